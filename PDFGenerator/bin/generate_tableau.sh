@@ -17,8 +17,8 @@ TABLEAU_XSL=$3
 PARENTDIR="$(dirname "$TABLEAU_BASENAME")"
 mkdir -p $PARENTDIR
 
-# Creation du fichier fo
-java -jar vendors/saxon/saxon9.jar -warnings:fatal -t $TABLEAU_XML $TABLEAU_XSL > $TABLEAU_BASENAME.fo
+# Creation du fichier fo (par le service Saxon s'il est démarré, sinon avec java)
+PYTHONPATH=http python -m home.saxon -warnings:fatal -t -o $TABLEAU_BASENAME.fo $TABLEAU_XML $TABLEAU_XSL
 
 # Creation du fichier pdf
 /usr/AHFormatterV6_64/run.sh -d $TABLEAU_BASENAME.fo -o $TABLEAU_BASENAME.pdf -extlevel 3 -i inputs/config/AHFormatterSettings.xml
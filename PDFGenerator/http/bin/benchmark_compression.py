@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Compare the compression of a PDF by a single Ghostscript pass against the
+compression by page ranges in parallel.
+
+    bin/benchmark_compression.py <document.pdf> [--runs 3]
+
+The size of the compressed PDF is reported along the durations, the parallel
+mode recompresses the resources shared by the pages once per range.
+"""
+import argparse
+import asyncio
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from bin.generator import Generator
+from home.compression import page_count
+
+
+async def _time_compression(document: Path, parallel: bool) -> tuple[float, int]:
+    with tempfile.TemporaryDirectory() as home_generation_path:
+        ouvrage_path = Path(home_generation_path) / "benchmark" / "ouvrage"
+        ouvrage_path.mkdir(parents=True)
+        shutil.copy(document, ouvrage_path / "document.pdf")
+
+        generator = Generator(ouvrage_path, s3_endpoint=None, s3_inputs_bucket=None)
+
+        start = time.perf_counter()
+        if parallel:
+            await generator._compress_ouvrage_in_parallel()
+        else:
+            await asyncio.to_thread(generator._compress_ouvrage)
+        duration = time.perf_counter() - start
+        return duration, (ouvrage_path / "document_optimized.pdf").stat().st_size
+
+
+async def benchmark(document: Path, runs: int) -> None:
+    print(f"{document}, {page_count(document)} pages, {runs} runs")
+
+    for label, parallel in [("single pass", False), ("page ranges", True)]:
+        results = [await _time_compression(document, parallel) for _ in range(runs)]
+        median = statistics.median(duration for duration, _ in results)
+        size = results[-1][1]
+        print(f"{label:>12}: median {median:.2f}s, {size / 1_000_000:.1f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("document", type=Path)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.document, args.runs))
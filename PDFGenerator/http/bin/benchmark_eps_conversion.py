@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Compare EPS to PDF conversion with one `ps2pdf` process per file against the
+persistent Ghostscript worker pool.
+
+    bin/benchmark_eps_conversion.py <folder containing EPS files> [--runs 3]
+
+The EPS conversion cache is bypassed so every run converts every file.
+"""
+import argparse
+import asyncio
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from bin.generator import Generator
+from home.file_cache import FileCache
+from home.illustrations import EPS_PATTERN
+
+
+async def _time_conversion(eps_folder: Path, gs_pool: bool) -> float:
+    with tempfile.TemporaryDirectory() as home_generation_path:
+        ouvrage_path = Path(home_generation_path) / "benchmark" / "ouvrage"
+        ouvrage_path.mkdir(parents=True)
+        shutil.copytree(eps_folder, ouvrage_path / "illustrations" / "eps")
+
+        generator = Generator(
+            ouvrage_path,
+            s3_endpoint=None,
+            s3_inputs_bucket=None,
+            gs_pool=gs_pool,
+        )
+        generator.eps_cache = FileCache(Path(home_generation_path) / "cache", 0)
+
+        start = time.perf_counter()
+        await generator._convert_eps_to_pdf(ouvrage_path)
+        return time.perf_counter() - start
+
+
+async def benchmark(eps_folder: Path, runs: int) -> None:
+    eps_count = sum(1 for _ in eps_folder.rglob(EPS_PATTERN))
+    print(f"{eps_count} EPS files, {runs} runs")
+
+    for label, gs_pool in [("ps2pdf per file", False), ("Ghostscript pool", True)]:
+        durations = [await _time_conversion(eps_folder, gs_pool) for _ in range(runs)]
+        median = statistics.median(durations)
+        print(
+            f"{label:>16}: median {median:.2f}s"
+            f" ({1000 * median / max(eps_count, 1):.1f}ms per file)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("eps_folder", type=Path)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.eps_folder, args.runs))
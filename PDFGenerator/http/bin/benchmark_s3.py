@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Compare the S3 transfers run by `awscli` processes against the transfers run
+in the process, on a local S3 stand-in.
+
+    moto_server -p 5000 &  # or MinIO
+    AWS_ACCESS_KEY_ID=fake AWS_SECRET_ACCESS_KEY=fake \\
+        bin/benchmark_s3.py http://127.0.0.1:5000 [--files 20] [--size 1]
+
+Uploads are compared with an `awscli` process by file, as the generator wrote
+its outputs, and downloads with a recursive copy by a single process.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from home.s3_transfer import S3Transfers
+
+BUCKET = "sppnaut-benchmark"
+
+
+def _awscli(endpoint: str, *args: str) -> None:
+    subprocess.run(
+        [sys.executable, "-m", "awscli", "s3", *args, "--endpoint-url", endpoint],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def _timed(label: str, processes: int, transfer) -> None:
+    start = time.perf_counter()
+    transfer()
+    duration = time.perf_counter() - start
+    print(f"{label:>28}: {duration:.2f}s, {processes} processes")
+
+
+def benchmark(endpoint: str, file_count: int, size: int) -> None:
+    transfers = S3Transfers(endpoint)
+    transfers.client.create_bucket(Bucket=BUCKET)
+    with tempfile.TemporaryDirectory() as folder:
+        sources = Path(folder) / "sources"
+        sources.mkdir()
+        files = []
+        for index in range(file_count):
+            files.append(sources / f"{index}.pdf")
+            files[-1].write_bytes(os.urandom(size * 1024 * 1024))
+        print(f"{file_count} files of {size}MB")
+
+        _timed(
+            "upload, awscli by file",
+            file_count,
+            lambda: [
+                _awscli(endpoint, "cp", str(file), f"s3://{BUCKET}/awscli/{file.name}")
+                for file in files
+            ],
+        )
+        _timed(
+            "upload, in process",
+            0,
+            lambda: transfers.upload_files(
+                {file: f"s3://{BUCKET}/boto3/{file.name}" for file in files}
+            ),
+        )
+        _timed(
+            "download, awscli recursive",
+            1,
+            lambda: _awscli(
+                endpoint,
+                "cp",
+                "--recursive",
+                f"s3://{BUCKET}/awscli",
+                str(Path(folder) / "awscli"),
+            ),
+        )
+        _timed(
+            "download, in process",
+            0,
+            lambda: transfers.download_folder(
+                f"s3://{BUCKET}/boto3", Path(folder) / "boto3"
+            ),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("endpoint", help="URL of the S3 stand-in")
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size", type=int, default=1, help="size of a file, in MB")
+    args = parser.parse_args()
+    benchmark(args.endpoint, args.files, args.size)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Compare Saxon transforms run by the command line (one JVM per transform)
+against the Saxon transformation service.
+
+    bin/benchmark_saxon.py <document.xml> [<stylesheet.xsl>] [--runs 5]
+
+Without a stylesheet, the one of the `xml-stylesheet` processing instruction
+of the document is used, like the FO generation does. The service must be
+running (see services.sh); its first transform is reported separately since
+it includes the JIT warm-up.
+"""
+import argparse
+import statistics
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from home.saxon import SAXON_JAR, SaxonService, associated_stylesheet
+
+
+def _time(transform) -> float:
+    start = time.perf_counter()
+    transform()
+    return time.perf_counter() - start
+
+
+def benchmark(document: Path, stylesheet: Path, runs: int) -> None:
+    stylesheet = stylesheet or associated_stylesheet(document)
+    print(f"{document} with {stylesheet}, {runs} runs")
+
+    with tempfile.TemporaryDirectory() as output_folder:
+        output = Path(output_folder) / "output.xml"
+        cli_args = [
+            "java",
+            "-jar",
+            str(SAXON_JAR),
+            "-o",
+            str(output),
+            str(document),
+            str(stylesheet),
+        ]
+        cli_durations = [
+            _time(lambda: subprocess.run(cli_args, check=True, capture_output=True))
+            for _ in range(runs)
+        ]
+
+        saxon_service = SaxonService()
+
+        def service_transform():
+            if not saxon_service.transform(document, stylesheet, output):
+                raise SystemExit(
+                    f"Saxon service not running on {saxon_service.address}"
+                )
+
+        first_duration = _time(service_transform)
+        service_durations = [_time(service_transform) for _ in range(runs)]
+
+    print(f"{'cold command line':>20}: median {statistics.median(cli_durations):.2f}s")
+    print(f"{'service, first run':>20}: {first_duration:.2f}s")
+    print(f"{'warm service':>20}: median {statistics.median(service_durations):.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("document", type=Path)
+    parser.add_argument("stylesheet", type=Path, nargs="?")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    benchmark(args.document, args.stylesheet, args.runs)
@@ -1,20 +1,51 @@
 #!/usr/bin/env python
 import argparse
 import asyncio
+import hashlib
+import json
 import logging
 import os
 import shutil
 import subprocess
+import time
 from dataclasses import dataclass, field
 from pathlib import Path
-from zipfile import ZIP_DEFLATED, ZipFile
+from typing import Awaitable, Callable
+from xml.etree import ElementTree
 
-from home.s3 import bootstrap_assets
+from home.compression import PageGeometryError, page_count, page_ranges, reassemble
+from home.file_cache import FileCache, file_digest
+from home.fingerprint import (
+    FINGERPRINT_FILENAME,
+    commun_illustrations,
+    input_fingerprint,
+    write_fingerprint,
+)
+from home.fo_split import MAX_RENDERING_PASSES, SplitDocument, measure
+from home.ghostscript import GhostscriptPool
+from home.illustrations import (
+    EPS_CACHE_FOLDER,
+    EPS_CACHE_MAX_SIZE,
+    EPS_PATTERN,
+    PS2PDF_COMMAND,
+    is_image,
+    pdf_path,
+    referenced_files,
+)
+from home.incremental import BuildManifest, light_stamp, stamp
+from home.memory import Admission, MemoryBudget
+from home.s3 import CONVERTED_COMMUN_FOLDER, SHOM_ASSETS_ETAGS, bootstrap_assets
+from home.s3_transfer import S3_CACHE_FOLDER, S3_CACHE_MAX_SIZE, S3Transfers
+from home.saxon import SAXON_JAR, SaxonService, Transform
+from home.slots import TOOL_SLOTS_RESERVED, HostSlots, Slot, tool_of
+from home.workspace import WorkspaceLinker
 
 ROOT_PATH = Path(__file__).parent.parent.parent
 
-ARCHIVE_FILENAME = "archive.zip"
+# PDFs sent in a ZIP archive, one name by line
+BUNDLE_FILENAME = "bundle"
 LOG_FILENAME = "stderr.log"
+BUILD_MANIFEST_FILENAME = ".build_manifest.json"
 
 
 class Progress:
@@ -41,6 +72,39 @@ async def _gather_with_max_concurrency(n, *tasks):
     await asyncio.gather(*(sem_task(task) for task in tasks))
 
 
+@dataclass
+class Step:
+    name: str
+    run: Callable[[], Awaitable]
+    after: list[str] = field(default_factory=list)
+    # Displayed to the user when the step starts
+    description: str = None
+
+
+async def _run_steps(steps: list[Step], progress: Progress) -> None:
+    """
+    Run each step as soon as the steps it comes after are done.
+
+    When a step fails, the steps depending on it are not started, the running
+    ones are left to finish and the first error is raised.
+    """
+    tasks = {}
+
+    async def run(step: Step) -> None:
+        await asyncio.gather(*(tasks[name] for name in step.after))
+        if step.description:
+            progress.log_step(step.description)
+        await step.run()
+
+    for step in steps:
+        tasks[step.name] = asyncio.ensure_future(run(step))
+
+    results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
 @dataclass
 class Generator:
     ouvrage_path: Path
@@ -52,146 +116,562 @@ class Generator:
     vignette: bool = False
     metadata: bool = False
     cleanup: bool = True
+    gs_pool: bool = False
+    referenced_illustrations_only: bool = False
+    incremental: bool = False
+    single_parse: bool = False
+    parallel_compress: bool = False
+    split_rendering: bool = False
+    # Generations nobody waits for leave tool slots to the interactive ones
+    batch: bool = False
     logfile: Path = field(init=False)
     logger: logging.Logger = field(init=False)
+    log_handler: logging.Handler = field(init=False)
+    eps_cache: FileCache = field(init=False)
+    s3_cache: FileCache = field(init=False)
+    build_manifest: BuildManifest = field(init=False, default=None)
+    workspace: WorkspaceLinker = field(init=False, default_factory=WorkspaceLinker)
+    saxon_service: SaxonService = field(init=False, default_factory=SaxonService)
+    slots: HostSlots = field(init=False, default=None)
+    memory: MemoryBudget = field(init=False, default=None)
+    s3: S3Transfers = field(init=False, default=None)
+    # Version of the Shom assets read by the whole generation
+    shom_assets: Path = field(init=False, default=None)
+    # ETags of the fetched sources, by key relative to the ouvrage
+    source_etags: dict[str, str] = field(init=False, default=None)
+    metadata_generated: bool = field(init=False, default=False)
+    referenced_illustrations: set[str] = field(init=False, default=None)
 
     def __post_init__(self):
+        if self.incremental:
+            self.build_manifest = BuildManifest(
+                self.ouvrage_path / BUILD_MANIFEST_FILENAME
+            )
+        self.slots = HostSlots(reserved=TOOL_SLOTS_RESERVED if self.batch else 0)
+        self.memory = MemoryBudget()
+        self.eps_cache = FileCache(
+            self.ouvrage_path.parent.parent / EPS_CACHE_FOLDER, EPS_CACHE_MAX_SIZE
+        )
+        self.s3_cache = FileCache(
+            self.ouvrage_path.parent.parent / S3_CACHE_FOLDER, S3_CACHE_MAX_SIZE
+        )
         self.logfile = self.ouvrage_path / LOG_FILENAME
-        self.logger = logging.getLogger(self.ouvrage_path.name)
+        # Workers run many generations, of the same ouvrage too: each one has
+        # a logger of its own, writing to its own log file
+        self.logger = logging.getLogger(str(self.ouvrage_path.resolve()))
         self.logger.setLevel(logging.INFO)
-        file_handler = logging.FileHandler(self.logfile)
-        file_handler.setFormatter(
+        self.log_handler = logging.FileHandler(self.logfile)
+        self.log_handler.setFormatter(
             logging.Formatter(
-                fmt=f"%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+                fmt=f"%(asctime)s - {self.ouvrage_path.name} - %(levelname)s - %(message)s",
             )
         )
-        self.logger.addHandler(file_handler)
+        self.logger.addHandler(self.log_handler)
+        self.s3 = S3Transfers(self.s3_endpoint, self.logger)
 
-    def _run_and_log(self, args, check=True, **kwargs):
-        self.logger.info("SUBPROCESS : %s", " ".join(args))
-        with self.logfile.open("a") as log_file:
-            return subprocess.run(args, stderr=log_file, check=check, **kwargs)
+    def _log_slot(self, slot: Slot) -> None:
+        if slot.queued:
+            self.logger.info("SLOTS : %s waited %.2fs", slot.tool, slot.wait)
+
+    def _log_slots(self) -> None:
+        if self.slots.waits:
+            self.logger.info(
+                "SLOTS : waited %s",
+                ", ".join(
+                    f"{wait:.2f}s for {tool}" for tool, wait in self.slots.waits.items()
+                ),
+            )
+
+    def _log_admission(self, admission: Admission) -> None:
+        if admission.queued:
+            self.logger.info(
+                "MEMORY : %s waited %.2fs for %s MB",
+                admission.tool,
+                admission.wait,
+                admission.footprint // 2**20,
+            )
+
+    def _log_peak(self, admission: Admission) -> None:
+        if admission.peak:
+            self.logger.info(
+                "MEMORY : %s peaked at %s MB", admission.tool, admission.peak // 2**20
+            )
 
     async def _run_and_log_async(self, *args, **kwargs):
-        self.logger.info("SUBPROCESS : %s", " ".join(args))
-        with self.logfile.open("a") as log_file:
-            proc = await asyncio.create_subprocess_exec(
-                *args, stderr=log_file, **kwargs
+        tool = tool_of(args)
+        async with self.memory.admit_async(tool, self.ouvrage_path.name) as admission:
+            self._log_admission(admission)
+            async with self.slots.acquire_async(tool) as slot:
+                self._log_slot(slot)
+                self.logger.info("SUBPROCESS : %s", " ".join(args))
+                with self.logfile.open("a") as log_file:
+                    proc = await asyncio.create_subprocess_exec(
+                        *args, stderr=log_file, **kwargs
+                    )
+                    with admission.measure(proc.pid):
+                        returncode = await proc.wait()
+            self._log_peak(admission)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(
+                cmd=" ".join(args), returncode=returncode
             )
-            returncode = await proc.wait()
-            if returncode != 0:
-                raise subprocess.CalledProcessError(
-                    cmd=" ".join(*args), returncode=returncode
-                )
 
-    async def _convert_single_eps_to_pdf(self, eps: Path):
-        pdf_dir = eps.parent.parent / "pdf"
-        pdf_dir.mkdir(parents=True, exist_ok=True)
+    async def _transform_in_service(
+        self, document: Path, transforms: list[Transform]
+    ) -> bool:
+        if not self.saxon_service.enabled:
+            return False
+        # The transforms of the service take the memory and the slots of the
+        # command line, the JVM of the service being shared
+        async with self.memory.admit_async("java", self.ouvrage_path.name) as admission:
+            self._log_admission(admission)
+            async with self.slots.acquire_async("java") as slot:
+                self._log_slot(slot)
+                with self.logfile.open("a") as log_file:
+                    # The service answers on a blocking socket
+                    return await asyncio.to_thread(
+                        self.saxon_service.transform_all, document, transforms, log_file
+                    )
 
-        await self._run_and_log_async(
-            "ps2pdf",
-            "-dPDFSETTINGS=/prepress",
-            "-dEPSCrop",
-            str(eps.resolve()),
-            str((pdf_dir / (eps.stem + ".pdf")).resolve()),
-        )
+    async def _transform(self, document: Path, transforms: list[Transform]) -> None:
+        """Run Saxon transforms in the service, or with their command lines."""
+        start = time.perf_counter()
+        if await self._transform_in_service(document, transforms):
+            self.logger.info(
+                "SAXON SERVICE : %s in %.2fs",
+                ", ".join(
+                    (transform.stylesheet or document).name for transform in transforms
+                ),
+                time.perf_counter() - start,
+            )
+            return
+
+        for transform in transforms:
+            if transform.stdout:
+                with transform.stdout.open("w") as stdout_file:
+                    await self._run_and_log_async(
+                        *transform.command_line, stdout=stdout_file
+                    )
+            else:
+                await self._run_and_log_async(*transform.command_line)
+
+    def _is_up_to_date(self, stage: str, stamp: str, outputs: list[Path]) -> bool:
+        if self.build_manifest is None:
+            return False
+        if self.build_manifest.is_up_to_date(stage, stamp, outputs):
+            self.logger.info("UP TO DATE : %s", stage)
+            return True
+        self.build_manifest.invalidate(stage)
+        return False
+
+    def _record_stage(self, stage: str, stamp: str) -> None:
+        if self.build_manifest is not None:
+            self.build_manifest.record(stage, stamp)
+
+    async def _convert_single_eps_to_pdf(
+        self, eps: Path, gs_pool: GhostscriptPool = None
+    ):
+        pdf = pdf_path(eps)
+        pdf.parent.mkdir(parents=True, exist_ok=True)
+
+        stage = f"illustration {eps.relative_to(self.ouvrage_path.parent)}"
+        # PDFs of either converter are never served for the other
+        converter = gs_pool.cache_salts if gs_pool else PS2PDF_COMMAND
+        cache_key = await asyncio.to_thread(file_digest, eps, *converter)
+        if self._is_up_to_date(stage, cache_key, [pdf]):
+            return
+        if await asyncio.to_thread(self.eps_cache.fetch, cache_key, pdf):
+            self._record_stage(stage, cache_key)
+            return
+
+        # The fetch above unlinked the previous PDF, which may be shared with
+        # the mutual folder: conversions always write a new file
+        if gs_pool:
+            await gs_pool.convert(eps, pdf)
+        else:
+            await self._run_and_log_async(
+                *PS2PDF_COMMAND,
+                str(eps.resolve()),
+                str(pdf.resolve()),
+            )
+        await asyncio.to_thread(self.eps_cache.store, cache_key, pdf)
+        self._record_stage(stage, cache_key)
 
-    async def _convert_eps_to_pdf(self, eps_ancestor: Path) -> None:
-        convert_tasks = (
-            self._convert_single_eps_to_pdf(eps)
-            for eps in eps_ancestor.rglob("[!.]*.eps")
+    def _find_referenced_illustrations(self) -> None:
+        self.referenced_illustrations = self._referenced_illustrations()
+
+    def _referenced_illustrations(self) -> set[str]:
+        references = referenced_files(self.ouvrage_path / "xml" / "document.xml")
+
+        available_names = {
+            file.stem
+            for folder in [self.ouvrage_path, self.ouvrage_path.parent / "commun"]
+            for file in folder.rglob("*")
+            if file.is_file()
+        }
+        missing_images = sorted(
+            str(reference)
+            for reference in references
+            if is_image(reference) and reference.stem not in available_names
         )
+        if missing_images:
+            for missing_image in missing_images:
+                self.logger.error("MISSING ILLUSTRATION : %s", missing_image)
+            raise FileNotFoundError(
+                f"Illustrations not found: {', '.join(missing_images)}"
+            )
 
-        await _gather_with_max_concurrency(
-            os.cpu_count(),
-            *convert_tasks,
+        return {reference.stem for reference in references}
+
+    def _eps_files(
+        self, eps_ancestor: Path, skip_up_to_date: bool, only_names: set[str]
+    ) -> list[Path]:
+        return [
+            eps
+            for eps in eps_ancestor.rglob(EPS_PATTERN)
+            if not (skip_up_to_date and self._is_pdf_up_to_date(eps))
+            and (only_names is None or eps.stem in only_names)
+        ]
+
+    async def _convert_eps_to_pdf(
+        self,
+        eps_ancestor: Path,
+        skip_up_to_date: bool = False,
+        only_names: set[str] = None,
+    ) -> None:
+        eps_files = await asyncio.to_thread(
+            self._eps_files, eps_ancestor, skip_up_to_date, only_names
         )
+        if not self.gs_pool or not eps_files:
+            await _gather_with_max_concurrency(
+                os.cpu_count(),
+                *(self._convert_single_eps_to_pdf(eps) for eps in eps_files),
+            )
+            return
+
+        with self.logfile.open("a") as log_file:
+            async with GhostscriptPool(
+                size=min(os.cpu_count(), len(eps_files)),
+                permitted_directory=self.ouvrage_path.parent,
+                logger=self.logger,
+                log_file=log_file,
+                slots=self.slots,
+            ) as gs_pool:
+                conversions = [
+                    asyncio.ensure_future(self._convert_single_eps_to_pdf(eps, gs_pool))
+                    for eps in eps_files
+                ]
+                try:
+                    await asyncio.gather(*conversions)
+                finally:
+                    # None may queue a file once the workers are stopped
+                    for conversion in conversions:
+                        conversion.cancel()
+                    await asyncio.gather(*conversions, return_exceptions=True)
+
+    @staticmethod
+    def _is_pdf_up_to_date(eps: Path) -> bool:
+        try:
+            return pdf_path(eps).stat().st_mtime >= eps.stat().st_mtime
+        except FileNotFoundError:
+            return False
+
+    def _log_eps_cache(self) -> None:
+        if self.eps_cache.hits or self.eps_cache.misses:
+            self.logger.info(
+                "EPS CACHE : %s hits, %s misses",
+                self.eps_cache.hits,
+                self.eps_cache.misses,
+            )
+            self.eps_cache.evict()
+
+    def _bootstrap(self) -> None:
+        self.shom_assets = bootstrap_assets()
 
-    def _copy_remote_folder(self, folder_name) -> None:
+    def _copy_remote_folder(self, folder_name, mutual_folder_name=None) -> None:
         generation_path = self.ouvrage_path.parent
-        mutual_folder = generation_path.parent / folder_name
-        shutil.copytree(mutual_folder, generation_path / folder_name)
+        mutual_folder = self.shom_assets / (mutual_folder_name or folder_name)
+        if self.incremental:
+            # Left by the previous run, and maybe linked to the mutual folder
+            shutil.rmtree(generation_path / folder_name, ignore_errors=True)
+        self.workspace.link_tree(mutual_folder, generation_path / folder_name)
 
     def _copy_source_folder(self) -> None:
-        if (self.ouvrage_path / "source").exists():
+        if (self.ouvrage_path / "source").exists() and self.incremental:
+            # Kept in the ouvrage for the next runs
+            shutil.rmtree(self.ouvrage_path.parent / "source", ignore_errors=True)
+            self.workspace.link_tree(
+                self.ouvrage_path / "source", self.ouvrage_path.parent / "source"
+            )
+        elif (self.ouvrage_path / "source").exists():
             shutil.move(
                 self.ouvrage_path / "source", self.ouvrage_path.parent / "source"
             )
         else:
             self._copy_remote_folder("source")
+            self.saxon_service.linked_folders[self.ouvrage_path.parent / "source"] = (
+                self.shom_assets / "source"
+            )
 
-    def _generate_fo(self) -> None:
-        idocument_options = []
-        if (self.ouvrage_path / "idocument.donottouch.xml").exists():
-            idocument_options = ["pagination=false"]
-        self._run_and_log(
+    def _log_workspace(self) -> None:
+        self.logger.info(
+            "WORKSPACE : %s bytes linked, %s bytes copied",
+            self.workspace.linked_bytes,
+            self.workspace.copied_bytes,
+        )
+
+    def _fo_stamp(self) -> str:
+        return stamp(
+            self.ouvrage_path.parent,
             [
+                self.ouvrage_path / "xml" / "document.xml",
+                *(self.ouvrage_path.parent / "source" / "xsl").rglob("*.xsl"),
+                *self.ouvrage_path.glob("*.donottouch.xml"),
+            ],
+        )
+
+    def _pdf_stamp(self) -> str:
+        return stamp(
+            self.ouvrage_path.parent,
+            (self.ouvrage_path / "xml").glob("*.fo"),
+            file_digest(ROOT_PATH / "inputs" / "config" / "AHFormatterSettings.xml"),
+            # Illustrations are large, their modification dates are enough
+            light_stamp(
+                self.ouvrage_path.parent,
+                [
+                    file
+                    for folder in [
+                        self.ouvrage_path / "illustrations",
+                        self.ouvrage_path.parent / "commun",
+                    ]
+                    for file in folder.rglob("*")
+                    if file.is_file()
+                ],
+            ),
+        )
+
+    async def _generate_fo(self) -> None:
+        fo_stamp = None
+        if self.build_manifest is not None:
+            fo_stamp = await asyncio.to_thread(self._fo_stamp)
+            fo_files = list((self.ouvrage_path / "xml").glob("*.fo"))
+            if fo_files and self._is_up_to_date("fo", fo_stamp, fo_files):
+                return
+            for fo in fo_files:
+                fo.unlink()
+                (self.ouvrage_path / f"{fo.stem}.pdf").unlink(missing_ok=True)
+
+        await self._run_saxon_fo()
+        if fo_stamp:
+            self._record_stage("fo", fo_stamp)
+
+    async def _run_saxon_fo(self) -> None:
+        document = self.ouvrage_path / "xml" / "document.xml"
+        transforms = [self._fo_transform(document)]
+        if (self.ouvrage_path / "calmarafacon.donottouch.xml").exists():
+            transforms.append(self._calmar_transform(document))
+        if self.single_parse and self.metadata:
+            transforms.append(self._metadata_transform(document))
+            self.metadata_generated = True
+
+        if self.single_parse:
+            await self._transform(document, transforms)
+        else:
+            for transform in transforms:
+                await self._transform(document, [transform])
+
+    def _fo_transform(self, document: Path) -> Transform:
+        fo = self.ouvrage_path / "xml" / "document.fo"
+        idocument_parameters = {}
+        if (self.ouvrage_path / "idocument.donottouch.xml").exists():
+            idocument_parameters = {"pagination": "false"}
+        return Transform(
+            output=fo,
+            parameters=idocument_parameters,
+            warnings="recover",
+            command_line=[
                 "java",
                 "-jar",
-                str(ROOT_PATH / "vendors" / "saxon" / "saxon9.jar"),
+                str(SAXON_JAR),
                 "-warnings:recover",
                 "-t",
                 "-a",
-                str(self.ouvrage_path / "xml" / "document.xml"),
-                *idocument_options,
+                str(document),
+                *(f"{name}={value}" for name, value in idocument_parameters.items()),
+            ],
+            stdout=fo,
+        )
+
+    def _calmar_transform(self, document: Path) -> Transform:
+        calmar_stylesheet = (
+            self.ouvrage_path.parent / "source" / "xsl" / "fo" / "Calmar_A_Facon.xsl"
+        )
+        return Transform(
+            calmar_stylesheet,
+            warnings="recover",
+            command_line=[
+                "java",
+                "-jar",
+                str(SAXON_JAR),
+                "-warnings:recover",
+                "-t",
+                str(document),
+                str(calmar_stylesheet),
             ],
-            stdout=open(self.ouvrage_path / "xml" / "document.fo", "w"),
         )
-        if (self.ouvrage_path / "calmarafacon.donottouch.xml").exists():
-            self._run_and_log(
-                [
-                    "java",
-                    "-jar",
-                    str(ROOT_PATH / "vendors" / "saxon" / "saxon9.jar"),
-                    "-warnings:recover",
-                    "-t",
-                    str(self.ouvrage_path / "xml" / "document.xml"),
-                    str(
-                        self.ouvrage_path.parent
-                        / "source"
-                        / "xsl"
-                        / "fo"
-                        / "Calmar_A_Facon.xsl"
-                    ),
-                ],
-            )
+
+    def _metadata_transform(self, document: Path) -> Transform:
+        metadata = self.ouvrage_path / "metadonnees.xml"
+        metadata_stylesheet = (
+            self.ouvrage_path.parent
+            / "source"
+            / "xsl"
+            / "metadonnees"
+            / "ISO_OuvNaut.xsl"
+        )
+        return Transform(
+            metadata_stylesheet,
+            output=metadata,
+            command_line=[
+                "java",
+                "-jar",
+                str(SAXON_JAR),
+                "-t",
+                "-o",
+                str(metadata),
+                str(document),
+                str(metadata_stylesheet),
+            ],
+        )
+
+    async def _generate_and_bundle_pdfs(self) -> None:
+        await self._generate_pdfs()
+        await asyncio.to_thread(self._bundle_pdfs_if_needed)
 
     async def _generate_pdfs(self) -> None:
+        pdf_stamp = None
+        if self.build_manifest is not None:
+            pdf_stamp = await asyncio.to_thread(self._pdf_stamp)
+            pdfs = [
+                self.ouvrage_path / f"{fo.stem}.pdf"
+                for fo in (self.ouvrage_path / "xml").glob("*.fo")
+            ]
+            if self._is_up_to_date("pdf", pdf_stamp, pdfs):
+                return
+
+        await self._run_ahformatter()
+        if pdf_stamp:
+            self._record_stage("pdf", pdf_stamp)
+
+    def _ahformatter(self, fo: Path, pdf: Path) -> Awaitable:
         # AHFormatter run.sh writes the command invocation in stdout.
-        pdf_tasks = (
-            self._run_and_log_async(
-                "/usr/AHFormatterV6_64/run.sh",
-                "-d",
-                str(fo),
-                "-o",
-                str(self.ouvrage_path / f"{fo.stem}.pdf"),
-                "-extlevel",
-                "3",
-                "-i",
-                str(ROOT_PATH / "inputs" / "config" / "AHFormatterSettings.xml"),
-            )
-            for fo in (self.ouvrage_path / "xml").glob("*.fo")
+        return self._run_and_log_async(
+            "/usr/AHFormatterV6_64/run.sh",
+            "-d",
+            str(fo),
+            "-o",
+            str(pdf),
+            "-extlevel",
+            "3",
+            "-i",
+            str(ROOT_PATH / "inputs" / "config" / "AHFormatterSettings.xml"),
         )
+
+    async def _run_ahformatter(self) -> None:
+        fo_files = (self.ouvrage_path / "xml").glob("*.fo")
+        if self.split_rendering:
+            pdf_tasks = (self._render_by_parts(fo) for fo in fo_files)
+        else:
+            pdf_tasks = (
+                self._ahformatter(fo, self.ouvrage_path / f"{fo.stem}.pdf")
+                for fo in fo_files
+            )
         await _gather_with_max_concurrency(os.cpu_count(), *pdf_tasks)
 
+    async def _render_by_parts(self, fo: Path) -> None:
+        pdf = self.ouvrage_path / f"{fo.stem}.pdf"
+        document = await asyncio.to_thread(SplitDocument, fo, os.cpu_count())
+        if not document.splittable:
+            await self._ahformatter(fo, pdf)
+            return
+
+        parts_folder = fo.parent / f"{fo.stem}_parts"
+        parts_folder.mkdir(exist_ok=True)
+        part_fo_files = [
+            parts_folder / f"{index}.fo" for index in range(len(document.parts))
+        ]
+        part_pdfs = [part_fo.with_suffix(".pdf") for part_fo in part_fo_files]
+        layouts = [None] * len(document.parts)
+        rendered_digests = [None] * len(document.parts)
+        for rendering_pass in range(1, MAX_RENDERING_PASSES + 1):
+            parts = [
+                await asyncio.to_thread(document.part, index, layouts)
+                for index in range(len(document.parts))
+            ]
+            digests = [hashlib.sha256(part).digest() for part in parts]
+            # Parts are rendered again while the numbers of the others change
+            changed = [
+                index
+                for index, digest in enumerate(digests)
+                if digest != rendered_digests[index]
+            ]
+            if not changed:
+                break
+            self.logger.info(
+                "SPLIT RENDERING : %s, pass %s, parts %s",
+                fo.name,
+                rendering_pass,
+                changed,
+            )
+            await asyncio.gather(
+                *(
+                    asyncio.to_thread(part_fo_files[index].write_bytes, parts[index])
+                    for index in changed
+                )
+            )
+            await _gather_with_max_concurrency(
+                os.cpu_count(),
+                *(
+                    self._ahformatter(part_fo_files[index], part_pdfs[index])
+                    for index in changed
+                ),
+            )
+            for index in changed:
+                layouts[index] = await asyncio.to_thread(measure, part_pdfs[index])
+                rendered_digests[index] = digests[index]
+        else:
+            self.logger.warning(
+                "SPLIT RENDERING : %s, page numbers not stable after %s passes",
+                fo.name,
+                MAX_RENDERING_PASSES,
+            )
+
+        await asyncio.to_thread(document.merge, part_pdfs, layouts, pdf)
+
     def _bundle_pdfs_if_needed(self) -> None:
-        all_pdfs = list(self.ouvrage_path.glob("*.pdf"))
+        all_pdfs = sorted(self.ouvrage_path.glob("*.pdf"))
+        (self.ouvrage_path / BUNDLE_FILENAME).unlink(missing_ok=True)
         if len(all_pdfs) > 1:
-            self.logger.info("COMPRESSING : %s files", len(all_pdfs))
-            with ZipFile(
-                self.ouvrage_path / ARCHIVE_FILENAME, mode="w", compression=ZIP_DEFLATED
-            ) as zipfile:
-                for file in all_pdfs:
-                    self.logger.info("COMPRESSING : %s", file)
-                    zipfile.write(file, arcname=file.name)
+            self.logger.info("BUNDLING : %s files", len(all_pdfs))
+            (self.ouvrage_path / BUNDLE_FILENAME).write_text(
+                "".join(f"{file.name}\n" for file in all_pdfs)
+            )
 
     def _cleanup_folders(self) -> None:
+        # Incremental generations keep their intermediate files for the next run
+        intermediate_folders = (
+            []
+            if self.incremental
+            else [
+                self.ouvrage_path / "illustrations",
+                self.ouvrage_path / "tableaux",
+                self.ouvrage_path / "xml",
+                self.ouvrage_path.parent / "commun",
+                self.ouvrage_path.parent / "source",
+            ]
+        )
         for folder in [
-            self.ouvrage_path / "illustrations",
-            self.ouvrage_path / "tableaux",
-            self.ouvrage_path / "xml",
-            self.ouvrage_path.parent / "commun",
-            self.ouvrage_path.parent / "source",
+            *intermediate_folders,
             self.ouvrage_path.parent / "inputs",
         ]:
             shutil.rmtree(folder, ignore_errors=True)
@@ -202,101 +682,152 @@ class Generator:
             link_or_file.unlink(missing_ok=True)
 
     def _fetch_from_s3(self) -> None:
-        self._run_and_log(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "cp",
-                "--endpoint-url",
-                self.s3_endpoint,
-                "--recursive",
-                self.s3_source_path,
-                str(self.ouvrage_path),
-            ]
+        self.source_etags = self.s3.download_folder(
+            self.s3_source_path, self.ouvrage_path, cache=self.s3_cache
+        )
+        self.logger.info(
+            "S3 CACHE : %s hits, %s misses", self.s3_cache.hits, self.s3_cache.misses
         )
+        self.s3_cache.evict()
 
-    def _write_in_s3(self) -> None:
-        for file in [
-            self.ouvrage_path / "document.pdf",
-            self.ouvrage_path / "vignette.jpg",
-            self.logfile,
-            *self.ouvrage_path.glob("OUVNAUT_*.xml"),
-        ]:
-            self._run_and_log(
-                [
-                    "python",
-                    "-m",
-                    "awscli",
-                    "s3",
-                    "cp",
-                    "--endpoint-url",
-                    self.s3_endpoint,
-                    str(file),
-                    self.s3_destination_path + "/" + file.name,
-                ],
+    def _fingerprint_inputs(self) -> None:
+        # Without a fingerprint, the ouvrage is regenerated by the next batch:
+        # the one of a previous run must not be uploaded
+        (self.ouvrage_path / FINGERPRINT_FILENAME).unlink(missing_ok=True)
+        try:
+            shared_etags = json.loads(
+                (self.shom_assets / SHOM_ASSETS_ETAGS).read_text()
             )
+        except FileNotFoundError:
+            self.logger.warning("FINGERPRINT : no ETags in %s", self.shom_assets)
+            return
+        try:
+            references = referenced_files(self.ouvrage_path / "xml" / "document.xml")
+        except ElementTree.ParseError as error:
+            # The fingerprint is bookkeeping, the generation goes on
+            self.logger.warning("FINGERPRINT : document.xml not parsed (%s)", error)
+            return
+        illustrations = commun_illustrations(shared_etags, references)
+        fingerprint = input_fingerprint(self.source_etags, shared_etags, illustrations)
+        write_fingerprint(
+            self.ouvrage_path / FINGERPRINT_FILENAME, fingerprint, illustrations
+        )
+        self.logger.info("FINGERPRINT : %s", fingerprint)
+
+    def _write_in_s3(self) -> None:
+        self.s3.upload_files(
+            {
+                file: self.s3_destination_path + "/" + file.name
+                for file in [
+                    self.ouvrage_path / "document.pdf",
+                    self.ouvrage_path / "vignette.jpg",
+                    self.logfile,
+                    *self.ouvrage_path.glob("OUVNAUT_*.xml"),
+                ]
+            }
+        )
+        # Written last: the document is up to date once its fingerprint is
+        self.s3.upload_files(
+            {
+                file: self.s3_destination_path + "/" + file.name
+                for file in self.ouvrage_path.glob(FINGERPRINT_FILENAME)
+            }
+        )
 
-    def _compress_ouvrage(self) -> None:
+    def _compress_args(self, output: Path, *page_range: int) -> list[str]:
         # Ghostscript command line arguments:
         # https://ghostscript.com/docs/9.54.0/VectorDevices.htm
-        self._run_and_log(
-            [
-                "gs",
-                "-sDEVICE=pdfwrite",
-                "-dCompatibilityLevel=1.4",
-                "-dNOPAUSE",
-                "-dBATCH",
-                "-dPDFSETTINGS=/prepress",
-                "-dColorImageResolution=150",
-                "-dDownsampleColorImages=true",
-                "-dColorImageDownsampleThreshold=1.0",
-                "-sColorConversionStrategy=RGB",
-                f"-sOutputFile={self.ouvrage_path / 'document_optimized.pdf'}",
-                str(self.ouvrage_path / "document.pdf"),
-            ]
+        return [
+            "gs",
+            "-sDEVICE=pdfwrite",
+            "-dCompatibilityLevel=1.4",
+            "-dNOPAUSE",
+            "-dBATCH",
+            "-dPDFSETTINGS=/prepress",
+            "-dColorImageResolution=150",
+            "-dDownsampleColorImages=true",
+            "-dColorImageDownsampleThreshold=1.0",
+            "-sColorConversionStrategy=RGB",
+            *(
+                [f"-dFirstPage={page_range[0]}", f"-dLastPage={page_range[1]}"]
+                if page_range
+                else []
+            ),
+            f"-sOutputFile={output}",
+            str(self.ouvrage_path / "document.pdf"),
+        ]
+
+    async def _compress_ouvrage(self) -> None:
+        if self.build_manifest is not None:
+            # document.pdf is replaced, it is no longer the output of AHFormatter
+            self.build_manifest.invalidate("pdf")
+        await self._run_and_log_async(
+            *self._compress_args(self.ouvrage_path / "document_optimized.pdf")
+        )
+
+    async def _compress_ouvrage_in_parallel(self) -> None:
+        document = self.ouvrage_path / "document.pdf"
+        ranges = page_ranges(
+            await asyncio.to_thread(page_count, document), os.cpu_count()
         )
+        if len(ranges) == 1:
+            await self._compress_ouvrage()
+            return
+
+        if self.build_manifest is not None:
+            self.build_manifest.invalidate("pdf")
+        self.logger.info("COMPRESSION : %s ranges of pages %s", len(ranges), ranges)
+        parts = [
+            self.ouvrage_path / f"document_optimized_{first_page}-{last_page}.pdf"
+            for first_page, last_page in ranges
+        ]
+        try:
+            await asyncio.gather(
+                *(
+                    self._run_and_log_async(*self._compress_args(part, *page_range))
+                    for part, page_range in zip(parts, ranges)
+                )
+            )
+            await asyncio.to_thread(
+                reassemble,
+                document,
+                parts,
+                self.ouvrage_path / "document_optimized.pdf",
+            )
+        except PageGeometryError as error:
+            self.logger.warning("COMPRESSION : %s, in a single pass", error)
+            await self._compress_ouvrage()
+        finally:
+            for part in parts:
+                part.unlink(missing_ok=True)
+
+    def _replace_by_compressed_ouvrage(self) -> None:
         (self.ouvrage_path / "document_optimized.pdf").rename(
             self.ouvrage_path / "document.pdf"
         )
 
-    def _vignette_ouvrage(self) -> None:
-        self._run_and_log(
-            [
-                "gs",
-                "-dNOPAUSE",
-                "-dBATCH",
-                "-dFirstPage=1",
-                "-dLastPage=1",
-                "-sDEVICE=jpeg",
-                "-sOutputFile=" + str(self.ouvrage_path / "vignette.jpg"),
-                "-r150",
-                "-c...setpdfwrite",
-                "-f",
-                str(self.ouvrage_path / "document.pdf"),
-            ]
+    async def _vignette_ouvrage(self) -> None:
+        await self._run_and_log_async(
+            "gs",
+            "-dNOPAUSE",
+            "-dBATCH",
+            "-dFirstPage=1",
+            "-dLastPage=1",
+            "-sDEVICE=jpeg",
+            "-sOutputFile=" + str(self.ouvrage_path / "vignette.jpg"),
+            "-r150",
+            "-c...setpdfwrite",
+            "-f",
+            str(self.ouvrage_path / "document.pdf"),
         )
 
-    def _metadata_ouvrage(self) -> None:
-        self._run_and_log(
-            [
-                "java",
-                "-jar",
-                str(ROOT_PATH / "vendors" / "saxon" / "saxon9.jar"),
-                "-t",
-                "-o",
-                str(self.ouvrage_path / "metadonnees.xml"),
-                str(self.ouvrage_path / "xml" / "document.xml"),
-                str(
-                    self.ouvrage_path.parent
-                    / "source"
-                    / "xsl"
-                    / "metadonnees"
-                    / "ISO_OuvNaut.xsl"
-                ),
-            ]
-        )
+    async def _metadata_ouvrage_if_needed(self) -> None:
+        if not self.metadata_generated:
+            await self._metadata_ouvrage()
+
+    async def _metadata_ouvrage(self) -> None:
+        document = self.ouvrage_path / "xml" / "document.xml"
+        await self._transform(document, [self._metadata_transform(document)])
 
     async def __call__(self):
         displayable_step = self.ouvrage_path / "displayable_step"
@@ -315,55 +846,160 @@ class Generator:
 
         progress = Progress(displayable_step, step_count)
 
-        try:
-            progress.log_step("Récupération des ressources métiers du Shom")
-            bootstrap_assets()
-
-            if self.s3_endpoint and self.s3_source_path:
-                progress.log_step(
-                    "Récupération des sources de l'ouvrage dans le référentiel"
+        fetch = []
+        steps = [
+            Step(
+                "bootstrap",
+                lambda: asyncio.to_thread(self._bootstrap),
+                description="Récupération des ressources métiers du Shom",
+            )
+        ]
+        if self.s3_endpoint and self.s3_source_path:
+            fetch = ["fetch"]
+            steps.append(
+                Step(
+                    "fetch",
+                    lambda: asyncio.to_thread(self._fetch_from_s3),
+                    description="Récupération des sources de l'ouvrage dans le référentiel",
+                )
+            )
+            if self.s3_destination_path:
+                steps.append(
+                    Step(
+                        "fingerprint",
+                        lambda: asyncio.to_thread(self._fingerprint_inputs),
+                        after=["bootstrap", "fetch"],
+                    )
+                )
+        steps.append(
+            Step(
+                "commun",
+                # bootstrap_assets already converted the EPS of the mutual folder
+                lambda: asyncio.to_thread(
+                    self._copy_remote_folder, "commun", CONVERTED_COMMUN_FOLDER
+                ),
+                after=["bootstrap"],
+                description="Récupération des illustrations communes dans le référentiel",
+            )
+        )
+        references = []
+        if self.referenced_illustrations_only:
+            references = ["references"]
+            steps.append(
+                Step(
+                    "references",
+                    lambda: asyncio.to_thread(self._find_referenced_illustrations),
+                    after=["commun", *fetch],
+                )
+            )
+        steps += [
+            Step(
+                "convert_commun",
+                lambda: self._convert_eps_to_pdf(
+                    self.ouvrage_path.parent / "commun",
+                    skip_up_to_date=True,
+                    only_names=self.referenced_illustrations,
+                ),
+                after=["commun", *references],
+                description="Conversion des illustrations communes",
+            ),
+            Step(
+                "convert_ouvrage",
+                lambda: self._convert_eps_to_pdf(
+                    self.ouvrage_path, only_names=self.referenced_illustrations
+                ),
+                after=[*fetch, *references],
+                description="Conversion des illustrations de l'ouvrage",
+            ),
+            Step(
+                "eps_cache",
+                lambda: asyncio.to_thread(self._log_eps_cache),
+                after=["convert_commun", "convert_ouvrage"],
+            ),
+            Step(
+                "source",
+                lambda: asyncio.to_thread(self._copy_source_folder),
+                # EPS files of a local source folder are converted before it moves
+                after=["bootstrap", "commun", "convert_ouvrage"],
+                description="Récupération des sources communes",
+            ),
+            Step(
+                "workspace",
+                lambda: asyncio.to_thread(self._log_workspace),
+                after=["commun", "source"],
+            ),
+            Step(
+                "fo",
+                self._generate_fo,
+                after=["source"],
+                description="Génération des fichiers intermédiaires (FO)",
+            ),
+            Step(
+                "pdf",
+                self._generate_and_bundle_pdfs,
+                after=["fo", "eps_cache"],
+                description="Génération de l'ouvrage (PDF)",
+            ),
+        ]
+        if self.vignette:
+            steps.append(
+                Step(
+                    "vignette",
+                    self._vignette_ouvrage,
+                    after=["pdf"],
+                    description="Génération de la vignette",
+                )
+            )
+        if self.metadata:
+            steps.append(
+                Step(
+                    "metadata",
+                    self._metadata_ouvrage_if_needed,
+                    # The FO step generates the metadata in single parse mode
+                    after=["fo"] if self.single_parse else ["source"],
+                    description="Génération des métadonnées",
+                )
+            )
+        if self.compress:
+            steps += [
+                Step(
+                    "compress",
+                    self._compress_ouvrage_in_parallel
+                    if self.parallel_compress
+                    else self._compress_ouvrage,
+                    after=["pdf"],
+                    description="Compression du fichier PDF",
+                ),
+                Step(
+                    "replace_compressed",
+                    lambda: asyncio.to_thread(self._replace_by_compressed_ouvrage),
+                    # The vignette is generated from the uncompressed PDF
+                    after=["compress", *(["vignette"] if self.vignette else [])],
+                ),
+            ]
+        if self.s3_endpoint and self.s3_destination_path:
+            steps.append(
+                Step(
+                    "write",
+                    lambda: asyncio.to_thread(self._write_in_s3),
+                    after=[step.name for step in steps],
+                    description="Sauvegarde de l'ouvrage",
                 )
-                self._fetch_from_s3()
-
-            progress.log_step(
-                "Récupération des illustrations communes dans le référentiel"
             )
-            self._copy_remote_folder("commun")
-
-            progress.log_step("Conversion des illustrations communes")
-            await self._convert_eps_to_pdf(self.ouvrage_path.parent / "commun")
-
-            progress.log_step("Conversion des illustrations de l'ouvrage")
-            await self._convert_eps_to_pdf(self.ouvrage_path)
-
-            progress.log_step("Récupération des sources communes")
-            self._copy_source_folder()
-
-            progress.log_step("Génération des fichiers intermédiaires (FO)")
-            self._generate_fo()
-
-            progress.log_step("Génération de l'ouvrage (PDF)")
-            await self._generate_pdfs()
-            self._bundle_pdfs_if_needed()
-
-            if self.vignette:
-                progress.log_step("Génération de la vignette")
-                self._vignette_ouvrage()
-
-            if self.metadata:
-                progress.log_step("Génération des métadonnées")
-                self._metadata_ouvrage()
-
-            if self.compress:
-                progress.log_step("Compression du fichier PDF")
-                self._compress_ouvrage()
 
-            if self.s3_endpoint and self.s3_destination_path:
-                progress.log_step("Sauvegarde de l'ouvrage")
-                self._write_in_s3()
+        try:
+            await _run_steps(steps, progress)
         finally:
+            if self.build_manifest is not None:
+                await asyncio.to_thread(self.build_manifest.save)
+            self._log_slots()
             if self.cleanup:
-                self._cleanup_folders()
+                await asyncio.to_thread(self._cleanup_folders)
+            self._close_log()
+
+    def _close_log(self) -> None:
+        self.logger.removeHandler(self.log_handler)
+        self.log_handler.close()
 
 
 async def generate(*args, **kwargs):
@@ -380,5 +1016,12 @@ if __name__ == "__main__":
     parser.add_argument("--compress", action="store_true")
     parser.add_argument("--vignette", action="store_true")
     parser.add_argument("--metadata", action="store_true")
+    parser.add_argument("--gs_pool", action="store_true")
+    parser.add_argument("--referenced_illustrations_only", action="store_true")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--single_parse", action="store_true")
+    parser.add_argument("--parallel_compress", action="store_true")
+    parser.add_argument("--split_rendering", action="store_true")
+    parser.add_argument("--batch", action="store_true")
     args = parser.parse_args()
     asyncio.run(generate(**vars(args)))
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 """
 
 from pathlib import Path
+from urllib.parse import urlparse
 
 from core import error_reporting
 from decouple import config
@@ -65,6 +66,29 @@ TEMPLATES = [
 
 WSGI_APPLICATION = "core.wsgi.application"
 
+# Database, shared with procrastinate
+# https://docs.djangoproject.com/en/4.0/ref/settings/#databases
+
+if config("TEST", default=False, cast=bool):
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": ":memory:",
+        }
+    }
+else:
+    POSTGRESQL_ADDON_URI = urlparse(config("POSTGRESQL_ADDON_URI"))
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": POSTGRESQL_ADDON_URI.path.removeprefix("/"),
+            "USER": POSTGRESQL_ADDON_URI.username,
+            "PASSWORD": POSTGRESQL_ADDON_URI.password,
+            "HOST": POSTGRESQL_ADDON_URI.hostname,
+            "PORT": POSTGRESQL_ADDON_URI.port or "",
+        }
+    }
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.0/topics/i18n/
 
@@ -0,0 +1,98 @@
+"""
+Compression of a PDF by page ranges, each range being compressed by its own
+Ghostscript process.
+
+The compressed ranges only provide the content of the pages: they are grafted
+onto the pages of the original document, which keeps its bookmarks, links,
+page labels and metadata that Ghostscript would lose across ranges.
+
+Ghostscript may also rotate pages (-dAutoRotatePages): the rotation goes with
+the content. The annotations of the original pages are positioned in their
+user space, so a range whose boxes Ghostscript changed can't be grafted.
+"""
+import math
+from pathlib import Path
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import NameObject, NumberObject
+
+# Below this size, a range is not worth another Ghostscript process
+MIN_PAGES_PER_RANGE = 50
+PAGE_CONTENT_KEYS = ["/Contents", "/Resources"]
+# In points, Ghostscript rounds the coordinates it writes
+BOX_TOLERANCE = 0.01
+
+
+class PageGeometryError(ValueError):
+    """A compressed page doesn't have the boxes of its original page."""
+
+
+def page_count(pdf: Path) -> int:
+    return len(PdfReader(pdf).pages)
+
+
+def page_ranges(page_count: int, range_count: int) -> list[tuple[int, int]]:
+    """
+    Split pages 1 to `page_count` in at most `range_count` ranges of similar
+    sizes, each of at least MIN_PAGES_PER_RANGE pages. Bounds are inclusive,
+    like -dFirstPage and -dLastPage.
+    """
+    range_count = max(1, min(range_count, page_count // MIN_PAGES_PER_RANGE))
+    size, remainder = divmod(page_count, range_count)
+    ranges, first_page = [], 1
+    for index in range(range_count):
+        last_page = first_page + size - 1 + (1 if index < remainder else 0)
+        ranges.append((first_page, last_page))
+        first_page = last_page + 1
+    return ranges
+
+
+def reassemble(original: Path, parts: list[Path], destination: Path) -> None:
+    """
+    Write `original` to `destination` with the content of its pages replaced
+    by the pages of `parts`, in order.
+
+    Raise PageGeometryError when the media or crop box of a compressed page
+    differs from the one of its original page.
+    """
+    reader = PdfReader(original)
+    compressed_pages = [page for part in parts for page in PdfReader(part).pages]
+    if len(compressed_pages) != len(reader.pages):
+        raise ValueError(
+            f"{len(compressed_pages)} compressed pages for the "
+            f"{len(reader.pages)} pages of {original}"
+        )
+
+    for number, (original_page, compressed_page) in enumerate(
+        zip(reader.pages, compressed_pages), start=1
+    ):
+        for box in ["mediabox", "cropbox"]:
+            original_box = getattr(original_page, box)
+            compressed_box = getattr(compressed_page, box)
+            if not _same_box(original_box, compressed_box):
+                raise PageGeometryError(
+                    f"{box} of page {number} of {original}: "
+                    f"{list(original_box)} compressed as {list(compressed_box)}"
+                )
+        # Pages of `reader.pages` are copies, the writer clones the objects
+        page = reader.get_object(original_page.indirect_reference)
+        if compressed_page.rotation != original_page.rotation:
+            page[NameObject("/Rotate")] = NumberObject(compressed_page.rotation)
+        for key in PAGE_CONTENT_KEYS:
+            if key in compressed_page:
+                page[NameObject(key)] = compressed_page.raw_get(key)
+            else:
+                page.pop(key, None)
+
+    writer = PdfWriter(clone_from=reader)
+    if reader.metadata:
+        writer.add_metadata(reader.metadata)
+    with destination.open("wb") as output:
+        writer.write(output)
+
+
+def _same_box(box, other_box) -> bool:
+    return all(
+        math.isclose(coordinate, other_coordinate, abs_tol=BOX_TOLERANCE)
+        for coordinate, other_coordinate in zip(box, other_box)
+    )
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+
+from .workspace import reflink
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path: Path, *salts: str) -> str:
+    digest = hashlib.sha256()
+    for salt in salts:
+        digest.update(salt.encode())
+        digest.update(b"\0")
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def clone_or_copy(source: Path, destination: Path) -> None:
+    """
+    Reflink `source` to `destination`, or copy it when the filesystem can't.
+
+    Unlike a hardlink, the destination is a file of its own: writing it in
+    place leaves the source untouched.
+    """
+    try:
+        reflink(source, destination)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+@dataclass
+class FileCache:
+    """
+    Content-addressed files shared between generations.
+
+    Entries are reflinked in and out of the cache, or copied on filesystems
+    without copy-on-write: a file of a generation is never shared with the
+    cache, and writing it in place can't corrupt the entry. Least recently
+    used entries are evicted once `max_size` bytes are exceeded. The access
+    time of an entry is its last use, its modification time (copied to the
+    fetched files) is left untouched.
+    """
+
+    directory: Path
+    max_size: int
+    hits: int = 0
+    misses: int = 0
+
+    def _entry(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def fetch(self, key: str, destination: Path) -> bool:
+        entry = self._entry(key)
+        destination.unlink(missing_ok=True)
+        try:
+            clone_or_copy(entry, destination)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+
+        self._touch(entry)
+        self.hits += 1
+        return True
+
+    @staticmethod
+    def _touch(entry: Path) -> None:
+        os.utime(entry, ns=(time.time_ns(), entry.stat().st_mtime_ns))
+
+    def store(self, key: str, source: Path) -> None:
+        entry = self._entry(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        # Another generation may store the same entry concurrently
+        temporary_entry = entry.with_name(f"{key}.{uuid.uuid4()}.tmp")
+        clone_or_copy(source, temporary_entry)
+        os.replace(temporary_entry, entry)
+        self._touch(entry)
+
+    def evict(self) -> None:
+        entries = []
+        for entry in self.directory.glob("*/*"):
+            try:
+                entries.append((entry, entry.stat()))
+            except FileNotFoundError:
+                pass
+
+        cache_size = sum(stat.st_size for _, stat in entries)
+        for entry, stat in sorted(entries, key=lambda entry: entry[1].st_atime):
+            if cache_size <= self.max_size:
+                break
+            entry.unlink(missing_ok=True)
+            cache_size -= stat.st_size
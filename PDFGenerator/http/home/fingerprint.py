@@ -0,0 +1,74 @@
+"""
+Fingerprint of the inputs of an ouvrage in the referentiel, written next to
+its generated document: the nightly regeneration compares it with the
+fingerprint of the current inputs, and regenerates the ouvrage only when they
+differ.
+
+The inputs are the objects of the ouvrage, the shared `source` folder (the
+XSL) and the `commun` illustrations referenced by the ouvrage. They are
+identified by their ETag, so re-uploading an unchanged file changes nothing.
+When referentiel-sync wrote a version object in the folder of the ouvrage, it
+stands for all its objects: the nightly regeneration reads it instead of
+listing the ouvrage.
+"""
+import hashlib
+import json
+from pathlib import Path, PurePosixPath
+from typing import Iterable
+
+FINGERPRINT_FILENAME = "fingerprint.json"
+# Shared folders of the referentiel read by the generations
+COMMUN_FOLDER = "commun"
+SOURCE_FOLDER = "source"
+# Replaced by referentiel-sync in the folder of an ouvrage after each change
+OUVRAGE_VERSION_FILENAME = "VERSION"
+
+
+def commun_illustrations(
+    shared_etags: dict[str, str], references: Iterable[PurePosixPath]
+) -> list[str]:
+    """Names of the `commun` files among the `references` of the document."""
+    names = {
+        PurePosixPath(key).stem
+        for key in shared_etags
+        if key.startswith(f"{COMMUN_FOLDER}/")
+    }
+    return sorted(names & {reference.stem for reference in references})
+
+
+def input_fingerprint(
+    ouvrage_etags: dict[str, str],
+    shared_etags: dict[str, str],
+    illustrations: Iterable[str],
+) -> str:
+    """
+    Digest of the ETags of the objects of the ouvrage, by key relative to it,
+    and of the shared objects it reads, by key relative to the bucket.
+    """
+    if OUVRAGE_VERSION_FILENAME in ouvrage_etags:
+        ouvrage_etags = {
+            OUVRAGE_VERSION_FILENAME: ouvrage_etags[OUVRAGE_VERSION_FILENAME]
+        }
+    illustrations = set(illustrations)
+    read_shared_etags = {
+        key: etag
+        for key, etag in shared_etags.items()
+        if key.startswith(f"{SOURCE_FOLDER}/")
+        or (
+            key.startswith(f"{COMMUN_FOLDER}/")
+            and PurePosixPath(key).stem in illustrations
+        )
+    }
+    digest = hashlib.sha256()
+    for etags in [ouvrage_etags, read_shared_etags]:
+        for key, etag in sorted(etags.items()):
+            digest.update(f"{key}\0{etag}\0".encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def write_fingerprint(file: Path, fingerprint: str, illustrations: list[str]):
+    # The illustrations are kept to fingerprint the current inputs the same way
+    file.write_text(
+        json.dumps({"fingerprint": fingerprint, "illustrations": illustrations})
+    )
@@ -0,0 +1,429 @@
+"""
+Rendering of a monolithic FO document by parts split at page-sequence
+boundaries (the chapters), so that AHFormatter renders them concurrently.
+
+Each part is a complete FO document with the layout masters and declarations
+of the original one. The page numbers a part can't know on its own come from
+the rendering of the other parts, so the parts are rendered again until they
+are stable:
+
+- the first page-sequence of a part continues the page numbering of the
+  previous part, whose last page-sequence ends on an odd or even page as it
+  would before the next page-sequence in a single document,
+- page-number citations of ids of other parts are replaced by their number,
+- links to ids of other parts point to a placeholder URI, replaced by a
+  destination in the merged PDF.
+
+The pages of these ids are read from the outline of the rendered parts: the
+bookmark tree of each part bookmarks them, and the bookmark tree of the
+document is rebuilt on the merged PDF. Markers retrieved across page-sequences
+(`retrieve-boundary="document"`) are not carried over to the next part.
+"""
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from urllib.parse import quote, unquote
+from xml.etree import ElementTree
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, Fit, NameObject, NullObject, NumberObject
+
+FO_NAMESPACE = "http://www.w3.org/1999/XSL/Format"
+FO = "{%s}" % FO_NAMESPACE
+PAGE_SEQUENCE = f"{FO}page-sequence"
+PAGE_SEQUENCE_WRAPPER = f"{FO}page-sequence-wrapper"
+CITATIONS = {f"{FO}page-number-citation", f"{FO}page-number-citation-last"}
+# Links to the ids of other parts, replaced by destinations in the merged PDF
+CROSS_PART_LINK = "https://sppnaut.invalid/destination/"
+SEQUENCE_ID_PREFIX = "sppnaut-sequence-"
+# The parts are rendered at least twice when they cite each other
+MAX_RENDERING_PASSES = 4
+# Page numbers not known yet, during the first rendering
+UNKNOWN_PAGE_NUMBER = "00"
+ROMAN_NUMERALS = [
+    (1000, "m"),
+    (900, "cm"),
+    (500, "d"),
+    (400, "cd"),
+    (100, "c"),
+    (90, "xc"),
+    (50, "l"),
+    (40, "xl"),
+    (10, "x"),
+    (9, "ix"),
+    (5, "v"),
+    (4, "iv"),
+    (1, "i"),
+]
+
+
+def format_page_number(number: int, format: str) -> str:
+    """Page number with the `format` property of its page-sequence."""
+    if format in {"i", "I"}:
+        numeral = ""
+        for value, letters in ROMAN_NUMERALS:
+            count, number = divmod(number, value)
+            numeral += letters * count
+        return numeral.upper() if format == "I" else numeral
+    if format in {"a", "A"}:
+        letters = ""
+        while number > 0:
+            number, remainder = divmod(number - 1, 26)
+            letters = chr(ord(format) + remainder) + letters
+        return letters
+    if re.fullmatch(r"0*1", format):
+        return str(number).zfill(len(format))
+    return str(number)
+
+
+@dataclass
+class Destination:
+    page: int  # index in the rendered part, or in the merged PDF
+    left: float = None
+    top: float = None
+
+    @property
+    def fit(self) -> Fit:
+        return Fit.xyz(self.left, self.top)
+
+
+@dataclass
+class PartLayout:
+    page_count: int
+    destinations: dict[str, Destination]
+
+
+def _coordinate(value) -> float:
+    return None if value is None or isinstance(value, NullObject) else float(value)
+
+
+def measure(pdf: Path) -> PartLayout:
+    """Pages of the ids bookmarked in a rendered part."""
+    reader = PdfReader(pdf)
+    return PartLayout(
+        len(reader.pages),
+        {
+            item.title: Destination(
+                reader.get_destination_page_number(item),
+                _coordinate(item.left),
+                _coordinate(item.top),
+            )
+            for item in reader.outline
+            if not isinstance(item, list)
+        },
+    )
+
+
+@dataclass
+class PageSequence:
+    element: ElementTree.Element
+    # The properties as written in the document, the parts override them
+    initial_page_number: str
+    force_page_count: str
+    format: str
+
+    @property
+    def id(self) -> str:
+        return self.element.get("id")
+
+    @property
+    def parity(self) -> int:
+        """Parity of its first page number when set by the document, else None."""
+        if self.initial_page_number.isdigit():
+            return int(self.initial_page_number) % 2
+        return {"auto-odd": 1, "auto-even": 0}.get(self.initial_page_number)
+
+    def continued_page_number(self, last_page_number: int) -> int:
+        page_number = last_page_number + 1
+        if self.parity is not None and page_number % 2 != self.parity:
+            page_number += 1
+        return page_number
+
+
+@dataclass
+class Part:
+    units: list[ElementTree.Element]
+    sequences: list[PageSequence]
+    ids: set[str]
+    # fo:inline replacing a citation of another part, with the cited id and
+    # whether the citation is of its last page
+    citations: list[tuple[ElementTree.Element, str, bool]] = field(default_factory=list)
+    # Ids whose page is needed, bookmarked in the part
+    bookmarked_ids: set[str] = field(default_factory=set)
+
+
+@dataclass
+class NumberedSequence:
+    sequence: PageSequence
+    start: int  # index of its first page in the part
+    end: int
+    page_number: int  # of its first page, None when not known yet
+
+
+def _page_sequences(unit: ElementTree.Element) -> list[ElementTree.Element]:
+    return [unit] if unit.tag == PAGE_SEQUENCE else list(unit.iter(PAGE_SEQUENCE))
+
+
+def _balanced_groups(units: list, part_count: int) -> list[list]:
+    """Split `units` in at most `part_count` consecutive groups of similar sizes."""
+    sizes = [sum(1 for _ in unit.iter()) for unit in units]
+    total, groups, cumulated_size = sum(sizes), [[]], 0
+    for unit, size in zip(units, sizes):
+        if groups[-1] and cumulated_size >= total * len(groups) / part_count:
+            groups.append([])
+        groups[-1].append(unit)
+        cumulated_size += size
+    return groups
+
+
+def _set(element: ElementTree.Element, name: str, value: str) -> None:
+    if value is None:
+        element.attrib.pop(name, None)
+    else:
+        element.set(name, value)
+
+
+class SplitDocument:
+    def __init__(self, fo: Path, part_count: int) -> None:
+        parser = ElementTree.iterparse(fo, events=("start-ns",))
+        ElementTree.register_namespace("fo", FO_NAMESPACE)
+        for _, (prefix, uri) in parser:
+            if prefix and uri != FO_NAMESPACE:
+                ElementTree.register_namespace(prefix, uri)
+        self.root = parser.root
+
+        units = [
+            child
+            for child in self.root
+            if child.tag in {PAGE_SEQUENCE, PAGE_SEQUENCE_WRAPPER}
+        ]
+        self.prelude = [
+            child
+            for child in self.root
+            if child.tag
+            not in {PAGE_SEQUENCE, PAGE_SEQUENCE_WRAPPER, f"{FO}bookmark-tree"}
+        ]
+        self.bookmark_tree = self.root.find(f"{FO}bookmark-tree")
+
+        self.parts, sequence_count = [], 0
+        for group in _balanced_groups(units, part_count) if units else []:
+            sequences = []
+            for element in (e for unit in group for e in _page_sequences(unit)):
+                sequence_count += 1
+                if not element.get("id"):
+                    element.set("id", f"{SEQUENCE_ID_PREFIX}{sequence_count}")
+                sequences.append(
+                    PageSequence(
+                        element,
+                        element.get("initial-page-number", "auto"),
+                        element.get("force-page-count"),
+                        element.get("format", "1"),
+                    )
+                )
+            ids = {
+                element.get("id")
+                for unit in group
+                for element in unit.iter()
+                if element.get("id")
+            }
+            self.parts.append(Part(group, sequences, ids))
+        self._link_parts()
+
+    @property
+    def splittable(self) -> bool:
+        return len(self.parts) > 1
+
+    def part_of(self, id: str) -> Part:
+        return next((part for part in self.parts if id in part.ids), None)
+
+    def _link_parts(self) -> None:
+        """Replace the references to other parts, and bookmark their targets."""
+        for part in self.parts:
+            part.bookmarked_ids.update(sequence.id for sequence in part.sequences)
+            for element in (e for unit in part.units for e in unit.iter()):
+                target = element.get("ref-id") or element.get("internal-destination")
+                target_part = self.part_of(target) if target else None
+                if target_part is None or target_part is part:
+                    continue
+                target_part.bookmarked_ids.add(target)
+                if element.tag in CITATIONS:
+                    part.citations.append(
+                        (element, target, element.tag.endswith("-last"))
+                    )
+                    element.tag = f"{FO}inline"
+                    del element.attrib["ref-id"]
+                elif element.get("internal-destination"):
+                    del element.attrib["internal-destination"]
+                    element.set(
+                        "external-destination",
+                        f"url('{CROSS_PART_LINK}{quote(target)}')",
+                    )
+
+        if self.bookmark_tree is not None:
+            for bookmark in self.bookmark_tree.iter(f"{FO}bookmark"):
+                target = bookmark.get("internal-destination")
+                if target_part := self.part_of(target):
+                    target_part.bookmarked_ids.add(target)
+
+    def _numbered_sequences(
+        self, layouts: list[PartLayout]
+    ) -> list[list[NumberedSequence]]:
+        """Page numbers of the sequences of the rendered parts."""
+        numbered_parts, last_page_number = [], 0
+        for part, layout in zip(self.parts, layouts):
+            if layout is None:
+                numbered_parts.append(None)
+                last_page_number = None
+                continue
+            starts = [layout.destinations[s.id].page for s in part.sequences]
+            numbered_sequences = []
+            for sequence, start, end in zip(
+                part.sequences, starts, starts[1:] + [layout.page_count]
+            ):
+                if sequence.initial_page_number.isdigit():
+                    page_number = int(sequence.initial_page_number)
+                elif last_page_number is not None:
+                    page_number = sequence.continued_page_number(last_page_number)
+                else:
+                    page_number = None
+                numbered_sequences.append(
+                    NumberedSequence(sequence, start, end, page_number)
+                )
+                last_page_number = (
+                    None if page_number is None else page_number + end - start - 1
+                )
+            numbered_parts.append(numbered_sequences)
+        return numbered_parts
+
+    def _page_number(
+        self,
+        numbered_parts: list[list[NumberedSequence]],
+        layouts: list[PartLayout],
+        id: str,
+        last: bool,
+    ) -> str:
+        index = self.parts.index(self.part_of(id))
+        if numbered_parts[index] is None or id not in layouts[index].destinations:
+            return None
+        page = layouts[index].destinations[id].page
+        for numbered in numbered_parts[index]:
+            if last and numbered.sequence.id == id:
+                page = numbered.end - 1
+        numbered = [n for n in numbered_parts[index] if n.start <= page][-1]
+        if numbered.page_number is None:
+            return None
+        return format_page_number(
+            numbered.page_number + page - numbered.start, numbered.sequence.format
+        )
+
+    def part(self, index: int, layouts: list[PartLayout]) -> bytes:
+        """FO document of a part, numbered after the `layouts` of the parts."""
+        part = self.parts[index]
+        numbered_parts = self._numbered_sequences(layouts)
+
+        first = part.sequences[0]
+        initial_page_number = first.initial_page_number
+        previous = numbered_parts[index - 1] if index > 0 else None
+        if not initial_page_number.isdigit():
+            if previous and previous[-1].page_number is not None:
+                initial_page_number = str(
+                    first.continued_page_number(
+                        previous[-1].page_number
+                        + previous[-1].end
+                        - previous[-1].start
+                        - 1
+                    )
+                )
+        _set(
+            first.element,
+            "initial-page-number",
+            None if initial_page_number == "auto" else initial_page_number,
+        )
+
+        last = part.sequences[-1]
+        force_page_count = last.force_page_count
+        if index + 1 < len(self.parts) and force_page_count in {None, "auto"}:
+            next_parity = self.parts[index + 1].sequences[0].parity
+            force_page_count = {1: "end-on-even", 0: "end-on-odd"}.get(next_parity)
+        _set(last.element, "force-page-count", force_page_count)
+
+        for element, id, last_page in part.citations:
+            element.text = (
+                self._page_number(numbered_parts, layouts, id, last_page)
+                or UNKNOWN_PAGE_NUMBER
+            )
+
+        bookmark_tree = ElementTree.Element(f"{FO}bookmark-tree")
+        for id in sorted(part.bookmarked_ids):
+            bookmark = ElementTree.SubElement(
+                bookmark_tree, f"{FO}bookmark", {"internal-destination": id}
+            )
+            ElementTree.SubElement(bookmark, f"{FO}bookmark-title").text = id
+
+        root = ElementTree.Element(self.root.tag, self.root.attrib)
+        root.extend([*self.prelude, bookmark_tree, *part.units])
+        return ElementTree.tostring(root, encoding="utf-8", xml_declaration=True)
+
+    def merge(
+        self, pdfs: list[Path], layouts: list[PartLayout], destination: Path
+    ) -> None:
+        """Concatenate the rendered parts, with the links and bookmarks between them."""
+        writer = PdfWriter()
+        destinations = {}
+        for pdf, layout in zip(pdfs, layouts):
+            offset = len(writer.pages)
+            writer.append(pdf, import_outline=False)
+            for id, part_destination in layout.destinations.items():
+                destinations[id] = Destination(
+                    offset + part_destination.page,
+                    part_destination.left,
+                    part_destination.top,
+                )
+
+        for page in writer.pages:
+            for annotation in page.get("/Annots", []):
+                annotation = annotation.get_object()
+                action = annotation.get("/A")
+                uri = action.get_object().get("/URI", "") if action else ""
+                if not uri.startswith(CROSS_PART_LINK):
+                    continue
+                target = destinations.get(unquote(uri.removeprefix(CROSS_PART_LINK)))
+                if target is not None:
+                    del annotation["/A"]
+                    annotation[NameObject("/Dest")] = ArrayObject(
+                        [
+                            writer.pages[target.page].indirect_reference,
+                            NameObject(target.fit.fit_type),
+                            *target.fit.fit_args,
+                        ]
+                    )
+
+        if self.bookmark_tree is not None:
+            closed_items = []
+            self._add_bookmarks(
+                writer, self.bookmark_tree, None, destinations, closed_items
+            )
+            for item in closed_items:
+                item = item.get_object()
+                if "/Count" in item:
+                    item[NameObject("/Count")] = NumberObject(-abs(item["/Count"]))
+
+        metadata = PdfReader(pdfs[0]).metadata
+        if metadata:
+            writer.add_metadata(metadata)
+        with destination.open("wb") as output:
+            writer.write(output)
+
+    def _add_bookmarks(self, writer, element, parent, destinations, closed_items):
+        for bookmark in element.findall(f"{FO}bookmark"):
+            title = bookmark.find(f"{FO}bookmark-title")
+            target = destinations.get(bookmark.get("internal-destination"))
+            item = writer.add_outline_item(
+                "".join(title.itertext()).strip() if title is not None else "",
+                target.page if target else None,
+                parent,
+                fit=target.fit if target else Fit.fit(),
+            )
+            if bookmark.get("starting-state") == "hide":
+                closed_items.append(item)
+            self._add_bookmarks(writer, bookmark, item, destinations, closed_items)
@@ -0,0 +1,172 @@
+import asyncio
+import contextlib
+import logging
+import subprocess
+import uuid
+from pathlib import Path
+from typing import IO
+
+from .illustrations import PS2PDF_OPTIONS
+from .slots import HostSlots
+
+
+def _postscript_string(value) -> str:
+    escaped = str(value).replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return f"({escaped})"
+
+
+class GhostscriptPool:
+    """
+    Long-lived Ghostscript interpreters converting EPS files to PDF.
+
+    Each worker is a `gs` process reading PostScript from its standard input:
+    every conversion switches the pdfwrite output file, runs the EPS file and
+    closes the output again. Ghostscript errors are caught per file with
+    `stopped`, so a broken illustration doesn't take the whole worker down.
+    """
+
+    def __init__(
+        self,
+        size: int,
+        permitted_directory: Path,
+        logger: logging.Logger,
+        log_file: IO,
+        slots: HostSlots = None,
+    ) -> None:
+        self.size = size
+        self.permitted_directory = permitted_directory.resolve()
+        self.logger = logger
+        self.log_file = log_file
+        # Each worker holds a gs slot of the host while it lives
+        self.slots = slots or HostSlots(folder="")
+        self.marker = f"%%SPPNAUT-{uuid.uuid4()}"
+        self._queue = asyncio.Queue()
+        self._workers = []
+
+    @property
+    def args(self) -> list[str]:
+        return [
+            "gs",
+            "-q",
+            "-P-",
+            "-dSAFER",
+            f"--permit-file-all={self.permitted_directory}/",
+            "-dNOPAUSE",
+            "-sDEVICE=pdfwrite",
+            # Set by ps2pdf
+            "-dCompatibilityLevel=1.4",
+            *PS2PDF_OPTIONS,
+            "-sOutputFile=/dev/null",
+            "-",
+        ]
+
+    @property
+    def cache_salts(self) -> list[str]:
+        """Arguments of the workers, without those of this generation."""
+        return [arg for arg in self.args if not arg.startswith("--permit-file-all=")]
+
+    async def __aenter__(self):
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.size)]
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for _ in self._workers:
+            self._queue.put_nowait(None)
+        await asyncio.gather(*self._workers)
+
+    async def convert(self, eps: Path, pdf: Path) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((eps, pdf, future))
+        await future
+
+    async def _start(self) -> asyncio.subprocess.Process:
+        self.logger.info("SUBPROCESS : %s", " ".join(self.args))
+        return await asyncio.create_subprocess_exec(
+            *self.args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=self.log_file,
+        )
+
+    def _program(self, eps: Path, pdf: Path) -> bytes:
+        close_output = "<< /OutputFile (/dev/null) >> setpagedevice"
+        return (
+            f"{{ << /OutputFile {_postscript_string(pdf.resolve())} >> setpagedevice "
+            f"{_postscript_string(eps.resolve())} run {close_output} }} stopped "
+            f"{{ {close_output} ({self.marker} error ) print "
+            f"$error /errorname get =only (\\n) print }} "
+            f"{{ ({self.marker} ok\\n) print }} ifelse flush "
+            f"clear cleardictstack\n"
+        ).encode()
+
+    async def _run(self, process, eps: Path, pdf: Path) -> None:
+        self.logger.info("GHOSTSCRIPT : %s", eps)
+        process.stdin.write(self._program(eps, pdf))
+        await process.stdin.drain()
+
+        while line := (await process.stdout.readline()).decode():
+            if not line.startswith(self.marker):
+                self.log_file.write(line)
+                continue
+
+            status = line.removeprefix(self.marker).strip()
+            if status == "ok":
+                return
+            self.logger.error("GHOSTSCRIPT : %s failed with %s", eps, status)
+            raise subprocess.CalledProcessError(cmd=f"gs {eps}", returncode=1)
+
+        self.logger.error("GHOSTSCRIPT : worker exited while converting %s", eps)
+        raise subprocess.CalledProcessError(cmd=f"gs {eps}", returncode=1)
+
+    @staticmethod
+    def _alive(process) -> bool:
+        # The returncode of an asyncio process is set once it is reaped, its
+        # output ends as soon as it exits
+        return process.returncode is None and not process.stdout.at_eof()
+
+    async def _work(self) -> None:
+        async with self.slots.acquire_async("gs") as slot:
+            if slot.queued:
+                self.logger.info("SLOTS : gs waited %.2fs", slot.wait)
+            await self._run_jobs()
+
+    async def _run_jobs(self) -> None:
+        process = None
+        try:
+            while job := await self._queue.get():
+                eps, pdf, future = job
+                if process is not None and not self._alive(process):
+                    await self._stop(process)
+                    process = None
+                try:
+                    if process is None:
+                        process = await self._start()
+                    try:
+                        await self._run(process, eps, pdf)
+                    except (BrokenPipeError, ConnectionResetError):
+                        # The worker exited before reading the job, run it again
+                        self.logger.warning("GHOSTSCRIPT : worker exited, restarting")
+                        await self._stop(process)
+                        process = None
+                        process = await self._start()
+                        await self._run(process, eps, pdf)
+                except Exception as error:
+                    if not future.cancelled():
+                        future.set_exception(error)
+                else:
+                    if not future.cancelled():
+                        future.set_result(None)
+        finally:
+            if process is not None:
+                await self._stop(process)
+
+    @staticmethod
+    async def _stop(process) -> None:
+        if process.returncode is None:
+            try:
+                process.stdin.write(b"quit\n")
+                process.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                with contextlib.suppress(ProcessLookupError):
+                    process.kill()
+        await process.wait()
@@ -0,0 +1,132 @@
+import logging
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from xml.etree import ElementTree
+
+from decouple import config
+
+from .file_cache import FileCache, file_digest
+from .slots import HostSlots
+
+EPS_CACHE_FOLDER = "eps_cache"
+EPS_CACHE_MAX_SIZE = config(
+    "EPS_CACHE_MAX_SIZE", default=2 * 1024 * 1024 * 1024, cast=int
+)  # 2 GiB
+PS2PDF_OPTIONS = ["-dPDFSETTINGS=/prepress", "-dEPSCrop"]
+# Salts the cache keys of the conversions as well, with the converter
+PS2PDF_COMMAND = ["ps2pdf", *PS2PDF_OPTIONS]
+EPS_PATTERN = "[!.]*.eps"
+IMAGE_SUFFIXES = {".eps", ".pdf", ".jpg", ".jpeg", ".png", ".svg", ".tif", ".tiff"}
+
+
+def pdf_path(eps: Path) -> Path:
+    return eps.parent.parent / "pdf" / (eps.stem + ".pdf")
+
+
+def referenced_files(document: Path) -> set[PurePosixPath]:
+    """
+    Every token of `document` attributes and texts that could name a file.
+
+    The stylesheets build illustration paths from these values, either from a
+    full file name (`carte.eps`, `../illustrations/eps/carte.eps`) or from a
+    bare name completed with the folder and extension (`carte`).
+    """
+    tokens = set()
+    for element in ElementTree.parse(document).iter():
+        for value in [*element.attrib.values(), element.text or ""]:
+            tokens.update(value.split())
+    return {PurePosixPath(token.replace("\\", "/")) for token in tokens}
+
+
+def is_image(path: PurePosixPath) -> bool:
+    return path.suffix.lower() in IMAGE_SUFFIXES
+
+
+def _is_same_file(source: Path, destination: Path) -> bool:
+    try:
+        source_stat, destination_stat = source.stat(), destination.stat()
+    except FileNotFoundError:
+        return False
+    return (source_stat.st_size, source_stat.st_mtime) == (
+        destination_stat.st_size,
+        destination_stat.st_mtime,
+    )
+
+
+def _convert(eps: Path, eps_cache: FileCache, slots: HostSlots) -> None:
+    pdf = pdf_path(eps)
+    pdf.parent.mkdir(parents=True, exist_ok=True)
+
+    cache_key = file_digest(eps, *PS2PDF_COMMAND)
+    if eps_cache.fetch(cache_key, pdf):
+        return
+
+    with slots.acquire("ps2pdf") as slot:
+        if slot.queued:
+            logging.info("SLOTS : ps2pdf waited %.2fs", slot.wait)
+        logging.info("PS2PDF: %s", eps)
+        subprocess.run(
+            [*PS2PDF_COMMAND, str(eps.resolve()), str(pdf.resolve())],
+            check=True,
+        )
+    eps_cache.store(cache_key, pdf)
+
+
+def convert_synced_folder(
+    synced_folder: Path,
+    converted_folder: Path,
+    eps_cache: FileCache,
+    slots: HostSlots = None,
+) -> None:
+    """
+    Mirror `synced_folder` in `converted_folder`, with every EPS converted to PDF.
+
+    Only the files added or changed since the previous call are copied and
+    converted, files removed from `synced_folder` are removed as well. The
+    conversions take `slots` of the host, without limit by default.
+    """
+    slots = slots or HostSlots(folder="")
+    synced_files = {
+        file.relative_to(synced_folder)
+        for file in synced_folder.rglob("*")
+        if file.is_file()
+    }
+    converted_pdfs = {
+        pdf_path(file) for file in synced_files if file.match(EPS_PATTERN)
+    }
+
+    changed_eps = []
+    for file in synced_files - converted_pdfs:
+        source, destination = synced_folder / file, converted_folder / file
+        if _is_same_file(source, destination):
+            continue
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        destination.unlink(missing_ok=True)
+        shutil.copy2(source, destination)
+        if file.match(EPS_PATTERN):
+            changed_eps.append(destination)
+
+    for file in converted_folder.rglob("*"):
+        relative_file = file.relative_to(converted_folder)
+        if (
+            file.is_file()
+            and relative_file not in synced_files
+            and relative_file not in converted_pdfs
+        ):
+            file.unlink()
+
+    for eps in converted_folder.rglob(EPS_PATTERN):
+        if not pdf_path(eps).exists():
+            changed_eps.append(eps)
+
+    logging.info("PS2PDF: %s files to convert", len(changed_eps))
+    with ThreadPoolExecutor(os.cpu_count()) as executor:
+        # Consuming the results raises the first conversion error, if any
+        list(
+            executor.map(lambda eps: _convert(eps, eps_cache, slots), set(changed_eps))
+        )
+    eps_cache.evict()
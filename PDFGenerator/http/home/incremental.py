@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable
+
+from .file_cache import file_digest
+
+
+def stamp(root: Path, files: Iterable[Path], *salts: str) -> str:
+    """Digest of the content and location (relative to `root`) of `files`."""
+    digest = hashlib.sha256()
+    for salt in salts:
+        digest.update(salt.encode())
+        digest.update(b"\0")
+    for file in sorted(files):
+        digest.update(str(file.relative_to(root)).encode())
+        digest.update(file_digest(file).encode())
+    return digest.hexdigest()
+
+
+def light_stamp(root: Path, files: Iterable[Path]) -> str:
+    """Same as `stamp`, based on file sizes and modification dates only."""
+    digest = hashlib.sha256()
+    for file in sorted(files):
+        file_stat = file.stat()
+        digest.update(
+            f"{file.relative_to(root)}\0{file_stat.st_size}\0{file_stat.st_mtime_ns}\0".encode()
+        )
+    return digest.hexdigest()
+
+
+@dataclass
+class BuildManifest:
+    """
+    Input stamps of the last successful run of each generation stage.
+
+    A stage is up to date when its inputs have the recorded stamp and its
+    outputs still exist. Stages are invalidated before running, so an
+    interrupted stage is never considered up to date.
+
+    Stamps are kept in memory and saved once, at the end of the generation,
+    successful or not. Until then, a marker file tells the next generation
+    that this one may have been killed with stages half run: the stamps of
+    the file are then ignored.
+    """
+
+    file: Path
+    stamps: dict = field(init=False)
+
+    def __post_init__(self):
+        try:
+            if self._unsaved_marker.exists():
+                raise FileNotFoundError(self._unsaved_marker)
+            self.stamps = json.loads(self.file.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.stamps = {}
+        self._unsaved_marker.touch()
+
+    @property
+    def _unsaved_marker(self) -> Path:
+        return self.file.with_name(f"{self.file.name}.unsaved")
+
+    def is_up_to_date(self, stage: str, stamp: str, outputs: Iterable[Path]) -> bool:
+        return self.stamps.get(stage) == stamp and all(
+            output.exists() for output in outputs
+        )
+
+    def invalidate(self, stage: str) -> None:
+        self.stamps.pop(stage, None)
+
+    def record(self, stage: str, stamp: str) -> None:
+        self.stamps[stage] = stamp
+
+    def save(self) -> None:
+        tmp_file = self.file.with_name(f"{self.file.name}.tmp")
+        tmp_file.write_text(json.dumps(self.stamps, indent=2))
+        os.replace(tmp_file, self.file)
+        self._unsaved_marker.unlink(missing_ok=True)
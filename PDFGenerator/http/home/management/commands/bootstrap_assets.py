@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
-from home.s3 import bootstrap_assets
+from home.s3 import refresh_assets
 
 
 class Command(BaseCommand):
     def handle(self, *args, **options):
-        bootstrap_assets()
+        refresh_assets()
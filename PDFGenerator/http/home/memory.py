@@ -0,0 +1,221 @@
+"""
+Memory admission of the heavy tools, AHFormatter and the Saxon command line,
+shared by every generation on the host.
+
+Each run reserves the footprint expected from the peak RSS of the previous
+runs of the tool for the same ouvrage, and waits while the reservations of
+the host would exceed the memory budget. A run is always admitted when
+nothing else is reserved, so an ouvrage larger than the budget still renders
+alone. Peaks are sampled from /proc over the process tree of the tool, as
+AHFormatter runs under its run.sh script.
+"""
+import asyncio
+import contextlib
+import fcntl
+import json
+import os
+import statistics
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from decouple import config
+
+from .slots import TOOL_SLOTS_FOLDER
+
+HEAVY_TOOLS = {"ahformatter", "java"}
+GIB = 1024 * 1024 * 1024
+# Footprints of the tools never measured yet
+DEFAULT_FOOTPRINTS = {"ahformatter": 2 * GIB, "java": 1 * GIB}
+HISTORY_SIZE = 5  # peaks kept by tool and ouvrage
+ADMISSION_POLL_INTERVAL = 1  # seconds
+RSS_SAMPLING_INTERVAL = 0.5  # seconds
+
+
+def memory_limit() -> int:
+    """Memory of the container, or of the host."""
+    limit = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for cgroup_limit in [
+        Path("/sys/fs/cgroup/memory.max"),
+        Path("/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+    ]:
+        try:
+            limit = min(limit, int(cgroup_limit.read_text()))
+        except (OSError, ValueError):  # missing, or "max"
+            continue
+    return limit
+
+
+# An empty folder disables the admission
+MEMORY_FOLDER = config("MEMORY_FOLDER", default=TOOL_SLOTS_FOLDER)
+MEMORY_BUDGET = config("MEMORY_BUDGET", default=int(0.8 * memory_limit()), cast=int)
+
+
+def _children() -> dict[int, list[int]]:
+    children = {}
+    for stat in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            # The command name, in parentheses, may contain spaces
+            fields = stat.read_text().rpartition(")")[2].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat.parent.name))
+    return children
+
+
+def tree_rss(pid: int) -> int:
+    """Resident memory of a process and its descendants, in bytes."""
+    children, rss, pending = _children(), 0, [pid]
+    while pending:
+        process = pending.pop()
+        pending += children.get(process, [])
+        try:
+            status = Path(f"/proc/{process}/status").read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith("VmRSS:"):
+                rss += int(line.split()[1]) * 1024
+    return rss
+
+
+class PeakRss:
+    """Peak resident memory of a process tree, sampled in a thread."""
+
+    def __init__(self, pid: int, interval: float = RSS_SAMPLING_INTERVAL) -> None:
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self) -> None:
+        while True:
+            self.peak = max(self.peak, tree_rss(self.pid))
+            if self._stopped.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+
+
+@dataclass
+class Admission:
+    tool: str
+    footprint: int = 0  # reserved bytes
+    queued: bool = False
+    wait: float = 0.0
+    peak: int = 0  # measured bytes, 0 when not measured
+
+    @contextlib.contextmanager
+    def measure(self, pid: int):
+        if not self.footprint:
+            yield
+            return
+        with PeakRss(pid) as peak_rss:
+            yield
+        self.peak = peak_rss.peak
+
+
+@dataclass
+class MemoryBudget:
+    folder: str = MEMORY_FOLDER
+    budget: int = MEMORY_BUDGET
+    tools: set[str] = field(default_factory=lambda: HEAVY_TOOLS)
+
+    @contextlib.contextmanager
+    def _locked(self, name: str, default):
+        """JSON state of the folder, saved when the `with` block succeeds."""
+        Path(self.folder).mkdir(parents=True, exist_ok=True)
+        with open(Path(self.folder) / "memory.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            file = Path(self.folder) / name
+            try:
+                state = json.loads(file.read_text())
+            except (FileNotFoundError, json.JSONDecodeError):
+                state = default
+            yield state
+            tmp_file = file.with_suffix(".tmp")
+            tmp_file.write_text(json.dumps(state))
+            os.replace(tmp_file, file)
+
+    def footprint(self, tool: str, ouvrage: str) -> int:
+        """Expected footprint: the largest recent peak of the ouvrage."""
+        with self._locked("memory_history.json", {}) as history:
+            peaks = history.get(tool, {})
+        if peaks.get(ouvrage):
+            return max(peaks[ouvrage])
+        if peaks:
+            return int(statistics.median(max(p) for p in peaks.values()))
+        return DEFAULT_FOOTPRINTS.get(tool, GIB)
+
+    def record(self, tool: str, ouvrage: str, peak: int) -> None:
+        with self._locked("memory_history.json", {}) as history:
+            peaks = history.setdefault(tool, {}).setdefault(ouvrage, [])
+            peaks[:] = [*peaks, peak][-HISTORY_SIZE:]
+
+    def _try_reserve(self, key: str, footprint: int) -> bool:
+        with self._locked("memory_reservations.json", {}) as reservations:
+            for other_key, (pid, _) in list(reservations.items()):
+                try:
+                    os.kill(pid, 0)
+                except ProcessLookupError:  # a generation that died
+                    del reservations[other_key]
+            reserved = sum(size for _, size in reservations.values())
+            if reservations and reserved + footprint > self.budget:
+                return False
+            reservations[key] = (os.getpid(), footprint)
+            return True
+
+    def _release(self, key: str) -> None:
+        with self._locked("memory_reservations.json", {}) as reservations:
+            reservations.pop(key, None)
+
+    def _enabled(self, tool: str) -> bool:
+        return bool(self.folder) and tool in self.tools
+
+    @contextlib.contextmanager
+    def admit(self, tool: str, ouvrage: str):
+        """Reserve the footprint of `tool` for the `with` block, once it fits."""
+        if not self._enabled(tool):
+            yield Admission(tool)
+            return
+        admission = Admission(tool, self.footprint(tool, ouvrage))
+        key, start = str(uuid.uuid4()), time.perf_counter()
+        while not self._try_reserve(key, admission.footprint):
+            admission.queued = True
+            time.sleep(ADMISSION_POLL_INTERVAL)
+        admission.wait = time.perf_counter() - start
+        try:
+            yield admission
+        finally:
+            self._release(key)
+            if admission.peak:
+                self.record(tool, ouvrage, admission.peak)
+
+    @contextlib.asynccontextmanager
+    async def admit_async(self, tool: str, ouvrage: str):
+        if not self._enabled(tool):
+            yield Admission(tool)
+            return
+        admission = Admission(
+            tool, await asyncio.to_thread(self.footprint, tool, ouvrage)
+        )
+        key, start = str(uuid.uuid4()), time.perf_counter()
+        while not await asyncio.to_thread(self._try_reserve, key, admission.footprint):
+            admission.queued = True
+            await asyncio.sleep(ADMISSION_POLL_INTERVAL)
+        admission.wait = time.perf_counter() - start
+        try:
+            yield admission
+        finally:
+            await asyncio.to_thread(self._release, key)
+            if admission.peak:
+                await asyncio.to_thread(self.record, tool, ouvrage, admission.peak)
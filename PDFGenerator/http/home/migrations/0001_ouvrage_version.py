@@ -0,0 +1,24 @@
+# Generated by Django 4.1.9 on 2026-10-17 14:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="OuvrageVersion",
+            fields=[
+                (
+                    "ouvrage",
+                    models.CharField(max_length=255, primary_key=True, serialize=False),
+                ),
+                ("source_last_modified", models.DateTimeField()),
+                ("generated_last_modified", models.DateTimeField(null=True)),
+                ("indexed_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.9 on 2026-10-17 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("home", "0001_ouvrage_version"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="ouvrageversion",
+            name="generated_last_modified",
+        ),
+        migrations.RemoveField(
+            model_name="ouvrageversion",
+            name="source_last_modified",
+        ),
+        migrations.AddField(
+            model_name="ouvrageversion",
+            name="generated_fingerprint",
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name="ouvrageversion",
+            name="source_fingerprint",
+            field=models.CharField(default="", max_length=64),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,53 @@
+from django.db import models, transaction
+from django.db.models import F, Q
+
+
+class OuvrageVersionQuerySet(models.QuerySet):
+    def outdated(self):
+        """Ouvrages whose inputs changed since their document was generated."""
+        return self.filter(
+            Q(generated_fingerprint__isnull=True)
+            | ~Q(generated_fingerprint=F("source_fingerprint"))
+        )
+
+    def refresh(self, versions: dict):
+        """
+        Replace the index by `versions`, the `(source, generated)` input
+        fingerprints by ouvrage.
+        """
+        with transaction.atomic(using=self.db):
+            self.exclude(ouvrage__in=versions).delete()
+            self.bulk_create(
+                [
+                    OuvrageVersion(
+                        ouvrage=ouvrage,
+                        source_fingerprint=source_fingerprint,
+                        generated_fingerprint=generated_fingerprint,
+                    )
+                    for ouvrage, (
+                        source_fingerprint,
+                        generated_fingerprint,
+                    ) in versions.items()
+                ],
+                update_conflicts=True,
+                unique_fields=["ouvrage"],
+                update_fields=[
+                    "source_fingerprint",
+                    "generated_fingerprint",
+                    "indexed_at",
+                ],
+            )
+
+
+class OuvrageVersion(models.Model):
+    """
+    Fingerprints of the current inputs of an ouvrage in the production
+    referentiel, and of the inputs of its generated document.
+    """
+
+    ouvrage = models.CharField(max_length=255, primary_key=True)
+    source_fingerprint = models.CharField(max_length=64)
+    generated_fingerprint = models.CharField(max_length=64, null=True)
+    indexed_at = models.DateTimeField(auto_now=True)
+
+    objects = OuvrageVersionQuerySet.as_manager()
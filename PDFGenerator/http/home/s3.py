@@ -1,15 +1,59 @@
+import contextlib
+import fcntl
+import json
 import logging
-import subprocess
+import os
+import shutil
+import time
+import uuid
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
 
 import boto3
+from botocore.exceptions import ClientError
 from decouple import config
 
+from .file_cache import FileCache
+from .fingerprint import (
+    COMMUN_FOLDER,
+    FINGERPRINT_FILENAME,
+    OUVRAGE_VERSION_FILENAME,
+    SOURCE_FOLDER,
+    input_fingerprint,
+)
+from .illustrations import EPS_CACHE_FOLDER, EPS_CACHE_MAX_SIZE, convert_synced_folder
+from .s3_transfer import S3_MAX_CONCURRENCY, S3Transfers
+from .slots import TOOL_SLOTS_RESERVED, HostSlots
+from .workspace import WorkspaceLinker
+
 DELIMITER = "/"
 FOLDERS_TO_IGNORE = {"Fichiers_communs"}
 PUBLIC_DOWNLOADS_AVAILABILITY = 60 * 60 * 24  # 1 day
 PRIVATE_DOWNLOADS_AVAILABILITY = 60 * 5  # 5 minutes
+CONVERTED_COMMUN_FOLDER = "commun_converti"
+# Object of the referentiel bucket replaced by referentiel-sync on each change
+SHOM_ASSETS_VERSION_KEY = "VERSION"
+# Version of the last sync of the Shom assets, in HOME_GENERATION_PATH
+SHOM_ASSETS_MARKER = ".shom_assets.json"
+# Synced versions of the Shom assets, in HOME_GENERATION_PATH, and the link to
+# the version read by the generations
+SHOM_ASSETS_FOLDER = "shom_assets"
+SHOM_ASSETS_CURRENT = "current"
+# ETags of the synced objects of a version, by key in the bucket
+SHOM_ASSETS_ETAGS = "etags.json"
+# Superseded versions are removed after this delay, once the generations
+# started on them are over
+SHOM_ASSETS_RETENTION = config(
+    "SHOM_ASSETS_RETENTION", default=6 * 60 * 60, cast=int
+)  # seconds
+# Lock files held by the generation syncing an asset tree, in
+# HOME_GENERATION_PATH
+COPYRIGHTED_ASSETS_LOCK = ".copyrighted_assets.lock"
+SHOM_ASSETS_LOCK = ".shom_assets.lock"
+# Without a version object, the assets are synced again after this delay
+SHOM_ASSETS_TTL = config("SHOM_ASSETS_TTL", default=5 * 60, cast=int)  # seconds
 
 # S3 constants from env
 S3_BUCKET_REFERENTIEL_PREPARATION = config("S3_BUCKET_REFERENTIEL_PREPARATION")
@@ -111,103 +155,264 @@ COPYRIGHTED_SOURCES_DIRECTORIES = {
 
 
 def _s3_cp(s3_path, destination_path, recursive=False):
-    recusive_params = ["--recursive"] if recursive else []
-    subprocess.run(
-        [
-            "python",
-            "-m",
-            "awscli",
-            "s3",
-            "cp",
-            *recusive_params,
-            "--endpoint-url",
-            S3_ENDPOINT,
-            f"s3://{S3_BUCKET_COPYRIGHTED_SOURCES}/{s3_path}",
-            str(destination_path),
-        ],
-        check=True,
-    )
+    transfers = S3Transfers(S3_ENDPOINT)
+    s3_uri = f"s3://{S3_BUCKET_COPYRIGHTED_SOURCES}/{s3_path}"
+    if recursive:
+        transfers.download_folder(s3_uri, destination_path)
+    else:
+        transfers.download_file(s3_uri, destination_path)
 
 
 def _s3_sync(s3_path, destination_path):
-    awscli = subprocess.run(
-        [
-            "python",
-            "-m",
-            "awscli",
-            "s3",
-            "sync",
-            "--delete",
-            "--endpoint-url",
-            S3_ENDPOINT,
-            f"s3://{S3_BUCKET_REFERENTIEL_PRODUCTION}/{s3_path}",
-            destination_path,
-        ],
-        stderr=subprocess.STDOUT,
-        stdout=subprocess.PIPE,
+    return S3Transfers(S3_ENDPOINT).sync_folder(
+        f"s3://{S3_BUCKET_REFERENTIEL_PRODUCTION}/{s3_path}", destination_path
     )
-    logging.info("AWSCLI: %s", awscli.stdout.decode())
-    awscli.check_returncode()
+
+
+@contextlib.contextmanager
+def _single_flight(lock_name):
+    """
+    Hold the lock of an asset tree for the `with` block, waiting for the
+    generation syncing it, so a single sync of the tree runs at a time on the
+    host. The kernel releases the lock when a generation dies.
+    """
+    HOME_GENERATION_PATH.mkdir(parents=True, exist_ok=True)
+    fd = os.open(HOME_GENERATION_PATH / lock_name, os.O_RDWR | os.O_CREAT)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info("BOOTSTRAP : waiting for the sync of %s", lock_name)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
 
 
 def _bootstrap_copyrighted_assets(
     copyrighted_sources_files, copyrighted_sources_directories
 ):
-    for s3_path, destination_path in copyrighted_sources_files.items():
-        if not destination_path.exists():
-            # Using recursive=True to copy a single file messes that file encoding
-            # We get an "Invalid encoding for signature" error from Saxon
-            _s3_cp(s3_path, destination_path)
-
-    for s3_path, destination_path in copyrighted_sources_directories.items():
-        if destination_path.is_dir() and not any(destination_path.iterdir()):
-            _s3_cp(s3_path, destination_path, recursive=True)
-
-
-def _bootstrap_shom_assets():
-    folders_to_sync = ["commun", "source"]
+    # Waiting generations find the assets downloaded by the previous one
+    with _single_flight(COPYRIGHTED_ASSETS_LOCK):
+        for s3_path, destination_path in copyrighted_sources_files.items():
+            if not destination_path.exists():
+                # Using recursive=True to copy a single file messes that file encoding
+                # We get an "Invalid encoding for signature" error from Saxon
+                _s3_cp(s3_path, destination_path)
+
+        for s3_path, destination_path in copyrighted_sources_directories.items():
+            if destination_path.is_dir() and not any(destination_path.iterdir()):
+                _s3_cp(s3_path, destination_path, recursive=True)
+
+
+def _head_etag(client, key):
+    """ETag of the object of the referentiel, None when there is none."""
+    try:
+        return client.head_object(Bucket=S3_BUCKET_REFERENTIEL_PRODUCTION, Key=key)[
+            "ETag"
+        ]
+    except ClientError as err:
+        if err.response["Error"]["Code"] in {"404", "NoSuchKey"}:
+            return None
+        raise
+
+
+def _shom_assets_version():
+    """ETag of the version object, None when the bucket has none."""
+    return _head_etag(S3Transfers(S3_ENDPOINT).client, SHOM_ASSETS_VERSION_KEY)
+
+
+def _are_shom_assets_up_to_date(version, requested_at) -> bool:
+    if not (HOME_GENERATION_PATH / SHOM_ASSETS_FOLDER / SHOM_ASSETS_CURRENT).exists():
+        return False
+    try:
+        marker = json.loads((HOME_GENERATION_PATH / SHOM_ASSETS_MARKER).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    if version is not None and marker["version"] == version:
+        return True
+    # Synced by the generation this one waited for
+    if marker["synced_at"] >= requested_at:
+        return True
+    return version is None and time.time() - marker["synced_at"] < SHOM_ASSETS_TTL
+
+
+def _refresh_shom_assets():
+    requested_at = time.time()
+    with _single_flight(SHOM_ASSETS_LOCK):
+        # Read before syncing: changes made during the sync are synced next time
+        version = _shom_assets_version()
+        if _are_shom_assets_up_to_date(version, requested_at):
+            logging.info("SHOM ASSETS : up to date, version %s", version)
+            return
+        _sync_shom_assets(version)
+
+
+def _sync_shom_assets(version):
+    """
+    Sync a new version of the Shom assets next to the current one, then switch
+    the generations to it.
+    """
+    versions_path = HOME_GENERATION_PATH / SHOM_ASSETS_FOLDER
+    current = versions_path / SHOM_ASSETS_CURRENT
+    version_path = versions_path / datetime.now().strftime("%Y%m%d%H%M%S%f")
+    if current.exists():
+        # Unchanged files are cloned from the current version instead of
+        # downloaded and converted again
+        WorkspaceLinker().link_tree(current.resolve(), version_path)
+
+    folders_to_sync = [COMMUN_FOLDER, SOURCE_FOLDER]
+    for folder_name in [*folders_to_sync, CONVERTED_COMMUN_FOLDER]:
+        # The generations link each folder, even empty
+        (version_path / folder_name).mkdir(parents=True, exist_ok=True)
+    etags = {}
     for folder_name in folders_to_sync:
-        _s3_sync(folder_name, HOME_GENERATION_PATH / folder_name)
+        for key, etag in _s3_sync(folder_name, version_path / folder_name).items():
+            etags[f"{folder_name}/{key}"] = etag
+    # Linked to the file of the current version, replaced
+    (version_path / SHOM_ASSETS_ETAGS).unlink(missing_ok=True)
+    (version_path / SHOM_ASSETS_ETAGS).write_text(json.dumps(etags))
+
+    convert_synced_folder(
+        version_path / "commun",
+        version_path / CONVERTED_COMMUN_FOLDER,
+        FileCache(HOME_GENERATION_PATH / EPS_CACHE_FOLDER, EPS_CACHE_MAX_SIZE),
+        # Like the batch, the refresh leaves slots to the interactive generations
+        HostSlots(reserved=TOOL_SLOTS_RESERVED),
+    )
+    _switch_current_shom_assets(version_path)
+    (HOME_GENERATION_PATH / SHOM_ASSETS_MARKER).write_text(
+        json.dumps({"version": version, "synced_at": time.time()})
+    )
+    _remove_superseded_shom_assets(versions_path)
+
+
+def _switch_current_shom_assets(version_path):
+    current = version_path.parent / SHOM_ASSETS_CURRENT
+    if current.exists():
+        # The retention of the superseded version starts now
+        now = time.time()
+        os.utime(current.resolve(), (now, now))
+    # Replacing the link is atomic, a generation reads either version
+    link = version_path.parent / f"{SHOM_ASSETS_CURRENT}.{uuid.uuid4()}.tmp"
+    link.symlink_to(version_path.name, target_is_directory=True)
+    os.replace(link, current)
+    logging.info("SHOM ASSETS : switched to %s", version_path)
+
+
+def _remove_superseded_shom_assets(versions_path):
+    current = (versions_path / SHOM_ASSETS_CURRENT).resolve()
+    for version_path in versions_path.iterdir():
+        if (
+            version_path.is_dir()
+            and not version_path.is_symlink()
+            and version_path != current
+            and time.time() - version_path.stat().st_mtime > SHOM_ASSETS_RETENTION
+        ):
+            logging.info("SHOM ASSETS : remove %s", version_path)
+            shutil.rmtree(version_path, ignore_errors=True)
 
 
 def bootstrap_assets(
     copyrighted_sources_files=COPYRIGHTED_SOURCES_FILES,
     copyrighted_sources_directories=COPYRIGHTED_SOURCES_DIRECTORIES,
-):
+) -> Path:
+    """
+    Folder of the current version of the Shom assets, kept up to date by the
+    `refresh_assets` task. They are synced here only when there is none yet.
+    """
     _bootstrap_copyrighted_assets(
         copyrighted_sources_files, copyrighted_sources_directories
     )
-    _bootstrap_shom_assets()
+    current = HOME_GENERATION_PATH / SHOM_ASSETS_FOLDER / SHOM_ASSETS_CURRENT
+    if not current.exists():
+        _refresh_shom_assets()
+    # Resolved once: the generation keeps reading this version after a switch
+    return current.resolve()
 
 
-def _get_last_modified_by_ouvrage_based_on_subpath(bucket_name, file_subpath_to_match):
-    s3_resource = boto3.resource(
-        "s3",
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        endpoint_url=S3_ENDPOINT,
+def refresh_assets(
+    copyrighted_sources_files=COPYRIGHTED_SOURCES_FILES,
+    copyrighted_sources_directories=COPYRIGHTED_SOURCES_DIRECTORIES,
+) -> None:
+    """Sync the assets, and switch to a new version of the Shom assets if any."""
+    _bootstrap_copyrighted_assets(
+        copyrighted_sources_files, copyrighted_sources_directories
     )
-    bucket = s3_resource.Bucket(bucket_name)
-    last_modified_by_ouvrage = {}
-    for file in bucket.objects.all():
-        try:
-            ouvrage, file_subpath = file.key.split("/", maxsplit=1)
-        except ValueError:
-            pass
-        else:
-            if file_subpath == file_subpath_to_match:
-                last_modified_by_ouvrage[ouvrage] = file.last_modified
+    _refresh_shom_assets()
 
-    return last_modified_by_ouvrage
 
-
-def get_generated_pdf_ouvrages():
-    return _get_last_modified_by_ouvrage_based_on_subpath(
-        S3_BUCKET_GENERATED_PRODUCTION, "document.pdf"
+def _generated_fingerprint(client, ouvrage):
+    """Content of the fingerprint of the generated document, None without one."""
+    try:
+        response = client.get_object(
+            Bucket=S3_BUCKET_GENERATED_PRODUCTION,
+            Key=f"{ouvrage}/{FINGERPRINT_FILENAME}",
+        )
+    except ClientError as error:
+        if error.response["Error"]["Code"] in {"404", "NoSuchKey"}:
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+def get_ouvrage_fingerprints():
+    """
+    Fingerprints of the current inputs of the ouvrages of the production
+    referentiel, and of the inputs of their generated document (None without
+    one).
+
+    The shared folders are listed once, then the inputs of each ouvrage and
+    the fingerprint of its document are requested concurrently. The inputs of
+    an ouvrage are identified by its version object, only the ouvrages without
+    one are listed.
+    """
+    transfers = S3Transfers(S3_ENDPOINT)
+    referentiel = f"s3://{S3_BUCKET_REFERENTIEL_PRODUCTION}"
+    ouvrages = sorted(
+        {
+            s3_object["Prefix"].removesuffix(DELIMITER)
+            for page in transfers.client.get_paginator("list_objects_v2").paginate(
+                Bucket=S3_BUCKET_REFERENTIEL_PRODUCTION, Delimiter=DELIMITER
+            )
+            for s3_object in page.get("CommonPrefixes", [])
+        }
+        - {COMMUN_FOLDER, SOURCE_FOLDER}
+        - FOLDERS_TO_IGNORE
     )
+    shared_etags = {
+        f"{folder_name}/{key}": etag
+        for folder_name in [COMMUN_FOLDER, SOURCE_FOLDER]
+        for key, etag in transfers.etags(f"{referentiel}/{folder_name}").items()
+    }
 
-
-def get_source_xml_ouvrages():
-    return _get_last_modified_by_ouvrage_based_on_subpath(
-        S3_BUCKET_REFERENTIEL_PRODUCTION, "xml/document.xml"
-    )
+    def inputs(ouvrage):
+        """ETags of the inputs of the ouvrage, None without a document."""
+        version = _head_etag(transfers.client, f"{ouvrage}/{OUVRAGE_VERSION_FILENAME}")
+        if version is None:
+            etags = transfers.etags(f"{referentiel}/{ouvrage}")
+            return etags if "xml/document.xml" in etags else None
+        if _head_etag(transfers.client, f"{ouvrage}/xml/document.xml") is None:
+            return None
+        return {OUVRAGE_VERSION_FILENAME: version}
+
+    def fingerprints(ouvrage):
+        ouvrage_etags = inputs(ouvrage)
+        if ouvrage_etags is None:
+            return None
+        generated = _generated_fingerprint(transfers.client, ouvrage)
+        source_fingerprint = input_fingerprint(
+            ouvrage_etags,
+            shared_etags,
+            generated["illustrations"] if generated else [],
+        )
+        return source_fingerprint, generated["fingerprint"] if generated else None
+
+    with ThreadPoolExecutor(S3_MAX_CONCURRENCY) as executor:
+        return {
+            ouvrage: ouvrage_fingerprints
+            for ouvrage, ouvrage_fingerprints in zip(
+                ouvrages, executor.map(fingerprints, ouvrages)
+            )
+            if ouvrage_fingerprints is not None
+        }
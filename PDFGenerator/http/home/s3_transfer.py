@@ -0,0 +1,201 @@
+"""
+S3 transfers run in the process with boto3, instead of an `awscli` process by
+command or by file.
+
+Clients are shared by endpoint, with a pool of connections as large as the
+transfer concurrency. Files are transferred concurrently, the large ones in
+concurrent multipart parts, and failed requests are retried by botocore.
+Credentials and the signature version come from the environment and the
+`~/.aws` configuration, as for `awscli`.
+
+Downloads may go through a FileCache keyed by bucket, key and ETag: objects
+left unchanged since a previous generation are copied from the cache instead
+of being downloaded again.
+"""
+import functools
+import hashlib
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+from decouple import config
+
+from .file_cache import FileCache
+
+MIB = 1024 * 1024
+S3_CACHE_FOLDER = "s3_cache"
+S3_CACHE_MAX_SIZE = config(
+    "S3_CACHE_MAX_SIZE", default=5 * 1024 * 1024 * 1024, cast=int
+)  # 5 GiB
+S3_MAX_CONCURRENCY = config("S3_MAX_CONCURRENCY", default=16, cast=int)
+S3_RETRY_ATTEMPTS = 5
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * MIB,
+    multipart_chunksize=16 * MIB,
+    max_concurrency=S3_MAX_CONCURRENCY,
+)
+
+
+def split_s3_uri(s3_uri: str) -> tuple[str, str]:
+    """Bucket and key of `s3://bucket/key`."""
+    bucket, _, key = s3_uri.removeprefix("s3://").partition("/")
+    return bucket, key
+
+
+def object_cache_key(bucket: str, s3_object: dict) -> str:
+    """The ETag changes with the content of the object."""
+    return hashlib.sha256(
+        "\0".join([bucket, s3_object["Key"], s3_object["ETag"]]).encode()
+    ).hexdigest()
+
+
+def _etags(s3_objects: dict[str, dict]) -> dict[str, str]:
+    return {key: s3_object["ETag"] for key, s3_object in s3_objects.items()}
+
+
+@functools.cache
+def s3_client(endpoint_url: str):
+    """Client of the endpoint, shared by the threads of the process."""
+    # Its own session, the default session of boto3 is not thread safe
+    return boto3.session.Session().client(
+        "s3",
+        endpoint_url=endpoint_url,
+        config=Config(
+            max_pool_connections=S3_MAX_CONCURRENCY,
+            retries={"max_attempts": S3_RETRY_ATTEMPTS, "mode": "standard"},
+        ),
+    )
+
+
+@dataclass
+class S3Transfers:
+    endpoint_url: str
+    logger: logging.Logger = field(default_factory=lambda: logging.getLogger(__name__))
+
+    @property
+    def client(self):
+        return s3_client(self.endpoint_url)
+
+    def _objects(self, bucket: str, prefix: str) -> dict[str, dict]:
+        """Objects of the "folder" `prefix`, by key relative to it."""
+        prefix = f"{prefix.rstrip('/')}/" if prefix else ""
+        return {
+            s3_object["Key"].removeprefix(prefix): s3_object
+            for page in self.client.get_paginator("list_objects_v2").paginate(
+                Bucket=bucket, Prefix=prefix
+            )
+            for s3_object in page.get("Contents", [])
+            if not s3_object["Key"].endswith("/")
+        }
+
+    def _download_all(self, downloads: list[tuple[str, str, Path]]) -> None:
+        """Download the `(bucket, key, path)` concurrently."""
+        with create_transfer_manager(self.client, TRANSFER_CONFIG) as manager:
+            futures = []
+            for bucket, key, path in downloads:
+                self.logger.info("S3 : download s3://%s/%s to %s", bucket, key, path)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                futures.append(manager.download(bucket, key, str(path)))
+            for future in futures:
+                future.result()
+
+    def _upload_all(self, uploads: list[tuple[str, str, Path]]) -> None:
+        """Upload the `(bucket, key, path)` concurrently."""
+        with create_transfer_manager(self.client, TRANSFER_CONFIG) as manager:
+            futures = []
+            for bucket, key, path in uploads:
+                self.logger.info("S3 : upload %s to s3://%s/%s", path, bucket, key)
+                futures.append(manager.upload(str(path), bucket, key))
+            for future in futures:
+                future.result()
+
+    def download_file(self, s3_uri: str, destination: Path) -> None:
+        self._download_all([(*split_s3_uri(s3_uri), destination)])
+
+    def etags(self, s3_uri: str) -> dict[str, str]:
+        """ETags of the objects under `s3_uri`, by key relative to it."""
+        return _etags(self._objects(*split_s3_uri(s3_uri)))
+
+    def download_folder(
+        self, s3_uri: str, destination: Path, cache: FileCache = None
+    ) -> dict[str, str]:
+        """
+        Download every object under `s3_uri`, like `aws s3 cp --recursive`,
+        copying the objects found in `cache` instead. Returns the ETags of the
+        downloaded objects.
+        """
+        bucket, prefix = split_s3_uri(s3_uri)
+        s3_objects = self._objects(bucket, prefix)
+        downloads = {}
+        for key, s3_object in s3_objects.items():
+            path = destination / key
+            if cache is not None:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                if cache.fetch(object_cache_key(bucket, s3_object), path):
+                    continue
+            downloads[path] = s3_object
+
+        self._download_all(
+            [(bucket, s3_object["Key"], path) for path, s3_object in downloads.items()]
+        )
+        if cache is not None:
+            for path, s3_object in downloads.items():
+                cache.store(object_cache_key(bucket, s3_object), path)
+        return _etags(s3_objects)
+
+    def sync_folder(
+        self, s3_uri: str, destination: Path, delete=True
+    ) -> dict[str, str]:
+        """
+        Download the objects of `s3_uri` missing from `destination`, or with
+        another size or a later modification, like `aws s3 sync`. Returns the
+        ETags of the synced objects.
+        """
+        bucket, prefix = split_s3_uri(s3_uri)
+        s3_objects = self._objects(bucket, prefix)
+        local_files = {
+            file.relative_to(destination).as_posix(): file
+            for file in destination.rglob("*")
+            if file.is_file()
+        }
+
+        def is_outdated(key: str, s3_object: dict) -> bool:
+            if key not in local_files:
+                return True
+            stat = local_files[key].stat()
+            return (
+                stat.st_size != s3_object["Size"]
+                or stat.st_mtime < s3_object["LastModified"].timestamp()
+            )
+
+        outdated = {
+            key: s3_object
+            for key, s3_object in s3_objects.items()
+            if is_outdated(key, s3_object)
+        }
+        self._download_all(
+            [
+                (bucket, s3_object["Key"], destination / key)
+                for key, s3_object in outdated.items()
+            ]
+        )
+        # As awscli, the local files take the modification time of the objects
+        for key, s3_object in outdated.items():
+            modified = s3_object["LastModified"].timestamp()
+            os.utime(destination / key, (modified, modified))
+
+        if delete:
+            for key in local_files.keys() - s3_objects.keys():
+                self.logger.info("S3 : delete %s", local_files[key])
+                local_files[key].unlink()
+        return _etags(s3_objects)
+
+    def upload_files(self, files: dict[Path, str]) -> None:
+        """Upload concurrently each file to its `s3://bucket/key`."""
+        self._upload_all(
+            [(*split_s3_uri(s3_uri), file) for file, s3_uri in files.items()]
+        )
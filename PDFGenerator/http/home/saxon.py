@@ -0,0 +1,223 @@
+"""
+Client of the Saxon transformation service (see `PDFGenerator/saxon-service`).
+
+Used as a script, it accepts the subset of the Saxon command line used by
+`bin/generate_tableau.sh` and falls back to the command line when the service
+is not reachable:
+
+    python -m home.saxon [-warnings:fatal] [-o output] source [stylesheet] [name=value…]
+"""
+import hashlib
+import logging
+import os
+import re
+import socket
+import subprocess
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO
+from xml.etree import ElementTree
+
+from decouple import config
+
+from .file_cache import file_digest
+
+SAXON_JAR = Path(__file__).parent.parent.parent / "vendors" / "saxon" / "saxon9.jar"
+# An empty address disables the service, transforms then use the command line
+SAXON_SERVICE_ADDRESS = config("SAXON_SERVICE_ADDRESS", default="127.0.0.1:8390")
+SAXON_SERVICE_TIMEOUT = 30 * 60  # seconds, a transform of the largest ouvrages
+XSL_NAMESPACE = "{http://www.w3.org/1999/XSL/Transform}"
+
+
+def associated_stylesheet(document: Path) -> Path:
+    """Stylesheet of the `xml-stylesheet` processing instruction, like `saxon -a`."""
+    for event, element in ElementTree.iterparse(document, events=("pi", "start")):
+        if event == "start":
+            break
+        target, _, data = element.text.partition(" ")
+        href = re.search(r"""href\s*=\s*["']([^"']*)["']""", data)
+        if target == "xml-stylesheet" and href:
+            return (document.parent / href.group(1)).resolve()
+    raise ValueError(f"No xml-stylesheet processing instruction in {document}")
+
+
+def stylesheet_digest(stylesheet: Path) -> str:
+    """
+    Digest of `stylesheet` and of the stylesheets it imports or includes.
+
+    Files are identified by their path relative to `stylesheet`, so identical
+    source trees in different generation folders have the same digest.
+    """
+    stylesheet = stylesheet.resolve()
+    modules, pending = set(), [stylesheet]
+    while pending:
+        module = pending.pop()
+        if module in modules:
+            continue
+        modules.add(module)
+        for element in ElementTree.parse(module).iter():
+            if element.tag in {f"{XSL_NAMESPACE}import", f"{XSL_NAMESPACE}include"}:
+                pending.append((module.parent / element.get("href")).resolve())
+
+    digest = hashlib.sha256()
+    for module in sorted(modules):
+        digest.update(os.path.relpath(module, stylesheet.parent).encode())
+        digest.update(file_digest(module).encode())
+    return digest.hexdigest()
+
+
+def stylesheet_key(stylesheet: Path) -> str:
+    """
+    Key of the compiled `stylesheet` in the service: its version, at its
+    location. Relative `xsl:import`, `document()` or `unparsed-text` URIs
+    resolve against the folder it was compiled from, which must still exist.
+    """
+    stylesheet = stylesheet.resolve()
+    return hashlib.sha256(
+        f"{stylesheet}\0{stylesheet_digest(stylesheet)}".encode()
+    ).hexdigest()
+
+
+@dataclass
+class Transform:
+    """
+    A transform of a source document by the Saxon service.
+
+    `command_line` runs the same transform when the service is not available,
+    with its principal output written to `stdout` when given.
+    """
+
+    stylesheet: Path = None  # None for the xml-stylesheet processing instruction
+    output: Path = None
+    parameters: dict[str, str] = field(default_factory=dict)
+    warnings: str = None
+    command_line: list[str] = field(default_factory=list)
+    stdout: Path = None
+
+
+@dataclass
+class SaxonService:
+    address: str = SAXON_SERVICE_ADDRESS
+    timeout: float = SAXON_SERVICE_TIMEOUT
+    # Folders linked from a longer-lived one: their stylesheets are sent from
+    # the latter, which the service can keep compiled
+    linked_folders: dict[Path, Path] = field(default_factory=dict)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.address)
+
+    def transform(
+        self,
+        source: Path,
+        stylesheet: Path = None,
+        output: Path = None,
+        parameters: dict[str, str] = None,
+        warnings: str = None,
+        log_file: IO = None,
+    ) -> bool:
+        return self.transform_all(
+            source,
+            [Transform(stylesheet, output, parameters or {}, warnings)],
+            log_file,
+        )
+
+    def transform_all(
+        self, source: Path, transforms: list[Transform], log_file: IO = None
+    ) -> bool:
+        """
+        Run `transforms` in the service, on a single parse of `source`.
+
+        Warnings and messages go to `log_file`. Returns False when the service
+        is not reachable, so the caller can use the command line instead.
+        Raises CalledProcessError when a transform fails.
+        """
+        if not self.enabled:
+            return False
+        host, _, port = self.address.rpartition(":")
+        try:
+            connection = socket.create_connection((host, int(port)), self.timeout)
+        except OSError as error:
+            logging.warning("SAXON SERVICE : not available (%s)", error)
+            return False
+
+        request = [f"SOURCE\t{source.resolve()}"]
+        for transform in transforms:
+            stylesheet = self._shared_stylesheet(
+                (transform.stylesheet or associated_stylesheet(source)).resolve()
+            )
+            request.append(
+                "\t".join(
+                    [
+                        "TRANSFORM",
+                        str(stylesheet),
+                        stylesheet_key(stylesheet),
+                        str(transform.output.resolve()) if transform.output else "",
+                        transform.warnings or "",
+                        *(
+                            f"{name}={value}"
+                            for name, value in transform.parameters.items()
+                        ),
+                    ]
+                )
+            )
+        with connection, connection.makefile("rw", encoding="utf-8") as stream:
+            stream.write("\n".join(request) + "\n\n")
+            stream.flush()
+
+            errors = []
+            for line in stream:
+                kind, _, text = line.rstrip("\n").partition("\t")
+                if kind == "OK":
+                    return True
+                if kind == "ERROR":
+                    errors.append(text)
+                elif log_file:
+                    log_file.write(text + "\n")
+
+        raise subprocess.CalledProcessError(
+            cmd=f"saxon {source}",
+            returncode=1,
+            stderr="\n".join(errors) or "Saxon service closed the connection",
+        )
+
+    def _shared_stylesheet(self, stylesheet: Path) -> Path:
+        for folder, shared_folder in self.linked_folders.items():
+            if stylesheet.is_relative_to(folder.resolve()):
+                return shared_folder.resolve() / stylesheet.relative_to(
+                    folder.resolve()
+                )
+        return stylesheet
+
+
+def main(args: list[str]) -> int:
+    warnings = output = None
+    files, parameters = [], {}
+    arguments = iter(args)
+    for arg in arguments:
+        if arg.startswith("-warnings:"):
+            warnings = arg.removeprefix("-warnings:")
+        elif arg == "-o":
+            output = Path(next(arguments))
+        elif "=" in arg:
+            name, _, value = arg.partition("=")
+            parameters[name] = value
+        elif not arg.startswith("-"):
+            files.append(Path(arg))
+
+    source, stylesheet = (files + [None])[:2]
+    try:
+        if SaxonService().transform(
+            source, stylesheet, output, parameters, warnings, log_file=sys.stderr
+        ):
+            return 0
+    except subprocess.CalledProcessError as error:
+        print(error.stderr, file=sys.stderr)
+        return error.returncode
+
+    os.execvp("java", ["java", "-jar", str(SAXON_JAR), *args])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,187 @@
+"""
+Host-wide slots limiting the external tools run by every generation on the
+host: the procrastinate jobs and the generations started by the views.
+
+Slots are lock files of a shared folder, held with `flock` while the tool
+runs, so the kernel releases them when a generation dies. A tool process
+takes one of the slots of its tool, and `weight` slots of the host capacity,
+its share of the CPUs. Batch generations leave some slots of each tool and of
+the host to the generations started from the interface.
+
+Processes take all their slots at once or none. The first waiter, holding the
+queue lock file, keeps the slots it gets until it has all of them: lighter
+processes can't take every released slot of the host before a heavier one.
+"""
+import asyncio
+import contextlib
+import fcntl
+import os
+import random
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from decouple import Csv, config
+
+SLOTS_POLL_INTERVAL = 0.2  # seconds
+# An empty folder disables the slots, only each generation limits itself
+TOOL_SLOTS_FOLDER = config("TOOL_SLOTS_FOLDER", default="/tmp/sppnaut-slots")
+TOOL_SLOTS_CAPACITY = config("TOOL_SLOTS_CAPACITY", default=os.cpu_count(), cast=int)
+# Slots of each tool and of the host that batch generations never take
+TOOL_SLOTS_RESERVED = config("TOOL_SLOTS_RESERVED", default=1, cast=int)
+# Command names of the scheduled tools, the other commands run freely
+TOOLS = {"ps2pdf": "ps2pdf", "gs": "gs", "java": "java", "run.sh": "ahformatter"}
+
+
+@dataclass
+class ToolLimit:
+    slots: int  # processes of the tool at once on the host
+    weight: int = 1  # host capacity taken by each process
+
+
+def tool_limits(overrides: list[str]) -> dict[str, ToolLimit]:
+    """Default limits, overridden by `tool:slots[:weight]` values."""
+    limits = {
+        "ps2pdf": ToolLimit(TOOL_SLOTS_CAPACITY),
+        "gs": ToolLimit(TOOL_SLOTS_CAPACITY),
+        "java": ToolLimit(max(1, TOOL_SLOTS_CAPACITY // 2)),
+        # AHFormatter renders with several threads
+        "ahformatter": ToolLimit(max(1, TOOL_SLOTS_CAPACITY // 2), weight=2),
+    }
+    for override in overrides:
+        tool, slots, *weight = override.split(":")
+        limits[tool] = ToolLimit(int(slots), *map(int, weight))
+    return limits
+
+
+TOOL_LIMITS = tool_limits(config("TOOL_SLOTS", default="", cast=Csv()))
+
+
+def tool_of(args: list[str]) -> str:
+    """Scheduled tool run by a command line, None for the others."""
+    return TOOLS.get(Path(args[0]).name) if args else None
+
+
+@dataclass
+class Slot:
+    tool: str
+    queued: bool = False
+    wait: float = 0.0
+
+
+@dataclass
+class _Claim:
+    """Locks taken so far for a tool process."""
+
+    tool: list[int] = field(default_factory=list)
+    host: list[int] = field(default_factory=list)
+    # Queue lock, held by the first waiter of the host
+    turn: list[int] = field(default_factory=list)
+
+
+@dataclass
+class HostSlots:
+    folder: str = TOOL_SLOTS_FOLDER
+    capacity: int = TOOL_SLOTS_CAPACITY
+    limits: dict[str, ToolLimit] = field(default_factory=lambda: TOOL_LIMITS)
+    # Slots of each tool and of the host left to the other generations
+    reserved: int = 0
+    # Time spent queued for slots, by tool
+    waits: dict[str, float] = field(default_factory=dict)
+
+    def _lock_free(self, name: str, count: int, needed: int) -> list[int]:
+        """Lock up to `needed` of the `count` lock files of `name`."""
+        locked = []
+        for index in random.sample(range(count), count):
+            if len(locked) >= needed:
+                break
+            fd = os.open(
+                Path(self.folder) / f"{name}.{index}.lock", os.O_RDWR | os.O_CREAT
+            )
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            locked.append(fd)
+        return locked
+
+    def _lock_any(self, name: str, count: int, needed: int) -> list[int]:
+        """Lock `needed` of the `count` lock files of `name`, or none."""
+        locked = self._lock_free(name, count, needed)
+        if len(locked) < needed:
+            self._release(locked)
+            return []
+        return locked
+
+    def _usable(self, count: int) -> int:
+        """Lock files out of `count` this generation may take, at least one."""
+        return max(1, count - self.reserved)
+
+    def _try_acquire(self, tool: str, claim: _Claim) -> bool:
+        """Complete `claim` with a slot of `tool` and its weight of the host."""
+        limit = self.limits[tool]
+        tool_slots = self._usable(limit.slots)
+        capacity = self._usable(self.capacity)
+        weight = min(limit.weight, capacity)
+        if not claim.turn:
+            claim.tool = self._lock_any(tool, tool_slots, 1)
+            if claim.tool:
+                claim.host = self._lock_any("host", capacity, weight)
+                if claim.host:
+                    return True
+                self._release(claim.tool)
+                claim.tool = []
+            claim.turn = self._lock_any("queue", 1, 1)
+            if not claim.turn:
+                return False
+        # First waiter: the locks it gets are kept across attempts
+        claim.tool += self._lock_free(tool, tool_slots, 1 - len(claim.tool))
+        claim.host += self._lock_free("host", capacity, weight - len(claim.host))
+        return len(claim.tool) == 1 and len(claim.host) == weight
+
+    @staticmethod
+    def _release(locks: list[int]) -> None:
+        for fd in locks:
+            os.close(fd)
+
+    def _acquired(self, slot: Slot, start: float, claim: _Claim) -> None:
+        slot.wait = time.perf_counter() - start
+        if slot.queued:
+            self.waits[slot.tool] = self.waits.get(slot.tool, 0.0) + slot.wait
+        # The next waiter takes the turn
+        self._release(claim.turn)
+        claim.turn = []
+
+    @contextlib.contextmanager
+    def acquire(self, tool: str):
+        """Hold a slot of `tool` for the `with` block, waiting for one if needed."""
+        if not self.folder or tool not in self.limits:
+            yield Slot(tool)
+            return
+        start, slot, claim = time.perf_counter(), Slot(tool), _Claim()
+        Path(self.folder).mkdir(parents=True, exist_ok=True)
+        try:
+            while not self._try_acquire(tool, claim):
+                slot.queued = True
+                time.sleep(SLOTS_POLL_INTERVAL)
+            self._acquired(slot, start, claim)
+            yield slot
+        finally:
+            self._release(claim.tool + claim.host + claim.turn)
+
+    @contextlib.asynccontextmanager
+    async def acquire_async(self, tool: str):
+        if not self.folder or tool not in self.limits:
+            yield Slot(tool)
+            return
+        start, slot, claim = time.perf_counter(), Slot(tool), _Claim()
+        Path(self.folder).mkdir(parents=True, exist_ok=True)
+        try:
+            while not self._try_acquire(tool, claim):
+                slot.queued = True
+                await asyncio.sleep(SLOTS_POLL_INTERVAL)
+            self._acquired(slot, start, claim)
+            yield slot
+        finally:
+            self._release(claim.tool + claim.host + claim.turn)
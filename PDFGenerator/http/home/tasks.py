@@ -1,18 +1,51 @@
-import datetime
+import asyncio
 import uuid
+from dataclasses import fields
 from pathlib import Path
 
-from bin.generator import generate
-from decouple import config
-from home.s3 import get_generated_pdf_ouvrages, get_source_xml_ouvrages
+from asgiref.sync import sync_to_async
+from bin.generator import Generator, generate
+from decouple import Csv, config
+from django.core.exceptions import ImproperlyConfigured
+from home.models import OuvrageVersion
+from home.s3 import get_ouvrage_fingerprints, refresh_assets
 from workers import procrastinate_app
 
 S3_BUCKET_REFERENTIEL_PRODUCTION = config("S3_BUCKET_REFERENTIEL_PRODUCTION")
 S3_BUCKET_GENERATED_PRODUCTION = config("S3_BUCKET_GENERATED_PRODUCTION")
 S3_ENDPOINT = config("S3_ENDPOINT")
+# Queues of the generations, each with workers of its own: the nightly batch
+# can't delay the generations started from the interface
+INTERACTIVE_QUEUE = "interactive"
+BATCH_QUEUE = "batch"
+# Options of the generator set by the tasks themselves
+TASK_OPTIONS = {"compress", "vignette", "metadata", "cleanup", "batch"}
 
 
-@procrastinate_app.task(name="generate_publication_from_referentiel")
+def _generation_optimizations(options: list[str]) -> dict[str, bool]:
+    """Options of the generator turned on for every job, see the README."""
+    valid_options = sorted(
+        generator_field.name
+        for generator_field in fields(Generator)
+        if generator_field.init
+        and generator_field.type is bool
+        and generator_field.name not in TASK_OPTIONS
+    )
+    unknown_options = sorted(set(options) - set(valid_options))
+    if unknown_options:
+        raise ImproperlyConfigured(
+            f"Unknown GENERATION_OPTIMIZATIONS {', '.join(unknown_options)}, "
+            f"valid options are {', '.join(valid_options)}"
+        )
+    return {option: True for option in options}
+
+
+GENERATION_OPTIMIZATIONS = _generation_optimizations(
+    config("GENERATION_OPTIMIZATIONS", default="single_parse", cast=Csv())
+)
+
+
+@procrastinate_app.task(name="generate_publication_from_referentiel", queue=BATCH_QUEUE)
 async def generate_publication_from_referentiel(
     *,
     ouvrage: str,
@@ -35,22 +68,29 @@ async def generate_publication_from_referentiel(
         vignette=True,
         metadata=True,
         cleanup=True,
+        batch=True,
+        **GENERATION_OPTIMIZATIONS,
     )
 
 
+@procrastinate_app.task(name="generate_publication", queue=INTERACTIVE_QUEUE)
+async def generate_publication(*, publication_path: str, **options):
+    """Generation started from the interface, its job status is polled."""
+    await generate(Path(publication_path), **{**GENERATION_OPTIMIZATIONS, **options})
+
+
 @procrastinate_app.periodic(cron="5 0 * * *")
 @procrastinate_app.task
 async def generate_all_updated_ouvrage_from_production(timestamp):
-    source_xml_ouvrages = get_source_xml_ouvrages()
-    generated_pdf_ouvrages = get_generated_pdf_ouvrages()
-    ouvrages_to_generate = []
-    for source_xml_ouvrage, source_xml_ouvrage_date in source_xml_ouvrages.items():
-        last_generated_pdf_date = generated_pdf_ouvrages.get(
-            source_xml_ouvrage,
-            datetime.datetime.fromtimestamp(0, datetime.timezone.utc),
-        )
-        if last_generated_pdf_date < source_xml_ouvrage_date:
-            ouvrages_to_generate.append(source_xml_ouvrage)
+    # Regenerated exactly when the fingerprint of their inputs changed
+    ouvrage_versions = await asyncio.to_thread(get_ouvrage_fingerprints)
+    await sync_to_async(OuvrageVersion.objects.refresh)(ouvrage_versions)
+    ouvrages_to_generate = [
+        ouvrage
+        async for ouvrage in OuvrageVersion.objects.outdated()
+        .order_by("ouvrage")
+        .values_list("ouvrage", flat=True)
+    ]
 
     for source_xml_ouvrage in ouvrages_to_generate:
         await generate_publication_from_referentiel.defer_async(
@@ -62,3 +102,10 @@ async def generate_all_updated_ouvrage_from_production(timestamp):
         )
 
     return ouvrages_to_generate
+
+
+@procrastinate_app.periodic(cron="*/5 * * * *")
+@procrastinate_app.task
+async def refresh_assets_from_production(timestamp):
+    # The generations read the version switched here, without syncing
+    await asyncio.to_thread(refresh_assets)
@@ -8,11 +8,18 @@ from itertools import takewhile
 from pathlib import Path
 
 import sentry_sdk
-from bin.generator import ARCHIVE_FILENAME, LOG_FILENAME
+from bin.generator import BUNDLE_FILENAME, LOG_FILENAME
 from django.conf import settings
-from django.http import FileResponse, HttpResponse, JsonResponse
+from django.http import (
+    FileResponse,
+    HttpResponse,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from django.views.decorators.http import require_GET, require_POST
 from django.views.generic import FormView
+from procrastinate.jobs import Status
+from workers import procrastinate_app
 
 from .forms import UploadDirectoryFileForm, UploadFileForm
 from .s3 import (
@@ -21,8 +28,8 @@ from .s3 import (
     list_generated_documents_by_ouvrages,
     list_ouvrages_en_preparation,
 )
-
-RETURN_CODE_FILENAME = "returncode"
+from .tasks import generate_publication
+from .zip_stream import stream_zip
 
 
 class Tableau(FormView):
@@ -30,7 +37,7 @@ class Tableau(FormView):
     template_name = "index.html"
 
     def form_valid(self, form):
-        bootstrap_assets()
+        shom_assets = bootstrap_assets()
         timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
         name = Path(form.cleaned_data["file"].name).stem
         basename = f"{name}_{timestamp}"
@@ -39,11 +46,7 @@ class Tableau(FormView):
                 "../bin/generate_tableau.sh",
                 form.cleaned_data["file"].temporary_file_path(),
                 settings.HOME_GENERATION_PATH / "tableaux" / basename,
-                settings.HOME_GENERATION_PATH
-                / "source"
-                / "xsl"
-                / "fo"
-                / "tableauTaP.xsl",
+                shom_assets / "source" / "xsl" / "fo" / "tableauTaP.xsl",
             ],
             check=True,
         )
@@ -94,21 +97,33 @@ def generate_publication_from_upload(request, generation_id):
         sentry_sdk.capture_exception(err)
         return HttpResponse(status=HTTPStatus.BAD_REQUEST)
 
-    subprocess.Popen(
-        [
-            settings.BIN_DIR / "echo_returncode_in.py",
-            publication_path / RETURN_CODE_FILENAME,
-            settings.BASE_DIR / "bin" / "generator.py",
-            publication_path,
-            "--s3_endpoint",
-            settings.S3_ENDPOINT,
-            "--s3_inputs_bucket",
-            f"s3://{settings.S3_BUCKET_REFERENTIEL_PRODUCTION}",
-        ]
+    # A generation can be started again after uploading corrected files, only
+    # the steps impacted by the changes are run again
+    _defer_generation(
+        generation_id,
+        publication_path,
+        s3_endpoint=settings.S3_ENDPOINT,
+        s3_inputs_bucket=f"s3://{settings.S3_BUCKET_REFERENTIEL_PRODUCTION}",
+        incremental=True,
     )
     return HttpResponse(status=HTTPStatus.ACCEPTED)
 
 
+def _defer_generation(generation_id, publication_path, **options) -> None:
+    # The lock runs the generations of a folder one after the other
+    generate_publication.configure(lock=str(generation_id)).defer(
+        publication_path=str(publication_path), **options
+    )
+
+
+def _generation_status(generation_id):
+    """Status of the last generation job of the folder, None before the first."""
+    jobs = procrastinate_app.job_manager.list_jobs(
+        task="generate_publication", lock=str(generation_id)
+    )
+    return Status(max(jobs, key=lambda job: job.id).status) if jobs else None
+
+
 @require_GET
 def publication(request, generation_id):
     try:
@@ -116,8 +131,8 @@ def publication(request, generation_id):
     except FileNotFoundError:
         return HttpResponse(status=HTTPStatus.CONFLICT)
 
-    return_code_path = publication_path / RETURN_CODE_FILENAME
-    if not return_code_path.exists():
+    status = _generation_status(generation_id)
+    if status not in {Status.SUCCEEDED, Status.FAILED}:
         try:
             displayable_step = (
                 (publication_path / "displayable_step").read_text().splitlines()[-1]
@@ -130,9 +145,10 @@ def publication(request, generation_id):
             status=HTTPStatus.NOT_FOUND,
         )
 
-    return_code = return_code_path.read_text()
-    if int(return_code) != 0:
-        stderr = (publication_path / LOG_FILENAME).read_text().splitlines()
+    if status == Status.FAILED:
+        log_file = publication_path / LOG_FILENAME
+        # The job can fail before the generator opens its log
+        stderr = log_file.read_text().splitlines() if log_file.exists() else []
 
         for line in stderr:
             logging.warning(line)
@@ -146,15 +162,21 @@ def publication(request, generation_id):
         ]
 
         return HttpResponse(
-            "\n".join(non_python_stderr),
+            "\n".join(non_python_stderr) or "La génération a échoué.",
             content_type="text/plain; charset=utf-8",
             status=HTTPStatus.INTERNAL_SERVER_ERROR,
         )
 
-    if (publication_path / ARCHIVE_FILENAME).exists():
-        return FileResponse(
-            (publication_path / ARCHIVE_FILENAME).open("rb"),
-            filename=f"{publication_path.name}.zip",
+    if (publication_path / BUNDLE_FILENAME).exists():
+        pdfs = (publication_path / BUNDLE_FILENAME).read_text().splitlines()
+        return StreamingHttpResponse(
+            stream_zip([publication_path / pdf for pdf in pdfs]),
+            content_type="application/zip",
+            headers={
+                "Content-Disposition": (
+                    f'attachment; filename="{publication_path.name}.zip"'
+                )
+            },
         )
     return FileResponse(
         (publication_path / "document.pdf").open("rb"),
@@ -200,25 +222,19 @@ def list_from_production(request):
     return JsonResponse(ouvrages, safe=False)
 
 
-def _generate_publication_from_referentiel(request, args_callable):
+def _generate_publication_from_referentiel(request, options_callable):
     generation_id = uuid.uuid4()
     ouvrage = request.POST["ouvrage"]
 
     publication_path = settings.HOME_GENERATION_PATH / str(generation_id) / ouvrage
     publication_path.mkdir(parents=True)
 
-    subprocess.Popen(
-        [
-            settings.BIN_DIR / "echo_returncode_in.py",
-            publication_path / RETURN_CODE_FILENAME,
-            settings.BASE_DIR / "bin" / "generator.py",
-            publication_path,
-            "--s3_endpoint",
-            settings.S3_ENDPOINT,
-            "--s3_inputs_bucket",
-            f"s3://{settings.S3_BUCKET_REFERENTIEL_PRODUCTION}",
-            *args_callable(ouvrage),
-        ]
+    _defer_generation(
+        generation_id,
+        publication_path,
+        s3_endpoint=settings.S3_ENDPOINT,
+        s3_inputs_bucket=f"s3://{settings.S3_BUCKET_REFERENTIEL_PRODUCTION}",
+        **options_callable(ouvrage),
     )
 
     return JsonResponse({"generation_id": generation_id}, status=HTTPStatus.ACCEPTED)
@@ -226,29 +242,26 @@ def _generate_publication_from_referentiel(request, args_callable):
 
 @require_POST
 def generate_from_preparation(request) -> JsonResponse:
-    def specific_args_generator_sh(ouvrage):
-        return [
-            "--s3_source_path",
-            f"s3://{settings.S3_BUCKET_REFERENTIEL_PREPARATION}/{ouvrage}",
-        ]
+    def generator_options(ouvrage):
+        return {
+            "s3_source_path": f"s3://{settings.S3_BUCKET_REFERENTIEL_PREPARATION}/{ouvrage}",
+        }
 
-    return _generate_publication_from_referentiel(request, specific_args_generator_sh)
+    return _generate_publication_from_referentiel(request, generator_options)
 
 
 @require_POST
 def generate_from_production(request) -> JsonResponse:
-    def generator_sh_args(ouvrage):
-        return [
-            "--s3_source_path",
-            f"s3://{settings.S3_BUCKET_REFERENTIEL_PRODUCTION}/{ouvrage}",
-            "--s3_destination_path",
-            f"s3://{settings.S3_BUCKET_GENERATED_PRODUCTION}/{ouvrage}",
-            "--compress",
-            "--vignette",
-            "--metadata",
-        ]
-
-    return _generate_publication_from_referentiel(request, generator_sh_args)
+    def generator_options(ouvrage):
+        return {
+            "s3_source_path": f"s3://{settings.S3_BUCKET_REFERENTIEL_PRODUCTION}/{ouvrage}",
+            "s3_destination_path": f"s3://{settings.S3_BUCKET_GENERATED_PRODUCTION}/{ouvrage}",
+            "compress": True,
+            "vignette": True,
+            "metadata": True,
+        }
+
+    return _generate_publication_from_referentiel(request, generator_options)
 
 
 @require_GET
@@ -0,0 +1,46 @@
+import fcntl
+import os
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+
+# ioctl request cloning a whole file on copy-on-write filesystems (btrfs, XFS…)
+FICLONE = 0x40049409
+
+
+def reflink(source: Path, destination: Path) -> None:
+    with open(source, "rb") as source_file, open(destination, "xb") as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            os.unlink(destination)
+            raise
+    shutil.copystat(source, destination)
+
+
+@dataclass
+class WorkspaceLinker:
+    """
+    Populate generation folders from the shared assets without copying them.
+
+    Files are reflinked when the filesystem supports it, and copied otherwise.
+    Either way the destination is a file of its own, which the generation can
+    modify in place without touching the assets.
+    """
+
+    linked_bytes: int = 0
+    copied_bytes: int = 0
+
+    def link_file(self, source: str, destination: str) -> str:
+        size = os.stat(source).st_size
+        try:
+            reflink(source, destination)
+        except OSError:
+            shutil.copy2(source, destination)
+            self.copied_bytes += size
+        else:
+            self.linked_bytes += size
+        return destination
+
+    def link_tree(self, source: Path, destination: Path) -> None:
+        shutil.copytree(source, destination, copy_function=self.link_file)
@@ -0,0 +1,46 @@
+"""
+ZIP archive built while it is sent, for the generations producing several
+PDFs.
+
+PDFs are already compressed: they are stored as they are, and read once from
+the ouvrage folder instead of being deflated into an archive written on disk
+first.
+"""
+import io
+from pathlib import Path
+from typing import Iterator
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class _Chunks(io.RawIOBase):
+    """Unseekable output of the archive, emptied after each write."""
+
+    def __init__(self) -> None:
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self) -> bytes:
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+def stream_zip(files: list[Path], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Chunks of a ZIP archive of `files`, stored under their names."""
+    output = _Chunks()
+    with ZipFile(output, mode="w", compression=ZIP_STORED) as archive:
+        for file in files:
+            info = ZipInfo.from_file(file, arcname=file.name)
+            with file.open("rb") as source, archive.open(info, mode="w") as entry:
+                while data := source.read(chunk_size):
+                    entry.write(data)
+                    yield output.pop()
+            yield output.pop()
+    yield output.pop()
@@ -7,11 +7,67 @@ import requests
 
 INTEGRATION_TESTS_ROOT = Path(__file__).parent
 DOTENV_FILE = INTEGRATION_TESTS_ROOT.parent / ".env"
-DOTENV_TEST_FILE = INTEGRATION_TESTS_ROOT.parent / ".env.test"
+# The server, the workers and the database share a network, the database is
+# reached as `postgres` like in POSTGRESQL_ADDON_URI of .env.template
+DOCKER_NETWORK = "sppnaut-integration"
+POSTGRES_CONTAINER = "sppnaut-integration-postgres"
+SERVER_CONTAINER = "sppnaut-integration-server"
 
 
 @pytest.fixture(scope="session")
-def ds_server():
+def postgres():
+    # Jobs deferred by the server must reach the worker processes: unlike the
+    # unit tests (TEST=True), they share a real database
+    subprocess.run(["docker", "network", "create", DOCKER_NETWORK], check=True)
+    subprocess.run(
+        [
+            "docker",
+            "run",
+            "--detach",
+            "--rm",
+            "--name",
+            POSTGRES_CONTAINER,
+            "--network",
+            DOCKER_NETWORK,
+            "--network-alias",
+            "postgres",
+            "--env",
+            "POSTGRES_USER=sppnaut",
+            "--env",
+            "POSTGRES_PASSWORD=sppnaut",
+            "--env",
+            "POSTGRES_DB=sppnaut",
+            "postgres:14-alpine",
+        ],
+        check=True,
+    )
+
+    max_retries = 30
+    for attempt in range(1, max_retries + 1):
+        ready = subprocess.run(
+            [
+                "docker",
+                "exec",
+                POSTGRES_CONTAINER,
+                "pg_isready",
+                "--username",
+                "sppnaut",
+                "--host",
+                "127.0.0.1",
+            ],
+        )
+        if ready.returncode == 0:
+            break
+        print(f"{attempt} of {max_retries}: database not ready.")
+        time.sleep(1)
+
+    yield
+    subprocess.run(["docker", "stop", POSTGRES_CONTAINER])
+    subprocess.run(["docker", "network", "rm", DOCKER_NETWORK])
+
+
+@pytest.fixture(scope="session")
+def ds_server(postgres):
     assert DOTENV_FILE.exists()
     ds_proc = subprocess.Popen(
         [
@@ -19,8 +75,10 @@ def ds_server():
             "run",
             "--env-file",
             DOTENV_FILE,
-            "--env-file",
-            DOTENV_TEST_FILE,
+            "--name",
+            SERVER_CONTAINER,
+            "--network",
+            DOCKER_NETWORK,
             "--rm",
             "--publish",
             "8081:8080",
@@ -34,7 +92,8 @@ def ds_server():
     # Check it started successfully
     assert not ds_proc.poll(), ds_proc.stdout.read().decode("utf-8")
 
-    max_retries = 5
+    # The schemas of procrastinate and Django are applied before the server starts
+    max_retries = 30
     # Wait for the HTTP server to be available
     for attempt in range(1, max_retries + 1):
         try:
@@ -51,5 +110,7 @@ def ds_server():
     yield ds_proc
     # Shut it down at the end of the pytest session
     ds_proc.terminate()
+    # The container outlives the docker client, it would hold the network
+    subprocess.run(["docker", "stop", SERVER_CONTAINER])
     # Log Docker stdout to help debug failing tests
     print(ds_proc.stdout.read().decode("utf-8"))
@@ -10,6 +10,7 @@ INTEGRATION_TESTS_ROOT = Path(__file__).parent
 
 DOTENV_FILE = INTEGRATION_TESTS_ROOT.parent / ".env.template"
 env_config = Config(RepositoryEnv(DOTENV_FILE))
+GENERATION_TIMEOUT = 10 * 60  # seconds
 
 
 def test_health_check_unauthorized(ds_server):
@@ -75,7 +76,9 @@ def test_generate_minimal_ouvrage_via_upload(ds_server):
     )
     assert generate_response.status_code == 202
 
-    while True:
+    # The generation job runs in a worker of the container
+    deadline = time.monotonic() + GENERATION_TIMEOUT
+    while time.monotonic() < deadline:
         ouvrage_response = requests.get(
             f"http://localhost:8081/publication/{fake_generation_id}/",
             auth=(username, password),
@@ -3,9 +3,22 @@
 # Generate schema if not exist (else failed but it is ignored)
 PYTHONPATH=. procrastinate --app=workers.procrastinate_app schema --apply
 
-# Start worker(s)
+# Apply the migrations of the Django models
+python manage.py migrate --no-input
+
+# Start the Saxon transformation service (generations fall back to the command line without it)
+echo "Launching Saxon service..."
+# As many threads as java slots, sharing a bounded heap
+TOOL_SLOTS_CAPACITY="${TOOL_SLOTS_CAPACITY:-$(nproc)}"
+SAXON_SERVICE_THREADS="${SAXON_SERVICE_THREADS:-$(( TOOL_SLOTS_CAPACITY > 1 ? TOOL_SLOTS_CAPACITY / 2 : 1 ))}"
+java ${SAXON_SERVICE_JAVA_OPTIONS:--XX:MaxRAMPercentage=50} -cp ../vendors/saxon/saxon9.jar:../vendors/saxon/service SaxonService "${SAXON_SERVICE_ADDRESS:-127.0.0.1:8390}" "$SAXON_SERVICE_THREADS" &
+echo "Saxon service launched"
+
+# Start worker(s): the interactive generations have workers of their own, the
+# nightly batch and the periodic tasks can't delay them
 echo "Launching workers..."
-PYTHONPATH=. procrastinate --app=workers.procrastinate_app worker &
+PYTHONPATH=. procrastinate --app=workers.procrastinate_app worker --queues interactive --concurrency "${INTERACTIVE_CONCURRENCY:-2}" &
+PYTHONPATH=. procrastinate --app=workers.procrastinate_app worker --queues batch,default --concurrency "${BATCH_CONCURRENCY:-2}" &
 echo "Workers launched"
 
 # Start server
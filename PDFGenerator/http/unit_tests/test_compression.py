@@ -0,0 +1,133 @@
+import pytest
+from home.compression import PageGeometryError, page_count, page_ranges, reassemble
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import (
+    AnnotationBuilder,
+    DecodedStreamObject,
+    NameObject,
+    RectangleObject,
+)
+
+
+def _set_content(writer: PdfWriter, page, text: str) -> None:
+    content = DecodedStreamObject()
+    content.set_data(text.encode())
+    page[NameObject("/Contents")] = writer._add_object(content)
+
+
+def write_ouvrage(pdf, page_count: int) -> None:
+    writer = PdfWriter()
+    for index in range(page_count):
+        _set_content(writer, writer.add_blank_page(200, 200), f"original {index}")
+    writer.add_outline_item("Chapitre 2", 2)
+    writer.add_annotation(
+        0, AnnotationBuilder.link(rect=(0, 0, 50, 50), target_page_index=3)
+    )
+    writer.add_metadata({"/Title": "Ouvrage"})
+    writer.set_page_label(0, 1, style="/r")
+    writer.write(pdf)
+
+
+def write_compressed_range(
+    original,
+    part,
+    first_page: int,
+    last_page: int,
+    rotation: int = 0,
+    mediabox: tuple[int, int, int, int] | None = None,
+) -> None:
+    """What Ghostscript writes for -dFirstPage/-dLastPage, without the outline."""
+    reader, writer = PdfReader(original), PdfWriter()
+    for index in range(first_page - 1, last_page):
+        page = writer.add_page(reader.pages[index])
+        _set_content(writer, page, f"compressed {index}")
+        page.rotate(rotation)
+        if mediabox:
+            page.mediabox = RectangleObject(mediabox)
+    writer.write(part)
+
+
+class TestPageRanges:
+    def test_split(self):
+        assert page_ranges(250, 4) == [(1, 63), (64, 126), (127, 188), (189, 250)]
+
+    def test_minimum_range_size(self):
+        assert page_ranges(120, 8) == [(1, 60), (61, 120)]
+        assert page_ranges(10, 8) == [(1, 10)]
+
+
+class TestReassemble:
+    def test_keeps_navigation_and_metadata(self, tmp_path):
+        write_ouvrage(tmp_path / "document.pdf", 4)
+        write_compressed_range(tmp_path / "document.pdf", tmp_path / "1.pdf", 1, 2)
+        write_compressed_range(tmp_path / "document.pdf", tmp_path / "2.pdf", 3, 4)
+
+        reassemble(
+            tmp_path / "document.pdf",
+            [tmp_path / "1.pdf", tmp_path / "2.pdf"],
+            tmp_path / "document_optimized.pdf",
+        )
+
+        reader = PdfReader(tmp_path / "document_optimized.pdf")
+        assert page_count(tmp_path / "document_optimized.pdf") == 4
+        assert [page["/Contents"].get_object().get_data() for page in reader.pages] == [
+            f"compressed {index}".encode() for index in range(4)
+        ]
+        [chapter] = reader.outline
+        assert chapter.title == "Chapitre 2"
+        assert reader.get_destination_page_number(chapter) == 2
+        [link] = reader.pages[0]["/Annots"]
+        [original_link] = PdfReader(tmp_path / "document.pdf").pages[0]["/Annots"]
+        assert link.get_object()["/Dest"] == original_link.get_object()["/Dest"]
+        assert reader.page_labels == ["i", "ii", "1", "2"]
+        assert reader.metadata.title == "Ouvrage"
+        assert b"original" not in (tmp_path / "document_optimized.pdf").read_bytes()
+
+    def test_missing_pages(self, tmp_path):
+        write_ouvrage(tmp_path / "document.pdf", 4)
+        write_compressed_range(tmp_path / "document.pdf", tmp_path / "1.pdf", 1, 2)
+
+        with pytest.raises(ValueError):
+            reassemble(
+                tmp_path / "document.pdf",
+                [tmp_path / "1.pdf"],
+                tmp_path / "document_optimized.pdf",
+            )
+
+    def test_rotated_pages(self, tmp_path):
+        write_ouvrage(tmp_path / "document.pdf", 4)
+        write_compressed_range(tmp_path / "document.pdf", tmp_path / "1.pdf", 1, 2)
+        # -dAutoRotatePages
+        write_compressed_range(
+            tmp_path / "document.pdf", tmp_path / "2.pdf", 3, 4, rotation=90
+        )
+
+        reassemble(
+            tmp_path / "document.pdf",
+            [tmp_path / "1.pdf", tmp_path / "2.pdf"],
+            tmp_path / "document_optimized.pdf",
+        )
+
+        reader = PdfReader(tmp_path / "document_optimized.pdf")
+        assert [page.rotation for page in reader.pages] == [0, 0, 90, 90]
+        assert [page.mediabox for page in reader.pages] == [
+            RectangleObject((0, 0, 200, 200))
+        ] * 4
+
+    def test_other_media_box(self, tmp_path):
+        write_ouvrage(tmp_path / "document.pdf", 4)
+        write_compressed_range(tmp_path / "document.pdf", tmp_path / "1.pdf", 1, 2)
+        write_compressed_range(
+            tmp_path / "document.pdf",
+            tmp_path / "2.pdf",
+            3,
+            4,
+            mediabox=(-10, -10, 190, 190),
+        )
+
+        with pytest.raises(PageGeometryError):
+            reassemble(
+                tmp_path / "document.pdf",
+                [tmp_path / "1.pdf", tmp_path / "2.pdf"],
+                tmp_path / "document_optimized.pdf",
+            )
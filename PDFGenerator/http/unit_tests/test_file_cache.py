@@ -0,0 +1,74 @@
+import os
+
+from home.file_cache import FileCache, file_digest
+
+
+class TestFileDigest:
+    def test_depends_on_content_and_salts(self, tmp_path):
+        (tmp_path / "a.eps").write_text("a")
+        (tmp_path / "b.eps").write_text("a")
+        (tmp_path / "c.eps").write_text("c")
+
+        assert file_digest(tmp_path / "a.eps") == file_digest(tmp_path / "b.eps")
+        assert file_digest(tmp_path / "a.eps") != file_digest(tmp_path / "c.eps")
+        assert file_digest(tmp_path / "a.eps") != file_digest(
+            tmp_path / "a.eps", "-dEPSCrop"
+        )
+
+
+class TestFileCache:
+    def test_miss_then_hit(self, tmp_path):
+        cache = FileCache(tmp_path / "cache", max_size=1000)
+        (tmp_path / "converted.pdf").write_text("pdf")
+
+        assert not cache.fetch("abcd", tmp_path / "first.pdf")
+        cache.store("abcd", tmp_path / "converted.pdf")
+        assert cache.fetch("abcd", tmp_path / "second.pdf")
+
+        assert (tmp_path / "second.pdf").read_text() == "pdf"
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_fetch_keeps_modification_time(self, tmp_path):
+        cache = FileCache(tmp_path / "cache", max_size=1000)
+        (tmp_path / "converted.pdf").write_text("pdf")
+        os.utime(tmp_path / "converted.pdf", (0, 0))
+        cache.store("abcd", tmp_path / "converted.pdf")
+
+        assert cache.fetch("abcd", tmp_path / "linked.pdf")
+        assert (tmp_path / "linked.pdf").stat().st_mtime == 0
+
+    def test_fetch_replaces_destination(self, tmp_path):
+        cache = FileCache(tmp_path / "cache", max_size=1000)
+        (tmp_path / "converted.pdf").write_text("pdf")
+        cache.store("abcd", tmp_path / "converted.pdf")
+        (tmp_path / "stale.pdf").write_text("stale")
+
+        assert cache.fetch("abcd", tmp_path / "stale.pdf")
+        assert (tmp_path / "stale.pdf").read_text() == "pdf"
+
+    def test_write_in_place(self, tmp_path):
+        cache = FileCache(tmp_path / "cache", max_size=1000)
+        (tmp_path / "converted.pdf").write_text("pdf")
+        cache.store("abcd", tmp_path / "converted.pdf")
+        cache.fetch("abcd", tmp_path / "fetched.pdf")
+
+        # Truncated and written by a later step of the generation
+        (tmp_path / "converted.pdf").write_text("changed")
+        (tmp_path / "fetched.pdf").write_text("changed")
+
+        assert cache.fetch("abcd", tmp_path / "second.pdf")
+        assert (tmp_path / "second.pdf").read_text() == "pdf"
+
+    def test_evict_least_recently_used(self, tmp_path):
+        cache = FileCache(tmp_path / "cache", max_size=10)
+        for index, key in enumerate(["aaaa", "bbbb", "cccc"]):
+            (tmp_path / key).write_text("12345")
+            cache.store(key, tmp_path / key)
+            os.utime(cache._entry(key), (index, 0))
+
+        cache.fetch("aaaa", tmp_path / "used.pdf")
+        cache.evict()
+
+        assert cache._entry("aaaa").exists()
+        assert not cache._entry("bbbb").exists()
+        assert cache._entry("cccc").exists()
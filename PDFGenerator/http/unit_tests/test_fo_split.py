@@ -0,0 +1,127 @@
+from xml.etree import ElementTree
+
+import pytest
+from home.fo_split import (
+    CROSS_PART_LINK,
+    FO,
+    Destination,
+    PartLayout,
+    SplitDocument,
+    format_page_number,
+)
+
+DOCUMENT = """<?xml version="1.0" encoding="utf-8"?>
+<fo:root xmlns:fo="http://www.w3.org/1999/XSL/Format"
+         xmlns:axf="http://www.antennahouse.com/names/XSL/Extensions">
+  <fo:layout-master-set>
+    <fo:simple-page-master master-name="page"><fo:region-body/></fo:simple-page-master>
+  </fo:layout-master-set>
+  <fo:bookmark-tree>
+    <fo:bookmark internal-destination="chapitre-2">
+      <fo:bookmark-title>Chapitre 2</fo:bookmark-title>
+    </fo:bookmark>
+  </fo:bookmark-tree>
+  <fo:page-sequence master-reference="page" initial-page-number="1" format="i">
+    <fo:flow flow-name="xsl-region-body">
+      <fo:block>Chapitre 2, page <fo:page-number-citation ref-id="chapitre-2"/></fo:block>
+      <fo:block><fo:basic-link internal-destination="chapitre-2">lien</fo:basic-link></fo:block>
+    </fo:flow>
+  </fo:page-sequence>
+  <fo:page-sequence master-reference="page" initial-page-number="1">
+    <fo:flow flow-name="xsl-region-body"><fo:block>Chapitre 1</fo:block></fo:flow>
+  </fo:page-sequence>
+  <fo:page-sequence id="chapitre-2" master-reference="page"
+                    initial-page-number="auto-odd" axf:suppress-if-first-on-page="true">
+    <fo:flow flow-name="xsl-region-body">
+      <fo:block>Chapitre 2, jusqu'à <fo:page-number-citation-last ref-id="chapitre-2"/></fo:block>
+    </fo:flow>
+  </fo:page-sequence>
+</fo:root>
+"""
+
+
+def parse(part: bytes) -> ElementTree.Element:
+    return ElementTree.fromstring(part)
+
+
+class TestFormatPageNumber:
+    @pytest.mark.parametrize(
+        "number,format,expected",
+        [
+            (12, "1", "12"),
+            (7, "01", "07"),
+            (14, "i", "xiv"),
+            (1994, "I", "MCMXCIV"),
+            (28, "a", "ab"),
+            (3, "A", "C"),
+        ],
+    )
+    def test_formats(self, number, format, expected):
+        assert format_page_number(number, format) == expected
+
+
+class TestSplitDocument:
+    @pytest.fixture
+    def document(self, tmp_path):
+        (tmp_path / "document.fo").write_text(DOCUMENT)
+        return SplitDocument(tmp_path / "document.fo", 2)
+
+    def test_split(self, tmp_path, document):
+        assert document.splittable
+        assert [len(part.sequences) for part in document.parts] == [2, 1]
+
+        assert not SplitDocument(tmp_path / "document.fo", 1).splittable
+
+    def test_first_rendering(self, document):
+        first_part = parse(document.part(0, [None, None]))
+
+        assert first_part.find(f"{FO}layout-master-set") is not None
+        citation = first_part.find(f".//{FO}flow/{FO}block/{FO}inline")
+        assert citation.text == "00"
+        assert "ref-id" not in citation.attrib
+        link = first_part.find(f".//{FO}flow/{FO}block/{FO}basic-link")
+        assert link.get("external-destination") == (
+            f"url('{CROSS_PART_LINK}chapitre-2')"
+        )
+        # Ends on an even page, as before the auto-odd chapter
+        sequences = first_part.findall(f"{FO}page-sequence")
+        assert sequences[-1].get("force-page-count") == "end-on-even"
+        assert [
+            bookmark.get("internal-destination")
+            for bookmark in first_part.iter(f"{FO}bookmark")
+        ] == [sequence.get("id") for sequence in sequences]
+
+        second_part = parse(document.part(1, [None, None]))
+        [sequence] = second_part.findall(f"{FO}page-sequence")
+        assert sequence.get("initial-page-number") == "auto-odd"
+        assert sequence.get(
+            "{http://www.antennahouse.com/names/XSL/Extensions}"
+            "suppress-if-first-on-page"
+        )
+        assert {
+            bookmark.get("internal-destination")
+            for bookmark in second_part.iter(f"{FO}bookmark")
+        } == {"chapitre-2"}
+
+    def test_numbered_from_layouts(self, document):
+        first_sequences = [sequence.id for sequence in document.parts[0].sequences]
+        layouts = [
+            PartLayout(
+                6,
+                {
+                    first_sequences[0]: Destination(0),
+                    first_sequences[1]: Destination(2),
+                },
+            ),
+            PartLayout(3, {"chapitre-2": Destination(0, 56.7, 785.2)}),
+        ]
+
+        second_part = parse(document.part(1, layouts))
+        [sequence] = second_part.findall(f"{FO}page-sequence")
+        # Chapitre 1 numbered 1 to 4, the chapter 2 starts on the next odd page
+        assert sequence.get("initial-page-number") == "5"
+
+        first_part = parse(document.part(0, layouts))
+        assert first_part.find(f".//{FO}flow/{FO}block/{FO}inline").text == "5"
+        # Citations inside a part are left to AHFormatter
+        assert second_part.find(f".//{FO}page-number-citation-last") is not None
@@ -1,10 +1,157 @@
-import zipfile
+import asyncio
+import json
+import logging
+import re
+import time
 from pathlib import Path
 from subprocess import CalledProcessError
-from unittest.mock import patch
+from unittest.mock import AsyncMock, Mock, patch
+from xml.etree import ElementTree
 
+import boto3
 import pytest
-from bin.generator import ROOT_PATH, generate
+from bin.generator import (
+    ROOT_PATH,
+    Generator,
+    Progress,
+    Step,
+    _run_steps,
+    generate,
+)
+from home.compression import PageGeometryError
+from home.file_cache import file_digest
+from home.fingerprint import input_fingerprint
+from home.ghostscript import GhostscriptPool
+from home.fo_split import FO
+from home.memory import GIB, MemoryBudget
+from home.slots import HostSlots, ToolLimit
+from moto import mock_s3
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import AnnotationBuilder, DecodedStreamObject, NameObject
+
+# Steps that must be displayed before a given step
+STEP_DEPENDENCIES = {
+    "Récupération des illustrations communes dans le référentiel": [
+        "Récupération des ressources métiers du Shom"
+    ],
+    "Conversion des illustrations communes": [
+        "Récupération des illustrations communes dans le référentiel"
+    ],
+    "Conversion des illustrations de l'ouvrage": [
+        "Récupération des sources de l'ouvrage dans le référentiel"
+    ],
+    "Récupération des sources communes": [
+        "Récupération des ressources métiers du Shom",
+        "Conversion des illustrations de l'ouvrage",
+    ],
+    "Génération des fichiers intermédiaires (FO)": [
+        "Récupération des sources communes"
+    ],
+    "Génération de l'ouvrage (PDF)": [
+        "Génération des fichiers intermédiaires (FO)",
+        "Conversion des illustrations communes",
+    ],
+    "Génération de la vignette": ["Génération de l'ouvrage (PDF)"],
+    "Génération des métadonnées": ["Récupération des sources communes"],
+    "Compression du fichier PDF": ["Génération de l'ouvrage (PDF)"],
+}
+
+
+def assert_steps(displayable_step: Path, expected_steps: list[str]) -> None:
+    """Independent steps run concurrently, only their dependencies are ordered."""
+    steps = displayable_step.read_text().splitlines()
+    step_count = len(expected_steps)
+    assert [step.split(":")[0] for step in steps] == [
+        f"Étape {index} sur {step_count}" for index in range(1, step_count + 1)
+    ]
+
+    texts = [step.split(": ", 1)[1] for step in steps]
+    assert sorted(texts) == sorted(step.split(": ", 1)[1] for step in expected_steps)
+    for index, text in enumerate(texts):
+        for dependency in STEP_DEPENDENCIES.get(text, []):
+            if dependency in texts:
+                assert texts.index(dependency) < index
+    if "Sauvegarde de l'ouvrage" in texts:
+        assert texts[-1] == "Sauvegarde de l'ouvrage"
+
+
+def render_fo(fo: Path, pdf: Path) -> None:
+    """
+    Render like AHFormatter, roughly: a page per block of the flows, with the
+    page numbers, citations, links and bookmarks of the FO document.
+    """
+    root = ElementTree.parse(fo).getroot()
+    sequences = list(root.iter(f"{FO}page-sequence"))
+    pages, page_of_id, page_number = [], {}, 0
+    for index, sequence in enumerate(sequences):
+        initial_page_number = sequence.get("initial-page-number", "auto")
+        if initial_page_number.isdigit():
+            page_number = int(initial_page_number)
+        else:
+            page_number += 1
+            if initial_page_number == "auto-odd" and page_number % 2 == 0:
+                page_number += 1
+        page_of_id[sequence.get("id")] = len(pages)
+        for block in sequence.find(f"{FO}flow"):
+            for element in block.iter():
+                page_of_id.setdefault(element.get("id"), len(pages))
+            pages.append((page_number, block))
+            page_number += 1
+        force_page_count = sequence.get("force-page-count", "auto")
+        if force_page_count == "auto" and index + 1 < len(sequences):
+            if sequences[index + 1].get("initial-page-number") == "auto-odd":
+                force_page_count = "end-on-even"
+        if force_page_count == "end-on-even" and page_number % 2 == 0:
+            pages.append((page_number, None))
+            page_number += 1
+        page_number -= 1
+
+    def text(element):
+        if element.tag == f"{FO}page-number-citation":
+            return str(pages[page_of_id[element.get("ref-id")]][0])
+        return "".join(
+            [
+                element.text or "",
+                *(text(child) + (child.tail or "") for child in element),
+            ]
+        )
+
+    writer = PdfWriter()
+    for page_number, block in pages:
+        page = writer.add_blank_page(200, 200)
+        content = DecodedStreamObject()
+        content.set_data(
+            f"{page_number} {'' if block is None else text(block)}".encode()
+        )
+        page[NameObject("/Contents")] = writer._add_object(content)
+        for link in [] if block is None else block.iter(f"{FO}basic-link"):
+            if link.get("internal-destination"):
+                annotation = AnnotationBuilder.link(
+                    rect=(0, 0, 10, 10),
+                    target_page_index=page_of_id[link.get("internal-destination")],
+                )
+            else:
+                url = re.fullmatch(r"url\('(.*)'\)", link.get("external-destination"))
+                annotation = AnnotationBuilder.link(rect=(0, 0, 10, 10), url=url[1])
+            writer.add_annotation(len(writer.pages) - 1, annotation)
+    for bookmark in root.iter(f"{FO}bookmark"):
+        writer.add_outline_item(
+            bookmark.find(f"{FO}bookmark-title").text,
+            page_of_id[bookmark.get("internal-destination")],
+        )
+    writer.write(pdf)
+
+
+def gs_stdin(write: Mock):
+    """pytest-subprocess doesn't provide the standard input stream."""
+    start = GhostscriptPool._start
+
+    async def start_worker(pool):
+        process = await start(pool)
+        process.stdin = AsyncMock(write=write, close=Mock())
+        return process
+
+    return patch.object(GhostscriptPool, "_start", start_worker)
 
 
 class TestGenerator:
@@ -23,6 +170,7 @@ class TestGenerator:
                 fake_process.any(min=2, max=2),
             ],
             occurrences=5,
+            callback=lambda process: Path(process.args[-1]).touch(),
         )
 
     @pytest.fixture
@@ -85,13 +233,40 @@ class TestGenerator:
             ).touch(),
         )
 
+    @pytest.fixture
+    def s3_resource(self):
+        with mock_s3():
+            yield boto3.resource("s3", endpoint_url="https://fake-s3-endpoint")
+
+    @pytest.fixture
+    def s3_readable_bucket(self, s3_resource):
+        bucket = s3_resource.Bucket("fake_readable_bucket")
+        bucket.create()
+        yield bucket
+
+    @pytest.fixture
+    def s3_writeable_bucket(self, s3_resource):
+        bucket = s3_resource.Bucket("fake_writeable_bucket")
+        bucket.create()
+        yield bucket
+
+    @pytest.fixture
+    def mock_s3_transfers(self, tmp_path):
+        with patch("home.s3.S3Transfers", autospec=True), patch(
+            "home.s3._shom_assets_version", return_value=None
+        ), patch("home.s3.HOME_GENERATION_PATH", tmp_path), patch(
+            "bin.generator.S3Transfers", autospec=True
+        ) as s3_transfers_mock:
+            yield s3_transfers_mock
+
     @pytest.fixture
     def mock_bootstrap_assets(self, tmp_path):
         def create_asset_dirs():
-            (tmp_path / "commun").mkdir(exist_ok=True)
+            (tmp_path / "commun_converti").mkdir(exist_ok=True)
             ion_file = tmp_path / "source" / "xsl" / "metadonnees" / "ISO_OuvNaut.xsl"
             ion_file.parent.mkdir(parents=True, exist_ok=True)
             ion_file.touch()
+            return tmp_path
 
         with patch(
             "bin.generator.bootstrap_assets", autospec=True
@@ -124,12 +299,33 @@ class TestGenerator:
             "Étape 7 sur 7: Génération de l'ouvrage (PDF)",
         ]
 
-        assert (
-            tmp_path / "fake_uuid" / "g4" / "displayable_step"
-        ).read_text().splitlines() == expected_steps
+        assert_steps(tmp_path / "fake_uuid" / "g4" / "displayable_step", expected_steps)
         assert (tmp_path / "fake_uuid" / "g4" / "stderr.log").exists()
         assert (tmp_path / "fake_uuid" / "g4" / "document.pdf").exists()
-        assert not (tmp_path / "fake_uuid" / "g4" / "archive.zip").exists()
+        assert not (tmp_path / "fake_uuid" / "g4" / "bundle").exists()
+        # The log file is closed with the generation
+        assert not logging.getLogger(str(tmp_path / "fake_uuid" / "g4")).handlers
+
+    def test_log_of_each_generation(self, tmp_path):
+        generators = []
+        for generation in ["first", "second"]:
+            (tmp_path / generation / "g4").mkdir(parents=True)
+            generators.append(
+                Generator(
+                    tmp_path / generation / "g4",
+                    s3_endpoint="https://fake_s3_endpoint",
+                    s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+                )
+            )
+        for generator, generation in zip(generators, ["first", "second"]):
+            generator.logger.info("%s generation", generation)
+            generator._close_log()
+
+        for generator, generation in zip(generators, ["first", "second"]):
+            log = generator.logfile.read_text()
+            assert f" - g4 - INFO - {generation} generation" in log
+            assert len(log.splitlines()) == 1
+            assert not generator.logger.handlers
 
     async def test_copy_shared_source(
         self, tmp_path, fake_ps2pdf, fake_saxon, fake_ahformatter, mock_bootstrap_assets
@@ -180,26 +376,11 @@ class TestGenerator:
         fake_ahformatter,
         fake_process,
         mock_bootstrap_assets,
+        s3_readable_bucket,
     ):
-        fake_s3_endpoint = "https://fake_s3_endpoint"
+        fake_s3_endpoint = "https://fake-s3-endpoint"
         fake_s3_source_path = "s3://fake_readable_bucket"
-        fake_s3_fetch_idocument_ouvrage = fake_process.register(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "cp",
-                "--endpoint-url",
-                fake_s3_endpoint,
-                "--recursive",
-                fake_s3_source_path,
-                str(tmp_path / "fake_uuid" / "g4"),
-            ],
-            callback=lambda process: (
-                tmp_path / "fake_uuid" / "g4" / "idocument.donottouch.xml"
-            ).touch(),
-        )
+        s3_readable_bucket.put_object(Key="idocument.donottouch.xml", Body="")
         fake_saxon_idocument = fake_process.register(
             [
                 "java",
@@ -221,7 +402,7 @@ class TestGenerator:
             s3_inputs_bucket="s3://fake_s3_inputs_bucket",
         )
         assert not fake_ps2pdf.calls
-        assert fake_s3_fetch_idocument_ouvrage.calls
+        assert (tmp_path / "fake_uuid" / "g4" / "idocument.donottouch.xml").exists()
         assert fake_saxon_idocument.calls
         assert fake_ahformatter.calls
         mock_bootstrap_assets.assert_called_once()
@@ -234,27 +415,12 @@ class TestGenerator:
         fake_ahformatter,
         fake_process,
         mock_bootstrap_assets,
+        s3_readable_bucket,
     ):
-        fake_s3_endpoint = "https://fake_s3_endpoint"
+        fake_s3_endpoint = "https://fake-s3-endpoint"
         fake_s3_source_path = "s3://fake_readable_bucket"
 
-        fake_s3_fetch_calmar_ouvrage = fake_process.register(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "cp",
-                "--endpoint-url",
-                fake_s3_endpoint,
-                "--recursive",
-                fake_s3_source_path,
-                str(tmp_path / "fake_uuid" / "g4"),
-            ],
-            callback=lambda process: (
-                tmp_path / "fake_uuid" / "g4" / "calmarafacon.donottouch.xml"
-            ).touch(),
-        )
+        s3_readable_bucket.put_object(Key="calmarafacon.donottouch.xml", Body="")
 
         fake_saxon_calmar = fake_process.register(
             [
@@ -311,18 +477,17 @@ class TestGenerator:
         )
 
         assert not fake_ps2pdf.calls
-        assert fake_s3_fetch_calmar_ouvrage.calls
+        assert (tmp_path / "fake_uuid" / "g4" / "calmarafacon.donottouch.xml").exists()
         assert fake_saxon.calls
         assert fake_saxon_calmar.calls
         assert fake_ahformatter.calls
         assert fake_ahformatter_calmar.calls
         mock_bootstrap_assets.assert_called_once()
 
-        archive = zipfile.Path(tmp_path / "fake_uuid" / "g4" / "archive.zip")
-        assert {file.name for file in archive.iterdir()} == {
-            "document.pdf",
+        assert (tmp_path / "fake_uuid" / "g4" / "bundle").read_text().splitlines() == [
             "01-FAKE_REGION_2023_local.pdf",
-        }
+            "document.pdf",
+        ]
 
     async def test_fetch_from_s3(
         self,
@@ -330,25 +495,12 @@ class TestGenerator:
         fake_ps2pdf,
         fake_saxon,
         fake_ahformatter,
-        fake_process,
         mock_bootstrap_assets,
+        s3_readable_bucket,
     ):
-        fake_s3_endpoint = "https://fake_s3_endpoint"
+        fake_s3_endpoint = "https://fake-s3-endpoint"
         fake_s3_source_path = "s3://fake_readable_bucket"
-        fake_s3_fetch_ouvrage = fake_process.register(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "cp",
-                "--endpoint-url",
-                fake_s3_endpoint,
-                "--recursive",
-                fake_s3_source_path,
-                str(tmp_path / "fake_uuid" / "g4"),
-            ]
-        )
+        s3_readable_bucket.put_object(Key="LISEZMOI.txt", Body="")
 
         await generate(
             tmp_path / "fake_uuid" / "g4",
@@ -362,8 +514,7 @@ class TestGenerator:
         assert fake_ahformatter.calls
         mock_bootstrap_assets.assert_called_once()
 
-        assert fake_s3_fetch_ouvrage.call_count() == 1
-        assert fake_s3_fetch_ouvrage.first_call.args == fake_process.calls[0]
+        assert (tmp_path / "fake_uuid" / "g4" / "LISEZMOI.txt").exists()
 
     async def test_write_in_s3(
         self,
@@ -372,41 +523,15 @@ class TestGenerator:
         fake_saxon,
         fake_ahformatter,
         fake_saxon_metadata,
-        fake_process,
         mock_bootstrap_assets,
+        s3_readable_bucket,
+        s3_writeable_bucket,
     ):
-        fake_s3_endpoint = "https://fake_s3_endpoint"
+        fake_s3_endpoint = "https://fake-s3-endpoint"
         fake_s3_source_path = "s3://fake_readable_bucket"
         fake_s3_destination_path = "s3://fake_writeable_bucket"
 
-        fake_process.register(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "cp",
-                "--endpoint-url",
-                fake_s3_endpoint,
-                "--recursive",
-                fake_s3_source_path,
-                str(tmp_path / "fake_uuid" / "g4"),
-            ]
-        )
-
-        fake_s3_write = fake_process.register(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "cp",
-                "--endpoint-url",
-                fake_s3_endpoint,
-                fake_process.any(min=2, max=2),
-            ],
-            occurrences=4,
-        )
+        (tmp_path / "fake_uuid" / "g4" / "vignette.jpg").write_text("vignette")
 
         await generate(
             tmp_path / "fake_uuid" / "g4",
@@ -423,42 +548,94 @@ class TestGenerator:
         assert fake_ahformatter.calls
         mock_bootstrap_assets.assert_called_once()
 
-        assert fake_s3_write.call_count() == 4
+        assert {s3_object.key for s3_object in s3_writeable_bucket.objects.all()} == {
+            "document.pdf",
+            "vignette.jpg",
+            "stderr.log",
+            next((tmp_path / "fake_uuid" / "g4").glob("OUVNAUT_*.xml")).name,
+        }
+        assert (
+            s3_writeable_bucket.Object("vignette.jpg").get()["Body"].read()
+            == b"vignette"
+        )
 
-        fake_s3_write_args = [call.args for call in fake_s3_write.calls]
-        assert fake_s3_write_args == list(fake_process.calls)[-4:]
+    async def test_write_fingerprint_in_s3(
+        self,
+        tmp_path,
+        fake_ps2pdf,
+        fake_saxon,
+        fake_ahformatter,
+        mock_bootstrap_assets,
+        s3_readable_bucket,
+        s3_writeable_bucket,
+    ):
+        shared_etags = {
+            "commun/illustrations/logo.eps": '"logo"',
+            "commun/illustrations/rose.eps": '"rose"',
+            "source/xsl/document.xsl": '"xsl"',
+        }
+        (tmp_path / "etags.json").write_text(json.dumps(shared_etags))
+        (tmp_path / "fake_uuid" / "g4" / "vignette.jpg").write_text("vignette")
+        s3_readable_bucket.put_object(
+            Key="xml/document.xml", Body='<g4><image fichier="logo.eps"/></g4>'
+        )
 
-        fake_source_prefixes = [
-            str(tmp_path / "fake_uuid" / "g4" / "document.pdf"),
-            str(tmp_path / "fake_uuid" / "g4" / "vignette.jpg"),
-            str(tmp_path / "fake_uuid" / "g4" / "stderr.log"),
-            str(tmp_path / "fake_uuid" / "g4" / "OUVNAUT"),
-        ]
-        fake_destination_prefixes = [
-            fake_s3_destination_path + "/document.pdf",
-            fake_s3_destination_path + "/vignette.jpg",
-            fake_s3_destination_path + "/stderr.log",
-            fake_s3_destination_path + "/OUVNAUT",
-        ]
-        for write_in_s3_call, fake_source_prefix, fake_destination_prefix in zip(
-            fake_s3_write_args,
-            fake_source_prefixes,
-            fake_destination_prefixes,
-            strict=True,
-        ):
-            assert write_in_s3_call[-2].startswith(fake_source_prefix)
-            assert write_in_s3_call[-1].startswith(fake_destination_prefix)
+        await generate(
+            tmp_path / "fake_uuid" / "g4",
+            s3_endpoint="https://fake-s3-endpoint",
+            s3_source_path="s3://fake_readable_bucket",
+            s3_destination_path="s3://fake_writeable_bucket",
+            s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+        )
+
+        source_etags = {
+            "xml/document.xml": s3_readable_bucket.Object("xml/document.xml").e_tag
+        }
+        assert json.loads(
+            s3_writeable_bucket.Object("fingerprint.json").get()["Body"].read()
+        ) == {
+            "fingerprint": input_fingerprint(source_etags, shared_etags, ["logo"]),
+            "illustrations": ["logo"],
+        }
+
+    async def test_fingerprint_of_unparsed_document(
+        self,
+        tmp_path,
+        fake_ps2pdf,
+        fake_saxon,
+        fake_ahformatter,
+        mock_bootstrap_assets,
+        s3_readable_bucket,
+        s3_writeable_bucket,
+    ):
+        (tmp_path / "etags.json").write_text("{}")
+        (tmp_path / "fake_uuid" / "g4" / "vignette.jpg").write_text("vignette")
+        # Left by a previous run
+        (tmp_path / "fake_uuid" / "g4" / "fingerprint.json").write_text("{}")
+        s3_readable_bucket.put_object(Key="xml/document.xml", Body="<g4>&entity;</g4>")
+
+        await generate(
+            tmp_path / "fake_uuid" / "g4",
+            s3_endpoint="https://fake-s3-endpoint",
+            s3_source_path="s3://fake_readable_bucket",
+            s3_destination_path="s3://fake_writeable_bucket",
+            s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+        )
+
+        keys = {s3_object.key for s3_object in s3_writeable_bucket.objects.all()}
+        assert "document.pdf" in keys
+        assert "fingerprint.json" not in keys
 
     async def test_eps_common(
         self, tmp_path, fake_ps2pdf, fake_saxon, fake_ahformatter, mock_bootstrap_assets
     ):
-        folder_eps = tmp_path / "commun"
+        folder_eps = tmp_path / "commun_converti"
         (folder_eps / "in" / "illustrations" / "eps").mkdir(parents=True)
-        (folder_eps / "in" / "illustrations" / "eps" / "fake1.eps").touch()
+        (folder_eps / "in" / "illustrations" / "eps" / "fake1.eps").write_text("1")
 
         (folder_eps / "illustrations" / "eps").mkdir(parents=True)
-        (folder_eps / "illustrations" / "eps" / "fake2.eps").touch()
-        (folder_eps / "illustrations" / "eps" / "fake3.eps").touch()
+        (folder_eps / "illustrations" / "eps" / "fake2.eps").write_text("2")
+        (folder_eps / "illustrations" / "eps" / "fake3.eps").write_text("3")
 
         await generate(
             tmp_path / "fake_uuid" / "g4",
@@ -471,7 +648,7 @@ class TestGenerator:
         assert fake_ahformatter.calls
         mock_bootstrap_assets.assert_called_once()
 
-        assert (tmp_path / "commun" / "illustrations" / "eps").exists()
+        assert (tmp_path / "commun_converti" / "illustrations" / "eps").exists()
         assert (tmp_path / "fake_uuid" / "commun" / "illustrations" / "pdf").exists()
         assert (
             tmp_path / "fake_uuid" / "commun" / "in" / "illustrations" / "pdf"
@@ -483,12 +660,45 @@ class TestGenerator:
             assert Path(eps_path).stem == Path(pdf_path).stem
             assert Path(pdf_path).suffix == ".pdf"
 
+    async def test_eps_common_already_converted(
+        self, tmp_path, fake_ps2pdf, fake_saxon, fake_ahformatter, mock_bootstrap_assets
+    ):
+        folder_illustrations = tmp_path / "commun_converti" / "illustrations"
+        (folder_illustrations / "eps").mkdir(parents=True)
+        (folder_illustrations / "eps" / "converted.eps").write_text("1")
+        (folder_illustrations / "eps" / "not_converted.eps").write_text("2")
+        (folder_illustrations / "pdf").mkdir(parents=True)
+        (folder_illustrations / "pdf" / "converted.pdf").write_text("1")
+
+        await generate(
+            tmp_path / "fake_uuid" / "g4",
+            s3_endpoint="https://fake_s3_endpoint",
+            s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+            cleanup=False,
+        )
+
+        assert fake_ps2pdf.call_count() == 1
+        *_, eps_path, pdf_path = fake_ps2pdf.first_call.args
+        assert Path(eps_path).name == "not_converted.eps"
+        assert (
+            tmp_path
+            / "fake_uuid"
+            / "commun"
+            / "illustrations"
+            / "pdf"
+            / "converted.pdf"
+        ).read_text() == "1"
+
     async def test_eps_ouvrage(
         self, tmp_path, fake_ps2pdf, fake_saxon, fake_ahformatter, mock_bootstrap_assets
     ):
         (tmp_path / "fake_uuid" / "g4" / "illustrations" / "eps").mkdir(parents=True)
-        (tmp_path / "fake_uuid" / "g4" / "illustrations" / "eps" / "fake1.eps").touch()
-        (tmp_path / "fake_uuid" / "g4" / "illustrations" / "eps" / "fake2.eps").touch()
+        (
+            tmp_path / "fake_uuid" / "g4" / "illustrations" / "eps" / "fake1.eps"
+        ).write_text("1")
+        (
+            tmp_path / "fake_uuid" / "g4" / "illustrations" / "eps" / "fake2.eps"
+        ).write_text("2")
         (
             tmp_path / "fake_uuid" / "g4" / "illustrations" / "eps" / ".toignore.eps"
         ).touch()
@@ -528,6 +738,46 @@ class TestGenerator:
                 / (stem + ".pdf")
             )
 
+    async def test_eps_cache(
+        self,
+        tmp_path,
+        fake_ps2pdf,
+        fake_saxon,
+        fake_ahformatter,
+        fake_process,
+        mock_bootstrap_assets,
+    ):
+        for generation_id in ["fake_uuid", "other_fake_uuid"]:
+            eps_dir = tmp_path / generation_id / "g4" / "illustrations" / "eps"
+            eps_dir.mkdir(parents=True)
+            (eps_dir / "fake1.eps").write_text("1")
+            (eps_dir / "fake2.eps").write_text("2")
+
+        await generate(
+            tmp_path / "fake_uuid" / "g4",
+            s3_endpoint="https://fake_s3_endpoint",
+            s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+            cleanup=False,
+        )
+        assert fake_ps2pdf.call_count() == 2
+
+        (tmp_path / "other_fake_uuid" / "g4" / "xml").mkdir()
+        fake_process.register(["java", fake_process.any()])
+        fake_process.register(["/usr/AHFormatterV6_64/run.sh", fake_process.any()])
+        await generate(
+            tmp_path / "other_fake_uuid" / "g4",
+            s3_endpoint="https://fake_s3_endpoint",
+            s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+            cleanup=False,
+        )
+        assert fake_ps2pdf.call_count() == 2
+
+        pdf_dir = tmp_path / "other_fake_uuid" / "g4" / "illustrations" / "pdf"
+        assert {pdf.name for pdf in pdf_dir.iterdir()} == {"fake1.pdf", "fake2.pdf"}
+
+        logs = (tmp_path / "other_fake_uuid" / "g4" / "stderr.log").read_text()
+        assert "EPS CACHE : 2 hits, 0 misses" in logs
+
     async def test_cleanup(
         self, tmp_path, fake_ps2pdf, fake_saxon, fake_ahformatter, mock_bootstrap_assets
     ):
@@ -562,6 +812,7 @@ class TestGenerator:
         self,
         tmp_path,
         fake_process,
+        mock_s3_transfers,
     ):
         fake_process.register([fake_process.any()], returncode=1)
         fake_process.keep_last_process(True)
@@ -635,6 +886,196 @@ class TestGenerator:
         assert not (tmp_path / "fake_uuid" / "g4" / "document_optimized.pdf").exists()
         assert (tmp_path / "fake_uuid" / "g4" / "document.pdf").exists()
 
+    async def test_split_rendering(
+        self, tmp_path, fake_ps2pdf, fake_process, mock_bootstrap_assets
+    ):
+        chapters = "".join(
+            f"""
+            <fo:page-sequence id="chapitre-{chapter}" master-reference="page"
+                              initial-page-number="{'auto-odd' if chapter == 3 else 'auto'}">
+              <fo:flow flow-name="xsl-region-body">
+                {'<fo:block>Chapitre</fo:block>' * (chapter + 1)}
+              </fo:flow>
+            </fo:page-sequence>"""
+            for chapter in range(1, 5)
+        )
+        contents = "".join(
+            f"""
+            <fo:block>
+              <fo:basic-link internal-destination="chapitre-{chapter}">Chapitre {chapter}</fo:basic-link>
+              page <fo:page-number-citation ref-id="chapitre-{chapter}"/>
+            </fo:block>"""
+            for chapter in range(1, 5)
+        )
+        bookmarks = "".join(
+            f"""
+            <fo:bookmark internal-destination="chapitre-{chapter}">
+              <fo:bookmark-title>Chapitre {chapter}</fo:bookmark-title>
+            </fo:bookmark>"""
+            for chapter in range(1, 5)
+        )
+        document_fo = f"""<?xml version="1.0" encoding="utf-8"?>
+        <fo:root xmlns:fo="http://www.w3.org/1999/XSL/Format">
+          <fo:layout-master-set/>
+          <fo:bookmark-tree>{bookmarks}</fo:bookmark-tree>
+          <fo:page-sequence master-reference="page">
+            <fo:flow flow-name="xsl-region-body">{contents}</fo:flow>
+          </fo:page-sequence>
+          {chapters}
+        </fo:root>
+        """
+        fo = tmp_path / "fake_uuid" / "g4" / "xml" / "document.fo"
+        fake_process.register(["java", fake_process.any()], stdout=document_fo)
+        fake_ahformatter = fake_process.register(
+            ["/usr/AHFormatterV6_64/run.sh", fake_process.any()],
+            occurrences=20,
+            callback=lambda process: render_fo(
+                Path(process.args[2]), Path(process.args[4])
+            ),
+        )
+
+        with patch("bin.generator.os.cpu_count", return_value=3):
+            await generate(
+                tmp_path / "fake_uuid" / "g4",
+                s3_endpoint="https://fake_s3_endpoint",
+                s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+                cleanup=False,
+                split_rendering=True,
+            )
+
+        assert 3 < fake_ahformatter.call_count() <= 9
+        render_fo(fo, tmp_path / "single_pass.pdf")
+        single_pass = PdfReader(tmp_path / "single_pass.pdf")
+        by_parts = PdfReader(tmp_path / "fake_uuid" / "g4" / "document.pdf")
+
+        def page_contents(reader):
+            return [page["/Contents"].get_object().get_data() for page in reader.pages]
+
+        def link_targets(reader):
+            page_references = [page.indirect_reference for page in reader.pages]
+            return [
+                destination
+                if isinstance(destination := link.get_object()["/Dest"][0], int)
+                else page_references.index(destination)
+                for page in reader.pages
+                for link in page.get("/Annots", [])
+            ]
+
+        def outline(reader):
+            return [
+                (item.title, reader.get_destination_page_number(item))
+                for item in reader.outline
+            ]
+
+        assert page_contents(by_parts) == page_contents(single_pass)
+        # Blank page before the auto-odd chapter 3
+        assert page_contents(by_parts)[9] == b"10 "
+        assert b"page 11" in page_contents(by_parts)[2]
+        assert link_targets(by_parts) == link_targets(single_pass)
+        assert outline(by_parts) == outline(single_pass)
+
+    async def test_parallel_compress(
+        self,
+        tmp_path,
+        fake_saxon,
+        fake_ahformatter,
+        fake_process,
+        mock_bootstrap_assets,
+    ):
+        def write_output_file(process):
+            [output_file] = [
+                arg.removeprefix("-sOutputFile=")
+                for arg in process.args
+                if arg.startswith("-sOutputFile=")
+            ]
+            Path(output_file).touch()
+
+        fake_compress = fake_process.register(
+            ["gs", fake_process.any()], occurrences=2, callback=write_output_file
+        )
+
+        with patch("bin.generator.page_count", return_value=120), patch(
+            "bin.generator.os.cpu_count", return_value=2
+        ), patch("bin.generator.reassemble", autospec=True) as mock_reassemble:
+            mock_reassemble.side_effect = lambda original, parts, destination: (
+                destination.touch()
+            )
+            await generate(
+                tmp_path / "fake_uuid" / "g4",
+                s3_endpoint="https://fake_s3_endpoint",
+                s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+                compress=True,
+                parallel_compress=True,
+            )
+
+        assert fake_compress.call_count() == 2
+        page_ranges = sorted(
+            [arg for arg in call if arg.startswith(("-dFirstPage", "-dLastPage"))]
+            for call in fake_process.calls
+            if call[0] == "gs"
+        )
+        assert page_ranges == [
+            ["-dFirstPage=1", "-dLastPage=60"],
+            ["-dFirstPage=61", "-dLastPage=120"],
+        ]
+        mock_reassemble.assert_called_once_with(
+            tmp_path / "fake_uuid" / "g4" / "document.pdf",
+            [
+                tmp_path / "fake_uuid" / "g4" / "document_optimized_1-60.pdf",
+                tmp_path / "fake_uuid" / "g4" / "document_optimized_61-120.pdf",
+            ],
+            tmp_path / "fake_uuid" / "g4" / "document_optimized.pdf",
+        )
+        assert set((tmp_path / "fake_uuid" / "g4").glob("document*.pdf")) == {
+            tmp_path / "fake_uuid" / "g4" / "document.pdf"
+        }
+
+    async def test_parallel_compress_fallback(
+        self,
+        tmp_path,
+        fake_saxon,
+        fake_ahformatter,
+        fake_process,
+        mock_bootstrap_assets,
+    ):
+        def write_output_file(process):
+            [output_file] = [
+                arg.removeprefix("-sOutputFile=")
+                for arg in process.args
+                if arg.startswith("-sOutputFile=")
+            ]
+            Path(output_file).touch()
+
+        fake_compress = fake_process.register(
+            ["gs", fake_process.any()], occurrences=3, callback=write_output_file
+        )
+
+        with patch("bin.generator.page_count", return_value=120), patch(
+            "bin.generator.os.cpu_count", return_value=2
+        ), patch(
+            "bin.generator.reassemble",
+            autospec=True,
+            side_effect=PageGeometryError("mediabox of page 61"),
+        ):
+            await generate(
+                tmp_path / "fake_uuid" / "g4",
+                s3_endpoint="https://fake_s3_endpoint",
+                s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+                compress=True,
+                parallel_compress=True,
+            )
+
+        assert fake_compress.call_count() == 3
+        [single_pass] = [
+            call
+            for call in fake_process.calls
+            if call[0] == "gs"
+            and not any(arg.startswith("-dFirstPage") for arg in call)
+            and "-sDEVICE=pdfwrite" in call
+        ]
+        assert single_pass[-2].endswith("/document_optimized.pdf")
+        assert not list((tmp_path / "fake_uuid" / "g4").glob("document_optimized_*"))
+
     async def test_vignette(
         self,
         tmp_path,
@@ -707,10 +1148,10 @@ class TestGenerator:
 
         assert fake_saxon_metadata.call_count() == 1
 
-    async def test_etape_all_steps(self, tmp_path, fake_process):
+    async def test_etape_all_steps(self, tmp_path, fake_process, mock_s3_transfers):
         (tmp_path / "fake_uuid" / "g4" / "document_optimized.pdf").touch()
-        (tmp_path / "commun").mkdir()
-        (tmp_path / "source").mkdir()
+        # Fetched from the referentiel
+        (tmp_path / "fake_uuid" / "g4" / "xml" / "document.xml").write_text("<g4/>")
 
         fake_process.register([fake_process.any()])
         fake_process.keep_last_process(True)
@@ -743,14 +1184,12 @@ class TestGenerator:
             "Étape 12 sur 12: Sauvegarde de l'ouvrage",
         ]
 
-        assert (
-            tmp_path / "fake_uuid" / "g4" / "displayable_step"
-        ).read_text().splitlines() == expected_steps
+        assert_steps(tmp_path / "fake_uuid" / "g4" / "displayable_step", expected_steps)
 
-    async def test_etape_some_steps(self, tmp_path, fake_process):
+    async def test_etape_some_steps(self, tmp_path, fake_process, mock_s3_transfers):
         (tmp_path / "fake_uuid" / "g4" / "document_optimized.pdf").touch()
-        (tmp_path / "commun").mkdir()
-        (tmp_path / "source").mkdir()
+        # Fetched from the referentiel
+        (tmp_path / "fake_uuid" / "g4" / "xml" / "document.xml").write_text("<g4/>")
 
         fake_process.register([fake_process.any()])
         fake_process.keep_last_process(True)
@@ -779,11 +1218,11 @@ class TestGenerator:
             "Étape 10 sur 10: Sauvegarde de l'ouvrage",
         ]
 
-        assert (
-            tmp_path / "fake_uuid" / "g4" / "displayable_step"
-        ).read_text().splitlines() == expected_steps
+        assert_steps(tmp_path / "fake_uuid" / "g4" / "displayable_step", expected_steps)
 
-    async def test_interrupted_progress(self, tmp_path, fake_process):
+    async def test_interrupted_progress(
+        self, tmp_path, fake_process, mock_s3_transfers
+    ):
         fake_process.register([fake_process.any()], returncode=1)
         fake_process.keep_last_process(True)
 
@@ -810,7 +1249,410 @@ class TestGenerator:
         mock_bootstrap_assets.assert_called_once()
 
         logs = (tmp_path / "fake_uuid" / "g4" / "stderr.log").read_text().splitlines()
+        assert any(
+            "g4 - INFO - WORKSPACE : 0 bytes linked, 0 bytes copied" in line
+            for line in logs
+        )
+        logs = [line for line in logs if "WORKSPACE" not in line]
         assert "g4 - INFO - SUBPROCESS : java -jar" in logs[0]
         assert logs[1] == "SAXON"
         assert "g4 - INFO - SUBPROCESS : /usr/AHFormatterV6_64/run.sh" in logs[2]
         assert logs[3] == "AHFormatter"
+
+    async def test_host_slots(
+        self, tmp_path, fake_ps2pdf, fake_saxon, fake_ahformatter, mock_bootstrap_assets
+    ):
+        def host_slots(reserved=0):
+            return HostSlots(
+                str(tmp_path / "slots"),
+                2,
+                {"ahformatter": ToolLimit(1, weight=2)},
+                reserved=reserved,
+            )
+
+        other_generation = host_slots()
+
+        async def render_other_ouvrage():
+            async with other_generation.acquire_async("ahformatter"):
+                await asyncio.sleep(0.5)
+
+        with patch("bin.generator.HostSlots", host_slots):
+            await asyncio.gather(
+                render_other_ouvrage(),
+                generate(
+                    tmp_path / "fake_uuid" / "g4",
+                    s3_endpoint="https://fake_s3_endpoint",
+                    s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+                    cleanup=False,
+                ),
+            )
+
+        assert fake_ahformatter.calls
+        logs = (tmp_path / "fake_uuid" / "g4" / "stderr.log").read_text()
+        assert re.search(r"SLOTS : ahformatter waited 0\.[0-9]+s\n", logs)
+        assert re.search(r"SLOTS : waited 0\.[0-9]+s for ahformatter\n", logs)
+
+    async def test_gs_pool(
+        self,
+        tmp_path,
+        fake_saxon,
+        fake_ahformatter,
+        fake_process,
+        mock_bootstrap_assets,
+    ):
+        eps_dir = tmp_path / "fake_uuid" / "g4" / "illustrations" / "eps"
+        eps_dir.mkdir(parents=True)
+        (eps_dir / "fake1.eps").write_text("1")
+        (eps_dir / "fake2.eps").write_text("2")
+
+        def write_output_file(program):
+            if output_file := re.search(rb"/OutputFile \((.+?\.pdf)\)", program):
+                Path(output_file.group(1).decode()).touch()
+
+        fake_gs_worker = fake_process.register(
+            ["gs", fake_process.any()],
+            stdout=["some output", "%%SPPNAUT-fake ok", "%%SPPNAUT-fake ok"],
+            # Running until it is waited for
+            callback=lambda process: None,
+            occurrences=2,
+        )
+
+        with patch("home.ghostscript.uuid.uuid4", return_value="fake"), gs_stdin(
+            Mock(side_effect=write_output_file)
+        ):
+            await generate(
+                tmp_path / "fake_uuid" / "g4",
+                s3_endpoint="https://fake_s3_endpoint",
+                s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+                cleanup=False,
+                gs_pool=True,
+            )
+
+        assert 1 <= fake_gs_worker.call_count() <= 2
+        assert "-sDEVICE=pdfwrite" in fake_gs_worker.first_call.args
+        assert "-dEPSCrop" in fake_gs_worker.first_call.args
+
+        logs = (tmp_path / "fake_uuid" / "g4" / "stderr.log").read_text()
+        assert "GHOSTSCRIPT : " + str(eps_dir / "fake1.eps") in logs
+        assert "some output" in logs
+
+    async def test_gs_pool_error(self, tmp_path, fake_process, mock_bootstrap_assets):
+        eps_dir = tmp_path / "fake_uuid" / "g4" / "illustrations" / "eps"
+        eps_dir.mkdir(parents=True)
+        (eps_dir / "broken.eps").write_text("1")
+
+        fake_process.register(
+            ["gs", fake_process.any()],
+            stdout=["%%SPPNAUT-fake error undefined"],
+            callback=lambda process: None,
+        )
+
+        with patch("home.ghostscript.uuid.uuid4", return_value="fake"), gs_stdin(
+            Mock()
+        ):
+            with pytest.raises(CalledProcessError):
+                await generate(
+                    tmp_path / "fake_uuid" / "g4",
+                    s3_endpoint="https://fake_s3_endpoint",
+                    s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+                    gs_pool=True,
+                )
+
+        logs = (tmp_path / "fake_uuid" / "g4" / "stderr.log").read_text()
+        assert (
+            f"GHOSTSCRIPT : {eps_dir / 'broken.eps'} failed with error undefined"
+            in logs
+        )
+
+    async def test_gs_pool_error_while_hashing(
+        self, tmp_path, fake_process, mock_bootstrap_assets
+    ):
+        eps_dir = tmp_path / "fake_uuid" / "g4" / "illustrations" / "eps"
+        eps_dir.mkdir(parents=True)
+        (eps_dir / "broken.eps").write_text("1")
+        (eps_dir / "slow.eps").write_text("2")
+
+        def slow_digest(file, *salt):
+            digest = file_digest(file, *salt)
+            if file.name == "slow.eps":
+                time.sleep(0.5)
+            return digest
+
+        converted = []
+        convert = GhostscriptPool.convert
+
+        async def record_conversion(pool, eps, pdf):
+            converted.append(eps.name)
+            await convert(pool, eps, pdf)
+
+        fake_process.register(
+            ["gs", fake_process.any()],
+            stdout=["%%SPPNAUT-fake error undefined"],
+            callback=lambda process: None,
+        )
+
+        with patch("home.ghostscript.uuid.uuid4", return_value="fake"), gs_stdin(
+            Mock()
+        ), patch("bin.generator.file_digest", side_effect=slow_digest), patch.object(
+            GhostscriptPool, "convert", record_conversion
+        ):
+            with pytest.raises(CalledProcessError):
+                await generate(
+                    tmp_path / "fake_uuid" / "g4",
+                    s3_endpoint="https://fake_s3_endpoint",
+                    s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+                    gs_pool=True,
+                )
+            await asyncio.sleep(1)
+
+        # slow.eps isn't queued to the stopped pool, where it would wait forever
+        assert converted == ["broken.eps"]
+
+    async def test_referenced_illustrations_only(
+        self, tmp_path, fake_ps2pdf, fake_saxon, fake_ahformatter, mock_bootstrap_assets
+    ):
+        commun_eps = tmp_path / "commun_converti" / "illustrations" / "eps"
+        commun_eps.mkdir(parents=True)
+        (commun_eps / "commune_utilisee.eps").write_text("1")
+        (commun_eps / "commune_inutilisee.eps").write_text("2")
+        ouvrage_eps = tmp_path / "fake_uuid" / "g4" / "illustrations" / "eps"
+        ouvrage_eps.mkdir(parents=True)
+        (ouvrage_eps / "ouvrage_utilisee.eps").write_text("3")
+        (ouvrage_eps / "ouvrage_inutilisee.eps").write_text("4")
+        (tmp_path / "fake_uuid" / "g4" / "xml" / "document.xml").write_text(
+            """<?xml version="1.0" encoding="UTF-16"?>
+<document>
+    <illustration fichier="commune_utilisee"/>
+    <illustration fichier="../illustrations/eps/ouvrage_utilisee.eps"/>
+</document>
+""",
+            encoding="utf-16",
+        )
+
+        await generate(
+            tmp_path / "fake_uuid" / "g4",
+            s3_endpoint="https://fake_s3_endpoint",
+            s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+            cleanup=False,
+            referenced_illustrations_only=True,
+        )
+
+        assert fake_saxon.calls
+        converted = {Path(call.args[-2]).name for call in fake_ps2pdf.calls}
+        assert converted == {"commune_utilisee.eps", "ouvrage_utilisee.eps"}
+
+    async def test_referenced_illustrations_missing(
+        self, tmp_path, fake_ps2pdf, fake_saxon, fake_ahformatter, mock_bootstrap_assets
+    ):
+        (tmp_path / "fake_uuid" / "g4" / "xml" / "document.xml").write_text(
+            '<document><illustration fichier="absente.eps"/></document>'
+        )
+
+        with pytest.raises(FileNotFoundError, match="absente.eps"):
+            await generate(
+                tmp_path / "fake_uuid" / "g4",
+                s3_endpoint="https://fake_s3_endpoint",
+                s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+                referenced_illustrations_only=True,
+            )
+
+        assert not fake_saxon.calls
+        logs = (tmp_path / "fake_uuid" / "g4" / "stderr.log").read_text()
+        assert "ERROR - MISSING ILLUSTRATION : absente.eps" in logs
+
+    async def test_incremental(
+        self,
+        tmp_path,
+        fake_ps2pdf,
+        fake_saxon,
+        fake_ahformatter,
+        fake_process,
+        mock_bootstrap_assets,
+    ):
+        ouvrage_path = tmp_path / "fake_uuid" / "g4"
+        (ouvrage_path / "xml" / "document.xml").write_text("<document/>")
+        (ouvrage_path / "illustrations" / "eps").mkdir(parents=True)
+        (ouvrage_path / "illustrations" / "eps" / "fake1.eps").write_text("1")
+
+        for _ in range(2):
+            await generate(
+                ouvrage_path,
+                s3_endpoint="https://fake_s3_endpoint",
+                s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+                incremental=True,
+            )
+
+        assert fake_ps2pdf.call_count() == 1
+        assert fake_saxon.call_count() == 1
+        assert fake_ahformatter.call_count() == 1
+        logs = (ouvrage_path / "stderr.log").read_text()
+        assert "UP TO DATE : fo" in logs
+        assert "UP TO DATE : pdf" in logs
+        assert (ouvrage_path / "xml" / "document.fo").exists()
+
+        (ouvrage_path / "xml" / "document.xml").write_text("<document>2</document>")
+        fake_process.register(["java", fake_process.any()])
+        fake_process.register(
+            ["/usr/AHFormatterV6_64/run.sh", fake_process.any()],
+            callback=lambda process: (ouvrage_path / "document.pdf").touch(),
+        )
+        await generate(
+            ouvrage_path,
+            s3_endpoint="https://fake_s3_endpoint",
+            s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+            incremental=True,
+        )
+
+        assert fake_ps2pdf.call_count() == 1
+        assert fake_process.call_count(["java", fake_process.any()]) == 2
+        assert (
+            fake_process.call_count(
+                ["/usr/AHFormatterV6_64/run.sh", fake_process.any()]
+            )
+            == 2
+        )
+
+    @pytest.fixture
+    def mock_saxon_service(self):
+        def transform_all(source, transforms, log_file=None):
+            for transform in transforms:
+                if transform.output:
+                    transform.output.touch()
+            return True
+
+        with patch(
+            "bin.generator.SaxonService.transform_all",
+            autospec=True,
+            side_effect=lambda self, *args: transform_all(*args),
+        ) as transform_all_mock, patch("bin.generator.SaxonService.enabled", True):
+            yield transform_all_mock
+
+    @pytest.mark.parametrize("single_parse", [False, True])
+    async def test_saxon_service(
+        self,
+        tmp_path,
+        fake_process,
+        fake_ahformatter,
+        mock_bootstrap_assets,
+        mock_saxon_service,
+        single_parse,
+    ):
+        (tmp_path / "fake_uuid" / "g4" / "calmarafacon.donottouch.xml").touch()
+
+        await generate(
+            tmp_path / "fake_uuid" / "g4",
+            s3_endpoint="https://fake_s3_endpoint",
+            s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+            cleanup=False,
+            metadata=True,
+            single_parse=single_parse,
+        )
+
+        requests = [
+            [transform.stylesheet for transform in call.args[2]]
+            for call in mock_saxon_service.call_args_list
+        ]
+        fo_stylesheets = [
+            None,
+            tmp_path / "fake_uuid" / "source" / "xsl" / "fo" / "Calmar_A_Facon.xsl",
+            tmp_path
+            / "fake_uuid"
+            / "source"
+            / "xsl"
+            / "metadonnees"
+            / "ISO_OuvNaut.xsl",
+        ]
+        if single_parse:
+            assert requests == [fo_stylesheets]
+        else:
+            # The metadata are generated concurrently with the FO
+            assert sorted(requests, key=str) == sorted(
+                ([stylesheet] for stylesheet in fo_stylesheets), key=str
+            )
+        assert (tmp_path / "fake_uuid" / "g4" / "metadonnees.xml").exists()
+        assert fake_ahformatter.calls
+        logs = (tmp_path / "fake_uuid" / "g4" / "stderr.log").read_text()
+        assert "SUBPROCESS : java" not in logs
+        assert "SAXON SERVICE : " in logs
+
+    async def test_saxon_service_admission(
+        self,
+        tmp_path,
+        fake_process,
+        fake_ahformatter,
+        mock_bootstrap_assets,
+        mock_saxon_service,
+    ):
+        slots = HostSlots(str(tmp_path / "slots"), 4, {"java": ToolLimit(1)})
+        memory = MemoryBudget(str(tmp_path / "memory"), budget=GIB)
+
+        async def transform_other_ouvrage():
+            async with memory.admit_async("java", "other"), slots.acquire_async("java"):
+                await asyncio.sleep(0.5)
+
+        with patch("bin.generator.HostSlots", return_value=slots), patch(
+            "bin.generator.MemoryBudget", return_value=memory
+        ), patch("home.memory.ADMISSION_POLL_INTERVAL", 0.1):
+            await asyncio.gather(
+                transform_other_ouvrage(),
+                generate(
+                    tmp_path / "fake_uuid" / "g4",
+                    s3_endpoint="https://fake_s3_endpoint",
+                    s3_inputs_bucket="s3://fake_s3_inputs_bucket",
+                    cleanup=False,
+                ),
+            )
+
+        assert mock_saxon_service.called
+        logs = (tmp_path / "fake_uuid" / "g4" / "stderr.log").read_text()
+        assert "MEMORY : java waited" in logs
+        assert "SUBPROCESS : java" not in logs
+
+
+class TestRunSteps:
+    async def test_independent_steps_overlap(self, tmp_path):
+        events = []
+        both_started = asyncio.Event()
+
+        async def step(name):
+            events.append(f"start {name}")
+            if len(events) == 2:
+                both_started.set()
+            await asyncio.wait_for(both_started.wait(), timeout=1)
+            events.append(f"end {name}")
+
+        await _run_steps(
+            [
+                Step("fetch", lambda: step("fetch")),
+                Step("commun", lambda: step("commun")),
+                Step("pdf", lambda: step("pdf"), after=["fetch", "commun"]),
+            ],
+            Progress(tmp_path / "displayable_step", 3),
+        )
+
+        assert events[:2] == ["start fetch", "start commun"]
+        assert events[-2:] == ["start pdf", "end pdf"]
+
+    async def test_failed_step(self, tmp_path):
+        started = []
+
+        async def fail():
+            raise CalledProcessError(1, "gs")
+
+        async def step(name):
+            started.append(name)
+
+        with pytest.raises(CalledProcessError):
+            await _run_steps(
+                [
+                    Step("compress", fail, description="Compression du fichier PDF"),
+                    Step("vignette", lambda: step("vignette")),
+                    Step("write", lambda: step("write"), after=["compress"]),
+                ],
+                Progress(tmp_path / "displayable_step", 2),
+            )
+
+        assert started == ["vignette"]
+        assert (tmp_path / "displayable_step").read_text().splitlines() == [
+            "Étape 1 sur 2: Compression du fichier PDF"
+        ]
@@ -0,0 +1,141 @@
+import asyncio
+import io
+import logging
+import shutil
+import subprocess
+from pathlib import Path
+from unittest.mock import AsyncMock, Mock, patch
+
+import pytest
+from home.file_cache import file_digest
+from home.ghostscript import GhostscriptPool
+from home.illustrations import PS2PDF_COMMAND
+from pypdf import PdfReader
+
+
+def fake_worker(*lines: str, exited: bool = False, drain=None) -> Mock:
+    stdout = asyncio.StreamReader()
+    for line in lines:
+        stdout.feed_data(f"{line}\n".encode())
+    if exited:
+        stdout.feed_eof()
+    return Mock(
+        stdin=Mock(drain=drain or AsyncMock()),
+        stdout=stdout,
+        returncode=None,
+        wait=AsyncMock(return_value=0),
+    )
+
+
+@pytest.fixture
+def pool(tmp_path):
+    return GhostscriptPool(1, tmp_path, logging.getLogger(__name__), io.StringIO())
+
+
+async def convert_all(pool, workers: list[Mock], count: int) -> list:
+    with patch.object(pool, "marker", "%%SPPNAUT-fake"), patch.object(
+        pool, "_start", AsyncMock(side_effect=workers)
+    ) as start:
+        async with pool:
+            results = await asyncio.gather(
+                *(
+                    pool.convert(
+                        pool.permitted_directory / f"{index}.eps",
+                        pool.permitted_directory / f"{index}.pdf",
+                    )
+                    for index in range(count)
+                ),
+                return_exceptions=True,
+            )
+    assert start.call_count == len(workers)
+    return results
+
+
+class TestGhostscriptPool:
+    async def test_reuses_worker(self, pool):
+        worker = fake_worker("%%SPPNAUT-fake ok", "%%SPPNAUT-fake ok")
+
+        assert await convert_all(pool, [worker], 2) == [None, None]
+        worker.wait.assert_awaited_once()
+
+    async def test_worker_exited_between_jobs(self, pool):
+        exited = fake_worker("%%SPPNAUT-fake ok", exited=True)
+        worker = fake_worker("%%SPPNAUT-fake ok")
+
+        assert await convert_all(pool, [exited, worker], 2) == [None, None]
+        exited.wait.assert_awaited_once()
+
+    async def test_broken_pipe(self, pool):
+        broken = fake_worker(drain=AsyncMock(side_effect=BrokenPipeError))
+        worker = fake_worker("%%SPPNAUT-fake ok")
+
+        assert await convert_all(pool, [broken, worker], 1) == [None]
+        broken.wait.assert_awaited_once()
+
+    def test_cache_salts(self, pool, tmp_path):
+        other_generation = GhostscriptPool(
+            1, tmp_path / "other", logging.getLogger(__name__), io.StringIO()
+        )
+        (tmp_path / "carte.eps").write_text("carte")
+
+        assert pool.cache_salts == other_generation.cache_salts
+        assert file_digest(tmp_path / "carte.eps", *pool.cache_salts) != file_digest(
+            tmp_path / "carte.eps", *PS2PDF_COMMAND
+        )
+
+    async def test_worker_exited_during_job(self, pool):
+        crashed = fake_worker(exited=True)
+        worker = fake_worker("%%SPPNAUT-fake ok")
+
+        failed, converted = await convert_all(pool, [crashed, worker], 2)
+
+        assert isinstance(failed, subprocess.CalledProcessError)
+        assert converted is None
+
+
+def write_eps(eps: Path, bounding_box: tuple[int, int, int, int]) -> None:
+    left, bottom, right, top = bounding_box
+    eps.write_text(
+        "%!PS-Adobe-3.0 EPSF-3.0\n"
+        f"%%BoundingBox: {left} {bottom} {right} {top}\n"
+        f"newpath {left} {bottom} moveto {right} {top} lineto stroke\n"
+        "showpage\n"
+    )
+
+
+@pytest.mark.skipif(
+    not (shutil.which("gs") and shutil.which("ps2pdf")), reason="Ghostscript needed"
+)
+class TestGhostscriptPoolOutput:
+    async def test_same_as_ps2pdf(self, tmp_path):
+        bounding_boxes = [(10, 20, 110, 70), (0, 0, 300, 500), (50, 50, 60, 400)]
+        eps_files = []
+        for index, bounding_box in enumerate(bounding_boxes):
+            write_eps(tmp_path / f"{index}.eps", bounding_box)
+            eps_files.append(tmp_path / f"{index}.eps")
+
+        # A single worker: the crop and the output file switch from one EPS to
+        # the next in the same interpreter
+        async with GhostscriptPool(
+            1, tmp_path, logging.getLogger(__name__), io.StringIO()
+        ) as pool:
+            await asyncio.gather(
+                *(pool.convert(eps, eps.with_suffix(".pool.pdf")) for eps in eps_files)
+            )
+        for eps in eps_files:
+            subprocess.run(
+                [*PS2PDF_COMMAND, eps, eps.with_suffix(".ps2pdf.pdf")],
+                check=True,
+            )
+
+        for eps, (left, bottom, right, top) in zip(eps_files, bounding_boxes):
+            pool_pdf = PdfReader(eps.with_suffix(".pool.pdf"))
+            ps2pdf_pdf = PdfReader(eps.with_suffix(".ps2pdf.pdf"))
+            assert pool_pdf.pdf_header == ps2pdf_pdf.pdf_header == "%PDF-1.4"
+            [pool_page], [ps2pdf_page] = pool_pdf.pages, ps2pdf_pdf.pages
+            assert pool_page.mediabox == ps2pdf_page.mediabox
+            assert pool_page.cropbox == ps2pdf_page.cropbox
+            assert (pool_page.mediabox.width, pool_page.mediabox.height) == (
+                right - left,
+                top - bottom,
+            )
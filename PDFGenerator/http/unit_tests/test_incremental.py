@@ -0,0 +1,30 @@
+import json
+
+from home.incremental import BuildManifest
+
+
+class TestBuildManifest:
+    def test_saved_once(self, tmp_path):
+        manifest = BuildManifest(tmp_path / "manifest.json")
+        manifest.record("illustrations/carte.eps", "stamp")
+        manifest.record("fo/pdf", "stamp")
+        manifest.invalidate("fo/pdf")
+
+        assert not manifest.file.exists()
+        manifest.save()
+        assert json.loads(manifest.file.read_text()) == {
+            "illustrations/carte.eps": "stamp"
+        }
+        assert BuildManifest(manifest.file).stamps == {
+            "illustrations/carte.eps": "stamp"
+        }
+
+    def test_not_saved(self, tmp_path):
+        manifest = BuildManifest(tmp_path / "manifest.json")
+        manifest.record("fo/pdf", "stamp")
+        manifest.save()
+
+        # Killed before saving: fo/pdf may have been invalidated and half run
+        BuildManifest(manifest.file).invalidate("fo/pdf")
+
+        assert BuildManifest(manifest.file).stamps == {}
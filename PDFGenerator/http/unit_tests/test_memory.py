@@ -0,0 +1,85 @@
+import asyncio
+import json
+import subprocess
+import sys
+
+from home.memory import GIB, MemoryBudget, PeakRss
+
+ALLOCATE = "import time; data = bytearray(200 * 1024 * 1024); time.sleep(1.5)"
+
+
+async def admit(budget: MemoryBudget, tool: str, ouvrage: str):
+    async with budget.admit_async(tool, ouvrage) as admission:
+        return admission
+
+
+class TestPeakRss:
+    def test_child_allocation(self):
+        with subprocess.Popen([sys.executable, "-c", ALLOCATE]) as process:
+            with PeakRss(process.pid, interval=0.1) as peak_rss:
+                process.wait()
+
+        assert peak_rss.peak > 200 * 1024 * 1024
+
+
+class TestMemoryBudget:
+    def test_footprint_from_history(self, tmp_path):
+        budget = MemoryBudget(str(tmp_path), 4 * GIB)
+        assert budget.footprint("ahformatter", "bpN") == 2 * GIB
+
+        for peak in [300, 100, 200, 400, 500, 600]:
+            budget.record("ahformatter", "bpN", peak)
+        budget.record("ahformatter", "bpS", 100)
+
+        # The first peak left the history
+        assert budget.footprint("ahformatter", "bpN") == 600
+        # Unknown ouvrages expect the median of the others
+        assert budget.footprint("ahformatter", "bpE") == 350
+        assert budget.footprint("java", "bpN") == GIB
+
+    async def test_queued_over_budget(self, tmp_path):
+        budget = MemoryBudget(str(tmp_path), 3 * GIB)
+        budget.record("ahformatter", "bpN", 2 * GIB)
+
+        async with budget.admit_async("ahformatter", "bpN") as first:
+            assert not first.queued
+            waiting = asyncio.create_task(admit(budget, "ahformatter", "bpN"))
+            await asyncio.sleep(1.5)
+            assert not waiting.done()
+            # A lighter run still fits beside it
+            async with budget.admit_async("java", "bpN") as java:
+                assert not java.queued
+
+        second = await waiting
+        assert second.queued
+        assert second.wait >= 1.5
+
+    def test_dead_reservations_released(self, tmp_path):
+        with subprocess.Popen(["true"]) as process:
+            process.wait()
+        (tmp_path / "memory_reservations.json").write_text(
+            json.dumps({"dead": [process.pid, 8 * GIB]})
+        )
+        budget = MemoryBudget(str(tmp_path), 4 * GIB)
+
+        with budget.admit("ahformatter", "bpN") as admission:
+            assert not admission.queued
+
+    def test_peak_recorded(self, tmp_path):
+        budget = MemoryBudget(str(tmp_path), 4 * GIB)
+
+        with budget.admit("java", "bpN") as admission:
+            with subprocess.Popen(
+                [sys.executable, "-c", ALLOCATE]
+            ) as process, admission.measure(process.pid):
+                process.wait()
+
+        assert budget.footprint("java", "bpN") == admission.peak > 0
+        assert json.loads((tmp_path / "memory_reservations.json").read_text()) == {}
+
+    def test_disabled(self, tmp_path):
+        with MemoryBudget("").admit("ahformatter", "bpN") as admission:
+            assert not admission.footprint
+        with MemoryBudget(str(tmp_path)).admit("gs", "bpN") as admission:
+            assert not admission.footprint
+        assert not list(tmp_path.iterdir())
@@ -1,9 +1,17 @@
+import fcntl
+import json
 import os
+import threading
+import time
 from datetime import datetime, timedelta
+from pathlib import Path
+from unittest.mock import patch
 from urllib.parse import parse_qs, urlparse
 
 import boto3
 import pytest
+import time_machine
+from home.fingerprint import input_fingerprint
 from home.s3 import (
     AWS_ACCESS_KEY_ID,
     AWS_SECRET_ACCESS_KEY,
@@ -13,16 +21,18 @@ from home.s3 import (
     S3_BUCKET_REFERENTIEL_PREPARATION,
     S3_BUCKET_REFERENTIEL_PRODUCTION,
     S3_ENDPOINT,
+    _s3_sync,
     bootstrap_assets,
-    get_generated_pdf_ouvrages,
+    get_ouvrage_fingerprints,
     get_presigned_url,
     list_generated_documents_by_ouvrages,
     list_ouvrages_en_preparation,
+    refresh_assets,
 )
+from home.s3_transfer import S3Transfers
+from home.slots import TOOL_SLOTS_RESERVED, HostSlots, ToolLimit
 from moto import mock_s3
 
-os.environ["MOTO_S3_CUSTOM_ENDPOINTS"] = S3_ENDPOINT
-
 BOTO_MAX_KEYS_DEFAULT = 1000
 
 
@@ -135,166 +145,377 @@ class TestListGeneratedDocumentsByOuvrages:
         assert ouvrages.keys() == {"g4"}
 
 
-class TestBootstrapAssets:
+class TestGetOuvrageFingerprints:
     @pytest.fixture
-    def fake_s3_copy_commun(self, fake_process):
-        fake_s3_endpoint = S3_ENDPOINT
-        fake_s3_commun_path = f"s3://{S3_BUCKET_REFERENTIEL_PRODUCTION}/commun"
-        return fake_process.register(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "sync",
-                "--delete",
-                "--endpoint-url",
-                fake_s3_endpoint,
-                fake_s3_commun_path,
-                HOME_GENERATION_PATH / "commun",
-            ],
-            stderr=["AWS sync commun"],
+    def s3_buckets(self, s3_resource):
+        referentiel = s3_resource.Bucket(S3_BUCKET_REFERENTIEL_PRODUCTION)
+        referentiel.create()
+        generated = s3_resource.Bucket(S3_BUCKET_GENERATED_PRODUCTION)
+        generated.create()
+        for key in [
+            "source/xsl/document.xsl",
+            "commun/illustrations/logo.eps",
+            "commun/illustrations/rose.eps",
+            "g4/xml/document.xml",
+            "g4/illustrations/carte.eps",
+            "11/xml/document.xml",
+        ]:
+            referentiel.put_object(Key=key, Body=key)
+        yield referentiel, generated
+
+    def current_fingerprint(self, referentiel, ouvrage, illustrations):
+        etags = {
+            s3_object.key: s3_object.e_tag for s3_object in referentiel.objects.all()
+        }
+        return input_fingerprint(
+            {
+                key.removeprefix(f"{ouvrage}/"): etag
+                for key, etag in etags.items()
+                if key.startswith(f"{ouvrage}/")
+            },
+            etags,
+            illustrations,
         )
 
-    @pytest.fixture
-    def fake_s3_copy_source(self, fake_process):
-        fake_s3_endpoint = S3_ENDPOINT
-        fake_s3_source_path = f"s3://{S3_BUCKET_REFERENTIEL_PRODUCTION}/source"
-        return fake_process.register(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "sync",
-                "--delete",
-                "--endpoint-url",
-                fake_s3_endpoint,
-                fake_s3_source_path,
-                HOME_GENERATION_PATH / "source",
-            ],
-            stderr=["AWS sync source"],
+    def test_basic(self, s3_buckets):
+        referentiel, generated = s3_buckets
+        generated.put_object(
+            Key="g4/fingerprint.json",
+            Body=json.dumps({"fingerprint": "generated", "illustrations": ["logo"]}),
         )
 
-    def test_downloads_if_no_file(
-        self, tmp_path, fake_s3_copy_commun, fake_s3_copy_source, fake_process
-    ):
-        COPYRIGHTED_SOURCES_FILES = {"foo_s3": tmp_path / "foo"}
+        assert get_ouvrage_fingerprints() == {
+            "g4": (
+                self.current_fingerprint(referentiel, "g4", ["logo"]),
+                "generated",
+            ),
+            "11": (self.current_fingerprint(referentiel, "11", []), None),
+        }
+
+    def test_referenced_illustrations(self, s3_buckets):
+        referentiel, generated = s3_buckets
+        generated.put_object(
+            Key="g4/fingerprint.json",
+            Body=json.dumps({"fingerprint": "generated", "illustrations": ["logo"]}),
+        )
+        before = get_ouvrage_fingerprints()["g4"][0]
 
-        fake_s3_endpoint = S3_ENDPOINT
-        fake_s3_source_path = f"s3://{S3_BUCKET_COPYRIGHTED_SOURCES}/foo_s3"
-        fake_copyrighted_assets = fake_process.register(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "cp",
-                "--endpoint-url",
-                fake_s3_endpoint,
-                fake_s3_source_path,
-                str(tmp_path / "foo"),
-            ]
+        referentiel.put_object(Key="commun/illustrations/rose.eps", Body="changed")
+        assert get_ouvrage_fingerprints()["g4"][0] == before
+        # Same content, same ETag
+        referentiel.put_object(Key="g4/xml/document.xml", Body="g4/xml/document.xml")
+        assert get_ouvrage_fingerprints()["g4"][0] == before
+
+        for key in [
+            "commun/illustrations/logo.eps",
+            "source/xsl/document.xsl",
+            "g4/illustrations/carte.eps",
+        ]:
+            referentiel.put_object(Key=key, Body="changed")
+            assert get_ouvrage_fingerprints()["g4"][0] != before
+            before = get_ouvrage_fingerprints()["g4"][0]
+
+    def test_ouvrage_version(self, s3_buckets):
+        referentiel, _ = s3_buckets
+        referentiel.put_object(Key="g4/VERSION", Body="1")
+        # As fingerprinted by the generation, from the downloaded objects
+        assert get_ouvrage_fingerprints()["g4"][0] == self.current_fingerprint(
+            referentiel, "g4", []
         )
+        before = get_ouvrage_fingerprints()["g4"][0]
+
+        with patch(
+            "home.s3.S3Transfers.etags", wraps=S3Transfers(S3_ENDPOINT).etags
+        ) as etags:
+            referentiel.put_object(Key="g4/illustrations/carte.eps", Body="changed")
+            assert get_ouvrage_fingerprints()["g4"][0] == before
+            referentiel.put_object(Key="g4/VERSION", Body="2")
+            assert get_ouvrage_fingerprints()["g4"][0] != before
+        listed = {call.args[0] for call in etags.call_args_list}
+        assert f"s3://{S3_BUCKET_REFERENTIEL_PRODUCTION}/g4" not in listed
+        assert f"s3://{S3_BUCKET_REFERENTIEL_PRODUCTION}/11" in listed
+
+    def test_only_ouvrage_documents(self, s3_resource):
+        referentiel = s3_resource.Bucket(S3_BUCKET_REFERENTIEL_PRODUCTION)
+        referentiel.create()
+        s3_resource.Bucket(S3_BUCKET_GENERATED_PRODUCTION).create()
+        for key in [
+            "VERSION",
+            "commun/illustrations/logo.eps",
+            # Shared folders aren't listed as ouvrages, whatever they contain
+            "commun/xml/document.xml",
+            "source/xml/document.xml",
+            "Fichiers_communs/xml/document.xml",
+            "11/tableau/xml/document.xml",
+            "11/illustrations/carte.eps",
+            "12/VERSION",
+        ]:
+            referentiel.put_object(Key=key, Body="")
 
-        bootstrap_assets(COPYRIGHTED_SOURCES_FILES, {})
+        assert get_ouvrage_fingerprints() == {}
+
+
+class TestBootstrapAssets:
+    @pytest.fixture
+    def home_generation_path(self, tmp_path):
+        with patch("home.s3.HOME_GENERATION_PATH", tmp_path / "generation"):
+            yield tmp_path / "generation"
+
+    @pytest.fixture
+    def current(self, home_generation_path):
+        return home_generation_path / "shom_assets" / "current"
+
+    @pytest.fixture
+    def s3_bucket_copyrighted_sources(self, s3_resource):
+        bucket = s3_resource.Bucket(S3_BUCKET_COPYRIGHTED_SOURCES)
+        bucket.create()
+        bucket.put_object(Key="foo_s3", Body="license")
+        bucket.put_object(Key="foo_s3/bar", Body="font")
+        yield bucket
+
+    @pytest.fixture
+    def s3_bucket_referentiel_production(self, s3_resource):
+        bucket = s3_resource.Bucket(S3_BUCKET_REFERENTIEL_PRODUCTION)
+        bucket.create()
+        bucket.put_object(Key="commun/illustrations/legende.txt", Body="legende")
+        bucket.put_object(Key="source/xsl/fo/document.xsl", Body="xsl")
+        yield bucket
+
+    @pytest.fixture(autouse=True)
+    def assert_shom_assets_synced(self, current, s3_bucket_referentiel_production):
+        yield
+        assert (
+            current / "commun" / "illustrations" / "legende.txt"
+        ).read_text() == "legende"
+        assert (current / "source" / "xsl" / "fo" / "document.xsl").read_text() == "xsl"
 
-        assert fake_s3_copy_commun.calls
-        assert fake_s3_copy_source.calls
+    def test_downloads_if_no_file(self, tmp_path, s3_bucket_copyrighted_sources):
+        COPYRIGHTED_SOURCES_FILES = {"foo_s3": tmp_path / "foo"}
+
+        bootstrap_assets(COPYRIGHTED_SOURCES_FILES, {})
 
-        assert fake_copyrighted_assets.calls
+        assert (tmp_path / "foo").read_text() == "license"
 
     def test_downloads_if_directory_empty(
-        self, tmp_path, fake_s3_copy_commun, fake_s3_copy_source, fake_process
+        self, tmp_path, s3_bucket_copyrighted_sources
     ):
         COPYRIGHTED_SOURCES_DIRECTORIES = {"foo_s3": tmp_path / "foo"}
 
         (tmp_path / "foo").mkdir()
 
-        fake_s3_endpoint = S3_ENDPOINT
-        fake_s3_source_path = f"s3://{S3_BUCKET_COPYRIGHTED_SOURCES}/foo_s3"
-        fake_copyrighted_assets = fake_process.register(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "cp",
-                "--recursive",
-                "--endpoint-url",
-                fake_s3_endpoint,
-                fake_s3_source_path,
-                str(tmp_path / "foo"),
-            ]
-        )
-
         bootstrap_assets({}, COPYRIGHTED_SOURCES_DIRECTORIES)
 
-        assert fake_s3_copy_commun.calls
-        assert fake_s3_copy_source.calls
+        assert (tmp_path / "foo" / "bar").read_text() == "font"
 
-        assert fake_copyrighted_assets.calls
-
-    def test_no_download_if_file_exists(
-        self, tmp_path, fake_s3_copy_commun, fake_s3_copy_source, fake_process
-    ):
+    def test_no_download_if_file_exists(self, tmp_path, s3_bucket_copyrighted_sources):
         COPYRIGHTED_SOURCES_FILES = {"foo_s3": tmp_path / "foo"}
 
-        (tmp_path / "foo").touch()
-
-        fake_s3_endpoint = S3_ENDPOINT
-        fake_s3_source_path = f"s3://{S3_BUCKET_COPYRIGHTED_SOURCES}/foo_s3"
-        fake_copyrighted_assets = fake_process.register(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "cp",
-                "--endpoint-url",
-                fake_s3_endpoint,
-                fake_s3_source_path,
-                str(tmp_path / "foo"),
-            ]
-        )
+        (tmp_path / "foo").write_text("local")
 
         bootstrap_assets(COPYRIGHTED_SOURCES_FILES, {})
 
-        assert fake_s3_copy_commun.calls
-        assert fake_s3_copy_source.calls
-
-        assert len(fake_copyrighted_assets.calls) == 0
+        assert (tmp_path / "foo").read_text() == "local"
 
     def test_no_download_if_directory_not_empty(
-        self, tmp_path, fake_s3_copy_commun, fake_s3_copy_source, fake_process
+        self, tmp_path, s3_bucket_copyrighted_sources
     ):
         COPYRIGHTED_SOURCES_DIRECTORIES = {"foo_s3": tmp_path / "foo"}
 
         (tmp_path / "foo").mkdir()
         (tmp_path / "foo" / "bar").touch()
 
-        fake_s3_endpoint = S3_ENDPOINT
-        fake_s3_source_path = f"s3://{S3_BUCKET_COPYRIGHTED_SOURCES}/foo_s3"
-        fake_copyrighted_assets = fake_process.register(
-            [
-                "python",
-                "-m",
-                "awscli",
-                "s3",
-                "cp",
-                "--endpoint-url",
-                fake_s3_endpoint,
-                fake_s3_source_path,
-                str(tmp_path / "foo"),
+        bootstrap_assets({}, COPYRIGHTED_SOURCES_DIRECTORIES)
+
+        assert (tmp_path / "foo" / "bar").read_text() == ""
+
+    def test_sync(self, current, s3_bucket_referentiel_production):
+        refresh_assets({}, {})
+        legende = current / "commun" / "illustrations" / "legende.txt"
+        synced_mtime = legende.stat().st_mtime
+        (current / "source" / "deleted.xsl").touch()
+
+        with patch("boto3.s3.transfer.TransferManager.download") as download:
+            refresh_assets({}, {})
+            assert not download.called
+
+        assert legende.stat().st_mtime == synced_mtime
+        assert not (current / "source" / "deleted.xsl").exists()
+
+        # Local changes are overwritten
+        (current / "source" / "xsl" / "fo" / "document.xsl").write_text("local")
+
+        refresh_assets({}, {})
+
+    def test_skipped_for_same_version(
+        self, home_generation_path, s3_bucket_referentiel_production
+    ):
+        s3_bucket_referentiel_production.put_object(Key="VERSION", Body="1")
+        refresh_assets({}, {})
+
+        with patch("home.s3._s3_sync", autospec=True) as s3_sync:
+            refresh_assets({}, {})
+            assert not s3_sync.called
+
+            s3_bucket_referentiel_production.put_object(Key="VERSION", Body="2")
+            refresh_assets({}, {})
+            assert s3_sync.call_count == 2
+
+    def test_skipped_within_ttl_without_version(self, home_generation_path):
+        with patch("home.s3.SHOM_ASSETS_TTL", 60):
+            refresh_assets({}, {})
+
+            with patch("home.s3._s3_sync", autospec=True) as s3_sync:
+                refresh_assets({}, {})
+                assert not s3_sync.called
+
+                with time_machine.travel(datetime.now() + timedelta(minutes=2)):
+                    refresh_assets({}, {})
+                assert s3_sync.call_count == 2
+
+    def test_generations_read_the_current_version(
+        self, current, s3_bucket_referentiel_production
+    ):
+        first_version = bootstrap_assets({}, {})
+        assert first_version == current.resolve()
+
+        s3_bucket_referentiel_production.put_object(
+            Key="source/xsl/fo/added.xsl", Body="xsl"
+        )
+        with patch("home.s3._s3_sync", autospec=True) as s3_sync:
+            assert bootstrap_assets({}, {}) == first_version
+            assert not s3_sync.called
+
+        refresh_assets({}, {})
+
+        assert bootstrap_assets({}, {}) != first_version
+        assert (current / "source" / "xsl" / "fo" / "added.xsl").exists()
+        # Left unchanged for the generations started before the switch
+        assert not (first_version / "source" / "xsl" / "fo" / "added.xsl").exists()
+
+    def test_removes_superseded_versions(
+        self, home_generation_path, current, s3_bucket_referentiel_production
+    ):
+        with patch("home.s3.SHOM_ASSETS_RETENTION", 60):
+            first_version = bootstrap_assets({}, {})
+            refresh_assets({}, {})
+            second_version = current.resolve()
+
+            with time_machine.travel(datetime.now() + timedelta(minutes=2)):
+                refresh_assets({}, {})
+
+        assert not first_version.exists()
+        assert second_version.exists()
+        assert sorted(
+            path.name for path in (home_generation_path / "shom_assets").iterdir()
+        ) == sorted(["current", second_version.name, current.resolve().name])
+
+    def test_single_sync_for_concurrent_generations(self, home_generation_path):
+        def slow_sync(*args):
+            time.sleep(0.2)
+            return _s3_sync(*args)
+
+        with patch("home.s3._s3_sync", side_effect=slow_sync) as s3_sync:
+            generations = [
+                threading.Thread(target=bootstrap_assets, args=({}, {}))
+                for _ in range(3)
             ]
+            for generation in generations:
+                generation.start()
+            for generation in generations:
+                generation.join()
+
+        # The waiting generations reused the sync of the first one
+        assert s3_sync.call_count == 2
+
+
+class TestBootstrapConvertedCommun:
+    @pytest.fixture
+    def home_generation_path(self, tmp_path):
+        with patch("home.s3.HOME_GENERATION_PATH", tmp_path):
+            yield tmp_path
+
+    @pytest.fixture
+    def s3_bucket_referentiel_production(self, s3_resource):
+        bucket = s3_resource.Bucket(S3_BUCKET_REFERENTIEL_PRODUCTION)
+        bucket.create()
+        yield bucket
+
+    @pytest.fixture
+    def fake_ps2pdf(self, fake_process):
+        return fake_process.register(
+            ["ps2pdf", fake_process.any()],
+            occurrences=5,
+            callback=lambda process: Path(process.args[-1]).write_text("pdf"),
         )
 
-        bootstrap_assets({}, COPYRIGHTED_SOURCES_DIRECTORIES)
+    def test_converts_only_changed_files(
+        self, home_generation_path, s3_bucket_referentiel_production, fake_ps2pdf
+    ):
+        converted = (
+            home_generation_path / "shom_assets" / "current" / "commun_converti"
+        ) / "illustrations"
+        for key, body in [
+            ("commun/illustrations/eps/kept.eps", "kept"),
+            ("commun/illustrations/eps/deleted.eps", "deleted"),
+            ("commun/illustrations/legende.txt", "legende"),
+        ]:
+            s3_bucket_referentiel_production.put_object(Key=key, Body=body)
+
+        refresh_assets({}, {})
+
+        assert fake_ps2pdf.call_count() == 2
+        assert (converted / "eps" / "kept.eps").read_text() == "kept"
+        assert (converted / "pdf" / "kept.pdf").exists()
+        assert (converted / "pdf" / "deleted.pdf").exists()
+        assert (converted / "legende.txt").read_text() == "legende"
+
+        s3_bucket_referentiel_production.Object(
+            "commun/illustrations/eps/deleted.eps"
+        ).delete()
+        s3_bucket_referentiel_production.put_object(
+            Key="commun/illustrations/eps/added.eps", Body="added"
+        )
+
+        refresh_assets({}, {})
+
+        assert fake_ps2pdf.call_count() == 3
+        *_, eps_path, pdf_path = fake_ps2pdf.calls[-1].args
+        assert eps_path == str(converted.resolve() / "eps" / "added.eps")
+        assert pdf_path == str(converted.resolve() / "pdf" / "added.pdf")
+        assert not (converted / "eps" / "deleted.eps").exists()
+        assert not (converted / "pdf" / "deleted.pdf").exists()
+        assert (converted / "pdf" / "kept.pdf").exists()
+
+    def test_conversions_take_host_slots(
+        self,
+        tmp_path,
+        home_generation_path,
+        s3_bucket_referentiel_production,
+        fake_process,
+    ):
+        slots = HostSlots(str(tmp_path / "slots"), 2, {"ps2pdf": ToolLimit(1)})
+        locked = []
+
+        def convert(process):
+            fd = os.open(tmp_path / "slots" / "ps2pdf.0.lock", os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                locked.append(process.args[-1])
+            finally:
+                os.close(fd)
+            Path(process.args[-1]).write_text("pdf")
+
+        s3_bucket_referentiel_production.put_object(
+            Key="commun/illustrations/eps/carte.eps", Body="carte"
+        )
 
-        assert fake_s3_copy_commun.calls
-        assert fake_s3_copy_source.calls
+        fake_process.register(["ps2pdf", fake_process.any()], callback=convert)
+        with patch("home.s3.HostSlots", return_value=slots) as host_slots:
+            refresh_assets({}, {})
 
-        assert len(fake_copyrighted_assets.calls) == 0
+        host_slots.assert_called_once_with(reserved=TOOL_SLOTS_RESERVED)
+        assert [Path(pdf).name for pdf in locked] == ["carte.pdf"]
 
 
 class TestGetPresignedUrl:
@@ -0,0 +1,88 @@
+from unittest.mock import patch
+
+import boto3
+import pytest
+from home.file_cache import FileCache
+from home.s3_transfer import S3Transfers, split_s3_uri
+from moto import mock_s3
+
+ENDPOINT = "https://fake-s3-endpoint"
+
+
+@pytest.fixture
+def bucket():
+    with mock_s3():
+        bucket = boto3.resource("s3", endpoint_url=ENDPOINT).Bucket("referentiel")
+        bucket.create()
+        bucket.put_object(Key="g4/xml/document.xml", Body="<document/>")
+        bucket.put_object(Key="g4/illustrations/eps/carte.eps", Body="eps")
+        bucket.put_object(Key="g4bis/xml/document.xml", Body="")
+        yield bucket
+
+
+def test_split_s3_uri():
+    assert split_s3_uri("s3://referentiel/g4/xml") == ("referentiel", "g4/xml")
+    assert split_s3_uri("s3://referentiel") == ("referentiel", "")
+
+
+class TestDownloadFolder:
+    def test_download(self, tmp_path, bucket):
+        etags = S3Transfers(ENDPOINT).download_folder("s3://referentiel/g4", tmp_path)
+
+        assert etags == {
+            "illustrations/eps/carte.eps": bucket.Object(
+                "g4/illustrations/eps/carte.eps"
+            ).e_tag,
+            "xml/document.xml": bucket.Object("g4/xml/document.xml").e_tag,
+        }
+
+        assert sorted(
+            file.relative_to(tmp_path).as_posix()
+            for file in tmp_path.rglob("*")
+            if file.is_file()
+        ) == ["illustrations/eps/carte.eps", "xml/document.xml"]
+        assert (tmp_path / "xml" / "document.xml").read_text() == "<document/>"
+
+    def test_cache(self, tmp_path, bucket):
+        cache = FileCache(tmp_path / "s3_cache", 1024)
+        transfers = S3Transfers(ENDPOINT)
+        transfers.download_folder("s3://referentiel/g4", tmp_path / "first", cache)
+        assert (cache.hits, cache.misses) == (0, 2)
+
+        with patch("boto3.s3.transfer.TransferManager.download") as download:
+            transfers.download_folder("s3://referentiel/g4", tmp_path / "second", cache)
+            assert not download.called
+        assert (cache.hits, cache.misses) == (2, 2)
+        document = tmp_path / "second" / "xml" / "document.xml"
+        assert document.read_text() == "<document/>"
+        assert not document.samefile(tmp_path / "first" / "xml" / "document.xml")
+
+        bucket.put_object(Key="g4/xml/document.xml", Body="<document>2</document>")
+        transfers.download_folder("s3://referentiel/g4", tmp_path / "third", cache)
+
+        assert (cache.hits, cache.misses) == (3, 3)
+        assert (
+            tmp_path / "third" / "xml" / "document.xml"
+        ).read_text() == "<document>2</document>"
+        # Linked files of the previous generations are left untouched
+        assert document.read_text() == "<document/>"
+
+
+def test_upload_files(tmp_path, bucket):
+    (tmp_path / "document.pdf").write_text("pdf")
+    (tmp_path / "stderr.log").write_text("log")
+
+    S3Transfers(ENDPOINT).upload_files(
+        {
+            tmp_path / "document.pdf": "s3://referentiel/generated/document.pdf",
+            tmp_path / "stderr.log": "s3://referentiel/generated/stderr.log",
+        }
+    )
+
+    assert bucket.Object("generated/document.pdf").get()["Body"].read() == b"pdf"
+    assert {
+        s3_object.key for s3_object in bucket.objects.filter(Prefix="generated")
+    } == {
+        "generated/document.pdf",
+        "generated/stderr.log",
+    }
@@ -0,0 +1,271 @@
+import io
+import shutil
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from home.saxon import (
+    SAXON_JAR,
+    SaxonService,
+    Transform,
+    associated_stylesheet,
+    stylesheet_digest,
+    stylesheet_key,
+)
+
+XSL = (
+    '<xsl:stylesheet version="2.0" '
+    'xmlns:xsl="http://www.w3.org/1999/XSL/Transform">%s</xsl:stylesheet>'
+)
+
+
+@pytest.fixture
+def fake_saxon_service():
+    """Answers every request with the lines of `server.response`."""
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = []
+            while line := self.rfile.readline().decode().rstrip("\n"):
+                request.append(line)
+            self.server.requests.append(request)
+            self.wfile.write(self.server.response.encode())
+
+    with socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler) as server:
+        server.requests = []
+        server.response = "OK\n"
+        server.address = "127.0.0.1:%s" % server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server
+        server.shutdown()
+
+
+class TestAssociatedStylesheet:
+    def test_processing_instruction(self, tmp_path):
+        (tmp_path / "xml").mkdir()
+        (tmp_path / "xml" / "document.xml").write_text(
+            '<?xml version="1.0"?>\n'
+            '<?xml-stylesheet type="text/xsl" href="../xsl/fo/Ouvrage.xsl"?>\n'
+            "<document/>"
+        )
+
+        assert associated_stylesheet(tmp_path / "xml" / "document.xml") == (
+            tmp_path / "xsl" / "fo" / "Ouvrage.xsl"
+        )
+
+    def test_missing(self, tmp_path):
+        (tmp_path / "document.xml").write_text("<document/>")
+
+        with pytest.raises(ValueError):
+            associated_stylesheet(tmp_path / "document.xml")
+
+
+class TestStylesheetDigest:
+    def test_imports(self, tmp_path):
+        for generation in ["first", "second"]:
+            xsl_folder = tmp_path / generation / "xsl"
+            (xsl_folder / "commun").mkdir(parents=True)
+            (xsl_folder / "fo.xsl").write_text(
+                XSL % '<xsl:import href="commun/styles.xsl"/>'
+            )
+            (xsl_folder / "commun" / "styles.xsl").write_text(
+                XSL % '<xsl:include href="../fo.xsl"/>'
+            )
+
+        first_digest = stylesheet_digest(tmp_path / "first" / "xsl" / "fo.xsl")
+        assert first_digest == stylesheet_digest(tmp_path / "second" / "xsl" / "fo.xsl")
+
+        (tmp_path / "second" / "xsl" / "commun" / "styles.xsl").write_text(XSL % "")
+        assert first_digest != stylesheet_digest(tmp_path / "second" / "xsl" / "fo.xsl")
+
+    def test_key_by_location(self, tmp_path):
+        for generation in ["first", "second"]:
+            (tmp_path / generation).mkdir()
+            (tmp_path / generation / "fo.xsl").write_text(XSL % "")
+
+        # Relative URIs resolve against the folder of the compiled stylesheet
+        assert stylesheet_key(tmp_path / "first" / "fo.xsl") != stylesheet_key(
+            tmp_path / "second" / "fo.xsl"
+        )
+        assert stylesheet_key(tmp_path / "first" / "fo.xsl") == stylesheet_key(
+            tmp_path / "second" / ".." / "first" / "fo.xsl"
+        )
+
+
+class TestSaxonService:
+    @pytest.fixture
+    def tmp_path(self, tmp_path):
+        (tmp_path / "ISO_OuvNaut.xsl").write_text(XSL % "")
+        return tmp_path
+
+    def test_transform(self, tmp_path, fake_saxon_service):
+        fake_saxon_service.response = "MESSAGE\tWarning: ambiguous rule\nOK\n"
+        log_file = io.StringIO()
+
+        assert SaxonService(fake_saxon_service.address).transform(
+            tmp_path / "document.xml",
+            tmp_path / "ISO_OuvNaut.xsl",
+            tmp_path / "metadonnees.xml",
+            parameters={"pagination": "false"},
+            warnings="recover",
+            log_file=log_file,
+        )
+
+        assert fake_saxon_service.requests == [
+            [
+                f"SOURCE\t{tmp_path / 'document.xml'}",
+                "\t".join(
+                    [
+                        "TRANSFORM",
+                        str(tmp_path / "ISO_OuvNaut.xsl"),
+                        stylesheet_key(tmp_path / "ISO_OuvNaut.xsl"),
+                        str(tmp_path / "metadonnees.xml"),
+                        "recover",
+                        "pagination=false",
+                    ]
+                ),
+            ]
+        ]
+        assert log_file.getvalue() == "Warning: ambiguous rule\n"
+
+    def test_transform_from_linked_folder(self, tmp_path, fake_saxon_service):
+        (tmp_path / "shared" / "xsl").mkdir(parents=True)
+        (tmp_path / "shared" / "xsl" / "fo.xsl").write_text(XSL % "")
+        shutil.copytree(tmp_path / "shared", tmp_path / "generation" / "source")
+
+        SaxonService(
+            fake_saxon_service.address,
+            linked_folders={tmp_path / "generation" / "source": tmp_path / "shared"},
+        ).transform(
+            tmp_path / "document.xml",
+            tmp_path / "generation" / "source" / "xsl" / "fo.xsl",
+        )
+
+        assert fake_saxon_service.requests[0][1].split("\t")[1] == str(
+            tmp_path / "shared" / "xsl" / "fo.xsl"
+        )
+
+    def test_transform_all(self, tmp_path, fake_saxon_service):
+        (tmp_path / "Calmar_A_Facon.xsl").write_text(XSL % "")
+
+        assert SaxonService(fake_saxon_service.address).transform_all(
+            tmp_path / "document.xml",
+            [
+                Transform(tmp_path / "Calmar_A_Facon.xsl"),
+                Transform(tmp_path / "ISO_OuvNaut.xsl", tmp_path / "metadonnees.xml"),
+            ],
+        )
+
+        [request] = fake_saxon_service.requests
+        assert [line.split("\t")[:2] for line in request] == [
+            ["SOURCE", str(tmp_path / "document.xml")],
+            ["TRANSFORM", str(tmp_path / "Calmar_A_Facon.xsl")],
+            ["TRANSFORM", str(tmp_path / "ISO_OuvNaut.xsl")],
+        ]
+
+    def test_transform_error(self, tmp_path, fake_saxon_service):
+        fake_saxon_service.response = "ERROR\tXTDE0050: no source\nERROR\tline 2\n"
+
+        with pytest.raises(subprocess.CalledProcessError) as error:
+            SaxonService(fake_saxon_service.address).transform(
+                tmp_path / "document.xml", tmp_path / "ISO_OuvNaut.xsl"
+            )
+        assert error.value.stderr == "XTDE0050: no source\nline 2"
+
+    def test_not_available(self, tmp_path, unused_tcp_port):
+        assert not SaxonService(f"127.0.0.1:{unused_tcp_port}").transform(
+            tmp_path / "document.xml", tmp_path / "ISO_OuvNaut.xsl"
+        )
+        assert not SaxonService("").transform(
+            tmp_path / "document.xml", tmp_path / "ISO_OuvNaut.xsl"
+        )
+
+
+@pytest.fixture(scope="class")
+def saxon_service(tmp_path_factory):
+    """SaxonService.java, compiled and started on a free port."""
+    classes = tmp_path_factory.mktemp("classes")
+    subprocess.run(
+        [
+            "javac",
+            "-cp",
+            str(SAXON_JAR),
+            "-d",
+            str(classes),
+            str(Path(__file__).parents[2] / "saxon-service" / "SaxonService.java"),
+        ],
+        check=True,
+    )
+    with socket.socket() as free_port:
+        free_port.bind(("127.0.0.1", 0))
+        address = "127.0.0.1:%s" % free_port.getsockname()[1]
+    with subprocess.Popen(
+        ["java", "-cp", f"{SAXON_JAR}:{classes}", "SaxonService", address, "1"]
+    ) as service:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(address.split(":"), 1).close()
+                break
+            except OSError:
+                if service.poll() is not None or time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        yield address
+        service.terminate()
+
+
+@pytest.mark.skipif(
+    not (shutil.which("javac") and shutil.which("java") and SAXON_JAR.exists()),
+    reason="JDK and saxon9.jar needed",
+)
+class TestSaxonServiceJava:
+    def test_transform_all(self, tmp_path, saxon_service):
+        (tmp_path / "document.xml").write_text("<document><titre>G4</titre></document>")
+        (tmp_path / "titre.xsl").write_text(
+            XSL
+            % (
+                '<xsl:param name="prefixe"/>'
+                '<xsl:template match="/">'
+                "<xsl:message>titre</xsl:message>"
+                '<titre><xsl:value-of select="concat($prefixe, //titre)"/></titre>'
+                "</xsl:template>"
+            )
+        )
+        log_file = io.StringIO()
+
+        assert SaxonService(saxon_service).transform_all(
+            tmp_path / "document.xml",
+            [
+                Transform(
+                    tmp_path / "titre.xsl",
+                    tmp_path / f"titre{index}.xml",
+                    {"prefixe": f"{index}-"},
+                )
+                for index in range(2)
+            ],
+            log_file,
+        )
+
+        for index in range(2):
+            assert (
+                f"<titre>{index}-G4</titre>"
+                in (tmp_path / f"titre{index}.xml").read_text()
+            )
+        assert log_file.getvalue().count("titre") == 2
+
+    def test_transform_error(self, tmp_path, saxon_service):
+        (tmp_path / "erreur.xsl").write_text(
+            XSL
+            % '<xsl:template match="/"><xsl:value-of select="error()"/></xsl:template>'
+        )
+
+        with pytest.raises(subprocess.CalledProcessError):
+            SaxonService(saxon_service).transform(
+                tmp_path / "absent.xml", tmp_path / "erreur.xsl"
+            )
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+
+from home.slots import HostSlots, ToolLimit, tool_limits, tool_of
+
+
+async def wait_for_slot(slots: HostSlots, tool: str):
+    async with slots.acquire_async(tool) as slot:
+        return slot
+
+
+class TestToolLimits:
+    def test_overrides(self):
+        limits = tool_limits(["ahformatter:3:4", "gs:2"])
+
+        assert limits["ahformatter"] == ToolLimit(3, 4)
+        assert limits["gs"] == ToolLimit(2, 1)
+        assert "java" in limits
+
+    def test_tool_of(self):
+        assert tool_of(["/usr/AHFormatterV6_64/run.sh", "-d"]) == "ahformatter"
+        assert tool_of(["gs", "-sDEVICE=pdfwrite"]) == "gs"
+        assert tool_of(["python", "-m", "awscli"]) is None
+
+
+class TestHostSlots:
+    async def test_tool_limit(self, tmp_path):
+        limits = {"gs": ToolLimit(1)}
+        first = HostSlots(str(tmp_path), 4, limits)
+        second = HostSlots(str(tmp_path), 4, limits)
+
+        async with first.acquire_async("gs") as slot:
+            assert not slot.queued
+            waiting = asyncio.create_task(wait_for_slot(second, "gs"))
+            await asyncio.sleep(0.3)
+            assert not waiting.done()
+
+        slot = await waiting
+        assert slot.queued
+        assert slot.wait >= 0.3
+        assert second.waits == {"gs": slot.wait}
+        assert first.waits == {}
+
+    async def test_weight(self, tmp_path):
+        limits = {"ahformatter": ToolLimit(2, weight=2), "gs": ToolLimit(4)}
+        first = HostSlots(str(tmp_path), 2, limits)
+        second = HostSlots(str(tmp_path), 2, limits)
+
+        async with first.acquire_async("ahformatter"):
+            waiting = asyncio.create_task(wait_for_slot(second, "gs"))
+            await asyncio.sleep(0.3)
+            assert not waiting.done()
+
+        assert (await waiting).queued
+
+    async def test_first_waiter(self, tmp_path):
+        limits = {"ahformatter": ToolLimit(2, weight=2), "gs": ToolLimit(4)}
+        running = HostSlots(str(tmp_path), 2, limits)
+        heavy = HostSlots(str(tmp_path), 2, limits)
+        light = HostSlots(str(tmp_path), 2, limits)
+
+        async with running.acquire_async("gs"):
+            waiting_heavy = asyncio.create_task(wait_for_slot(heavy, "ahformatter"))
+            await asyncio.sleep(0.3)
+            # The other slot of the host is kept for the first waiter
+            waiting_light = asyncio.create_task(wait_for_slot(light, "gs"))
+            await asyncio.sleep(0.3)
+            assert not waiting_heavy.done()
+            assert not waiting_light.done()
+
+        assert (await waiting_heavy).queued
+        assert (await waiting_light).queued
+
+    def test_acquire_in_threads(self, tmp_path):
+        limits = {"java": ToolLimit(1)}
+        first = HostSlots(str(tmp_path), 4, limits)
+        second = HostSlots(str(tmp_path), 4, limits)
+        slots = []
+
+        def run_java():
+            with second.acquire("java") as slot:
+                slots.append(slot)
+
+        with first.acquire("java"):
+            thread = threading.Thread(target=run_java)
+            thread.start()
+            thread.join(0.3)
+            assert not slots
+        thread.join()
+
+        assert slots[0].queued
+
+    async def test_reserved(self, tmp_path):
+        limits = {"gs": ToolLimit(2)}
+        batch = HostSlots(str(tmp_path), 4, limits, reserved=1)
+        other_batch = HostSlots(str(tmp_path), 4, limits, reserved=1)
+        interactive = HostSlots(str(tmp_path), 4, limits)
+
+        async with batch.acquire_async("gs"):
+            waiting = asyncio.create_task(wait_for_slot(other_batch, "gs"))
+            slot = await wait_for_slot(interactive, "gs")
+            assert not slot.queued
+            await asyncio.sleep(0.3)
+            assert not waiting.done()
+
+        assert (await waiting).queued
+
+    def test_disabled(self, tmp_path):
+        with HostSlots("").acquire("gs") as slot:
+            assert not slot.queued
+        with HostSlots(str(tmp_path)).acquire(None) as slot:
+            assert not slot.queued
+        assert not list(tmp_path.iterdir())
@@ -1,11 +1,14 @@
+import json
 import os
 from unittest import mock
 from unittest.mock import DEFAULT, patch
 
 import boto3
 import pytest
-import time_machine
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from home.fingerprint import input_fingerprint
+from home.models import OuvrageVersion
 from home.s3 import (
     AWS_ACCESS_KEY_ID,
     AWS_SECRET_ACCESS_KEY,
@@ -14,14 +17,15 @@ from home.s3 import (
     S3_ENDPOINT,
 )
 from home.tasks import (
+    _generation_optimizations,
     generate_all_updated_ouvrage_from_production,
+    generate_publication,
     generate_publication_from_referentiel,
+    refresh_assets_from_production,
 )
 from moto import mock_s3
 from workers import procrastinate_app
 
-os.environ["MOTO_S3_CUSTOM_ENDPOINTS"] = S3_ENDPOINT
-
 
 @pytest.fixture
 def mock_home_generation_path(tmp_path):
@@ -54,6 +58,8 @@ class TestGeneratePublicationFromReferentiel:
                 vignette=True,
                 metadata=True,
                 cleanup=True,
+                batch=True,
+                single_parse=True,
             )
 
     async def test_new_folder_for_each_generation(
@@ -80,6 +86,41 @@ class TestGeneratePublicationFromReferentiel:
                 assert list(dir.iterdir()) == [dir / "g4"]
 
 
+class TestGenerationOptimizations:
+    def test_valid(self):
+        assert _generation_optimizations(["single_parse", "gs_pool"]) == {
+            "single_parse": True,
+            "gs_pool": True,
+        }
+
+    @pytest.mark.parametrize("option", ["single_pass", "compress", "s3_endpoint"])
+    def test_invalid(self, option):
+        with pytest.raises(ImproperlyConfigured, match=f"{option}, valid options"):
+            _generation_optimizations(["single_parse", option])
+
+
+class TestGeneratePublication:
+    async def test_optimizations(self, tmp_path):
+        with patch("home.tasks.generate", autospec=True) as generate_mock, patch.dict(
+            "home.tasks.GENERATION_OPTIMIZATIONS", {"single_parse": True}, clear=True
+        ):
+            await generate_publication(
+                publication_path=str(tmp_path / "g4"),
+                s3_endpoint="https://endpoint.fake",
+                s3_inputs_bucket="bucket_fake",
+                incremental=True,
+            )
+
+        generate_mock.assert_awaited_once_with(
+            tmp_path / "g4",
+            s3_endpoint="https://endpoint.fake",
+            s3_inputs_bucket="bucket_fake",
+            incremental=True,
+            single_parse=True,
+        )
+
+
+@pytest.mark.django_db(transaction=True)
 class TestGenerateAllUpdatedOuvrageFromProduction:
     @pytest.fixture
     def s3_resource(self):
@@ -108,6 +149,27 @@ class TestGenerateAllUpdatedOuvrageFromProduction:
         bucket.create()
         yield bucket
 
+    def generated(self, s3_bucket_referentiel_production, ouvrage, illustrations=()):
+        """Fingerprint of the document generated from the current inputs."""
+        etags = {
+            s3_object.key: s3_object.e_tag
+            for s3_object in s3_bucket_referentiel_production.objects.all()
+        }
+        return json.dumps(
+            {
+                "fingerprint": input_fingerprint(
+                    {
+                        key.removeprefix(f"{ouvrage}/"): etag
+                        for key, etag in etags.items()
+                        if key.startswith(f"{ouvrage}/")
+                    },
+                    etags,
+                    illustrations,
+                ),
+                "illustrations": list(illustrations),
+            }
+        )
+
     async def test_empty(
         self,
         s3_bucket_generated_production,
@@ -123,27 +185,27 @@ class TestGenerateAllUpdatedOuvrageFromProduction:
         s3_bucket_referentiel_production,
         procrastinate,
     ):
-        with time_machine.travel("2022-01-01 11:00 +0000", tick=False) as traveller:
-            s3_bucket_referentiel_production.put_object(
-                Key="g4/xml/document.xml", Body=""
-            )
-            s3_bucket_generated_production.put_object(Key="g4/document.pdf", Body="")
-            s3_bucket_generated_production.put_object(Key="11/document.pdf", Body="")
-            s3_bucket_generated_production.put_object(Key="12/document.pdf", Body="")
-
-            traveller.shift(60)
+        for ouvrage in ["g4", "11", "12"]:
             s3_bucket_referentiel_production.put_object(
-                Key="11/xml/document.xml", Body=""
+                Key=f"{ouvrage}/xml/document.xml", Body=ouvrage
             )
-            s3_bucket_referentiel_production.put_object(
-                Key="12/xml/document.xml", Body=""
+            s3_bucket_generated_production.put_object(
+                Key=f"{ouvrage}/fingerprint.json",
+                Body=self.generated(s3_bucket_referentiel_production, ouvrage),
             )
+        s3_bucket_referentiel_production.put_object(
+            Key="11/xml/document.xml", Body="changed"
+        )
+        s3_bucket_referentiel_production.put_object(
+            Key="12/illustrations/carte.eps", Body=""
+        )
 
         await generate_all_updated_ouvrage_from_production(0)
         queued_jobs = list(procrastinate.jobs.values())
 
         for job in queued_jobs:
             assert job["task_name"] == "generate_publication_from_referentiel"
+            assert job["queue_name"] == "batch"
             assert job["status"] == "todo"
 
         assert {tuple(job["args"].items()) for job in queued_jobs} == {
@@ -181,13 +243,14 @@ class TestGenerateAllUpdatedOuvrageFromProduction:
             ),
         }
 
-    async def test_no_pdf(
+    async def test_no_fingerprint(
         self,
         s3_bucket_generated_production,
         s3_bucket_referentiel_production,
         procrastinate,
     ):
         s3_bucket_referentiel_production.put_object(Key="11/xml/document.xml", Body="")
+        s3_bucket_generated_production.put_object(Key="11/document.pdf", Body="")
 
         await generate_all_updated_ouvrage_from_production(0)
         queued_jobs = list(procrastinate.jobs.values())
@@ -213,24 +276,100 @@ class TestGenerateAllUpdatedOuvrageFromProduction:
         await generate_all_updated_ouvrage_from_production(0)
         assert procrastinate.jobs == {}
 
-    async def test_multiple_xml(
+    async def test_unchanged_reupload(
+        self,
+        s3_bucket_generated_production,
+        s3_bucket_referentiel_production,
+        procrastinate,
+    ):
+        s3_bucket_referentiel_production.put_object(
+            Key="11/xml/document.xml", Body="<document/>"
+        )
+        s3_bucket_generated_production.put_object(
+            Key="11/fingerprint.json",
+            Body=self.generated(s3_bucket_referentiel_production, "11"),
+        )
+        s3_bucket_referentiel_production.put_object(
+            Key="11/xml/document.xml", Body="<document/>"
+        )
+
+        await generate_all_updated_ouvrage_from_production(0)
+        assert procrastinate.jobs == {}
+
+    async def test_shared_inputs(
         self,
         s3_bucket_generated_production,
         s3_bucket_referentiel_production,
         procrastinate,
     ):
-        with time_machine.travel("2022-01-01 11:00 +0000", tick=False) as traveller:
+        for key in [
+            "commun/illustrations/logo.eps",
+            "commun/illustrations/rose.eps",
+            "source/xsl/document.xsl",
+            "g4/xml/document.xml",
+            "11/xml/document.xml",
+        ]:
+            s3_bucket_referentiel_production.put_object(Key=key, Body=key)
+        s3_bucket_generated_production.put_object(
+            Key="g4/fingerprint.json",
+            Body=self.generated(s3_bucket_referentiel_production, "g4", ["logo"]),
+        )
+        s3_bucket_generated_production.put_object(
+            Key="11/fingerprint.json",
+            Body=self.generated(s3_bucket_referentiel_production, "11", ["rose"]),
+        )
+
+        s3_bucket_referentiel_production.put_object(
+            Key="commun/illustrations/logo.eps", Body="changed"
+        )
+        assert await generate_all_updated_ouvrage_from_production(0) == ["g4"]
+
+        procrastinate.reset()
+        s3_bucket_referentiel_production.put_object(
+            Key="source/xsl/document.xsl", Body="changed"
+        )
+        assert await generate_all_updated_ouvrage_from_production(0) == ["11", "g4"]
+
+    async def test_index(
+        self,
+        s3_bucket_generated_production,
+        s3_bucket_referentiel_production,
+        procrastinate,
+    ):
+        for ouvrage in ["g4", "11"]:
             s3_bucket_referentiel_production.put_object(
-                Key="11/tableau/xml/document.xml", Body=""
+                Key=f"{ouvrage}/xml/document.xml", Body=ouvrage
             )
-            s3_bucket_generated_production.put_object(Key="11/document.pdf", Body="")
+        s3_bucket_generated_production.put_object(
+            Key="g4/fingerprint.json",
+            Body=self.generated(s3_bucket_referentiel_production, "g4"),
+        )
 
-            traveller.shift(60)
-            s3_bucket_referentiel_production.put_object(
-                Key="11/xml/document.xml", Body=""
+        assert await generate_all_updated_ouvrage_from_production(0) == ["11"]
+        assert {
+            version.ouvrage: version.generated_fingerprint is None
+            async for version in OuvrageVersion.objects.all()
+        } == {"11": True, "g4": False}
+
+        s3_bucket_referentiel_production.delete_objects(
+            Delete={"Objects": [{"Key": "11/xml/document.xml"}]}
+        )
+        s3_bucket_referentiel_production.put_object(
+            Key="g4/xml/document.xml", Body="changed"
+        )
+
+        assert await generate_all_updated_ouvrage_from_production(0) == ["g4"]
+        assert [
+            ouvrage
+            async for ouvrage in OuvrageVersion.objects.values_list(
+                "ouvrage", flat=True
             )
+        ] == ["g4"]
 
-        await generate_all_updated_ouvrage_from_production(0)
-        queued_jobs = list(procrastinate.jobs.values())
 
-        assert len(queued_jobs) == 1
+class TestRefreshAssetsFromProduction:
+    async def test_basic(self):
+        with patch("home.tasks.refresh_assets", autospec=True) as refresh_assets_mock:
+            await refresh_assets_from_production(timestamp=0)
+
+        refresh_assets_mock.assert_called_once_with()
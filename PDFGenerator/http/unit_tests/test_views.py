@@ -1,7 +1,10 @@
+import io
 import logging
+import zipfile
 from base64 import b64encode
 
 import pytest
+from workers import procrastinate_app
 
 
 @pytest.fixture
@@ -15,6 +18,28 @@ def authorization_header(settings):
     ).decode("utf8")
 
 
+@pytest.fixture
+def procrastinate():
+    procrastinate_app.connector.reset()
+    return procrastinate_app.connector
+
+
+def generation_job(procrastinate, generation_id, status):
+    """Job of a generation, as deferred by the views."""
+    job_id = len(procrastinate.jobs) + 1
+    procrastinate.jobs[job_id] = {
+        "id": job_id,
+        "queue_name": "interactive",
+        "task_name": "generate_publication",
+        "lock": generation_id,
+        "queueing_lock": None,
+        "args": {},
+        "status": status,
+        "scheduled_at": None,
+        "attempts": 0,
+    }
+
+
 class TestGeneratePublicationFromUpload:
     def test_basic(
         self,
@@ -22,36 +47,32 @@ class TestGeneratePublicationFromUpload:
         settings,
         client,
         authorization_header,
-        fake_process,
+        procrastinate,
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
         (tmp_path / "fake_generation_id" / "g4p").mkdir(parents=True)
 
-        fake_generator = fake_process.register(
-            [
-                settings.BIN_DIR / "echo_returncode_in.py",
-                fake_process.any(min=1, max=1),
-                settings.BASE_DIR / "bin" / "generator.py",
-                tmp_path / "fake_generation_id" / "g4p",
-                "--s3_endpoint",
-                "https://cellar-fr-north-hds-c1.services.clever-cloud.com",
-                "--s3_inputs_bucket",
-                f"s3://sppnaut-referentiel-production",
-            ],
-        )
-
         response = client.post(
             "/publication/fake_generation_id/generate",
             HTTP_AUTHORIZATION=authorization_header,
         )
 
-        assert fake_generator.calls
-
         assert response.status_code == 202
+        [job] = procrastinate.jobs.values()
+        assert job["task_name"] == "generate_publication"
+        assert job["queue_name"] == "interactive"
+        assert job["status"] == "todo"
+        assert job["lock"] == "fake_generation_id"
+        assert job["args"] == {
+            "publication_path": str(tmp_path / "fake_generation_id" / "g4p"),
+            "s3_endpoint": "https://cellar-fr-north-hds-c1.services.clever-cloud.com",
+            "s3_inputs_bucket": "s3://sppnaut-referentiel-production",
+            "incremental": True,
+        }
 
     def test_multiple_ouvrages_in_generation(
-        self, tmp_path, settings, client, authorization_header
+        self, tmp_path, settings, client, authorization_header, procrastinate
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
@@ -63,38 +84,12 @@ class TestGeneratePublicationFromUpload:
             HTTP_AUTHORIZATION=authorization_header,
         )
         assert response.status_code == 400
+        assert procrastinate.jobs == {}
 
 
 class TestGenerateFromProduction:
-    @pytest.fixture
-    def fake_g4_generator(self, fake_process, settings):
-        return fake_process.register(
-            [
-                settings.BIN_DIR / "echo_returncode_in.py",
-                fake_process.any(min=1, max=1),
-                settings.BASE_DIR / "bin" / "generator.py",
-                fake_process.any(min=1, max=1),
-                "--s3_endpoint",
-                "https://cellar-fr-north-hds-c1.services.clever-cloud.com",
-                "--s3_inputs_bucket",
-                f"s3://sppnaut-referentiel-production",
-                "--s3_source_path",
-                f"s3://sppnaut-referentiel-production/g4",
-                "--s3_destination_path",
-                f"s3://S3_BUCKET_GENERATED_PRODUCTION/g4",
-                "--compress",
-                "--vignette",
-                "--metadata",
-            ],
-        )
-
     def test_http(
-        self,
-        tmp_path,
-        settings,
-        client,
-        fake_g4_generator,
-        authorization_header,
+        self, tmp_path, settings, client, authorization_header, procrastinate
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
@@ -104,17 +99,12 @@ class TestGenerateFromProduction:
             HTTP_AUTHORIZATION=authorization_header,
         )
 
-        assert fake_g4_generator.calls
         assert response.status_code == 202
         assert "generation_id" in response.json()
+        assert len(procrastinate.jobs) == 1
 
     def test_filesystem_setup(
-        self,
-        tmp_path,
-        settings,
-        client,
-        fake_g4_generator,
-        authorization_header,
+        self, tmp_path, settings, client, authorization_header, procrastinate
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
@@ -125,16 +115,10 @@ class TestGenerateFromProduction:
         )
 
         generation_id = response.json()["generation_id"]
-        assert fake_g4_generator.calls
         assert (tmp_path / generation_id / "g4").exists()
 
-    def test_shell_script_options(
-        self,
-        tmp_path,
-        settings,
-        client,
-        fake_g4_generator,
-        authorization_header,
+    def test_generator_options(
+        self, tmp_path, settings, client, authorization_header, procrastinate
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
@@ -145,36 +129,23 @@ class TestGenerateFromProduction:
         )
 
         generation_id = response.json()["generation_id"]
-        publication_path = tmp_path / generation_id / "g4"
-        assert fake_g4_generator.first_call.args[1] == publication_path / "returncode"
-        assert fake_g4_generator.first_call.args[3] == publication_path
+        [job] = procrastinate.jobs.values()
+        assert job["lock"] == generation_id
+        assert job["args"] == {
+            "publication_path": str(tmp_path / generation_id / "g4"),
+            "s3_endpoint": "https://cellar-fr-north-hds-c1.services.clever-cloud.com",
+            "s3_inputs_bucket": "s3://sppnaut-referentiel-production",
+            "s3_source_path": "s3://sppnaut-referentiel-production/g4",
+            "s3_destination_path": "s3://S3_BUCKET_GENERATED_PRODUCTION/g4",
+            "compress": True,
+            "vignette": True,
+            "metadata": True,
+        }
 
 
 class TestGenerateFromPreparation:
-    @pytest.fixture
-    def fake_g4p_generator(self, fake_process, settings):
-        return fake_process.register(
-            [
-                settings.BIN_DIR / "echo_returncode_in.py",
-                fake_process.any(min=1, max=1),
-                settings.BASE_DIR / "bin" / "generator.py",
-                fake_process.any(min=1, max=1),
-                "--s3_endpoint",
-                "https://cellar-fr-north-hds-c1.services.clever-cloud.com",
-                "--s3_inputs_bucket",
-                "s3://sppnaut-referentiel-production",
-                "--s3_source_path",
-                f"s3://sppnaut-referentiel-preparation/g4p",
-            ],
-        )
-
     def test_http(
-        self,
-        tmp_path,
-        settings,
-        client,
-        fake_g4p_generator,
-        authorization_header,
+        self, tmp_path, settings, client, authorization_header, procrastinate
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
@@ -184,17 +155,12 @@ class TestGenerateFromPreparation:
             HTTP_AUTHORIZATION=authorization_header,
         )
 
-        assert fake_g4p_generator.calls
         assert response.status_code == 202
         assert "generation_id" in response.json()
+        assert len(procrastinate.jobs) == 1
 
     def test_filesystem_setup(
-        self,
-        tmp_path,
-        settings,
-        client,
-        fake_g4p_generator,
-        authorization_header,
+        self, tmp_path, settings, client, authorization_header, procrastinate
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
@@ -205,17 +171,10 @@ class TestGenerateFromPreparation:
         )
 
         generation_id = response.json()["generation_id"]
-        assert fake_g4p_generator.calls
-
         assert (tmp_path / generation_id / "g4p").exists()
 
-    def test_shell_script_options(
-        self,
-        tmp_path,
-        settings,
-        client,
-        fake_g4p_generator,
-        authorization_header,
+    def test_generator_options(
+        self, tmp_path, settings, client, authorization_header, procrastinate
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
@@ -226,9 +185,14 @@ class TestGenerateFromPreparation:
         )
 
         generation_id = response.json()["generation_id"]
-        publication_path = tmp_path / generation_id / "g4p"
-        assert fake_g4p_generator.first_call.args[1] == publication_path / "returncode"
-        assert fake_g4p_generator.first_call.args[3] == publication_path
+        [job] = procrastinate.jobs.values()
+        assert job["lock"] == generation_id
+        assert job["args"] == {
+            "publication_path": str(tmp_path / generation_id / "g4p"),
+            "s3_endpoint": "https://cellar-fr-north-hds-c1.services.clever-cloud.com",
+            "s3_inputs_bucket": "s3://sppnaut-referentiel-production",
+            "s3_source_path": "s3://sppnaut-referentiel-preparation/g4p",
+        }
 
 
 class TestPublication:
@@ -241,7 +205,7 @@ class TestPublication:
         assert response.status_code == 409
 
     def test_generation_not_started(
-        self, tmp_path, settings, client, authorization_header
+        self, tmp_path, settings, client, authorization_header, procrastinate
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
@@ -257,11 +221,12 @@ class TestPublication:
         assert response.headers["content-type"] == "text/plain; charset=utf-8"
 
     def test_generation_in_progress(
-        self, tmp_path, settings, client, authorization_header
+        self, tmp_path, settings, client, authorization_header, procrastinate
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
         (tmp_path / "fake_generation_id" / "g4p").mkdir(parents=True)
+        generation_job(procrastinate, "fake_generation_id", "doing")
         (tmp_path / "fake_generation_id" / "g4p" / "displayable_step").write_text(
             "Trop bieng!"
         )
@@ -276,12 +241,12 @@ class TestPublication:
         assert response.headers["content-type"] == "text/plain; charset=utf-8"
 
     def test_generation_failed(
-        self, tmp_path, settings, client, authorization_header, caplog
+        self, tmp_path, settings, client, authorization_header, procrastinate, caplog
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
         (tmp_path / "fake_generation_id" / "g4p").mkdir(parents=True)
-        (tmp_path / "fake_generation_id" / "g4p" / "returncode").write_text("1")
+        generation_job(procrastinate, "fake_generation_id", "failed")
         (tmp_path / "fake_generation_id" / "g4p" / "stderr.log").write_text(
             """Oh noes!
 Many errors!
@@ -314,11 +279,32 @@ Traceback (most recent call last):
             ),
         ]
 
-    def test_generation_done(self, tmp_path, settings, client, authorization_header):
+    def test_generation_failed_without_log(
+        self, tmp_path, settings, client, authorization_header, procrastinate, caplog
+    ):
         settings.HOME_GENERATION_PATH = tmp_path
 
         (tmp_path / "fake_generation_id" / "g4p").mkdir(parents=True)
-        (tmp_path / "fake_generation_id" / "g4p" / "returncode").write_text("0")
+        generation_job(procrastinate, "fake_generation_id", "failed")
+
+        response = client.get(
+            "/publication/fake_generation_id/",
+            HTTP_AUTHORIZATION=authorization_header,
+        )
+
+        assert response.status_code == 500
+        assert response.content.decode() == "La génération a échoué."
+        assert ("root", logging.ERROR, "Publication g4p failed to generate") in (
+            caplog.record_tuples
+        )
+
+    def test_generation_done(
+        self, tmp_path, settings, client, authorization_header, procrastinate
+    ):
+        settings.HOME_GENERATION_PATH = tmp_path
+
+        (tmp_path / "fake_generation_id" / "g4p").mkdir(parents=True)
+        generation_job(procrastinate, "fake_generation_id", "succeeded")
         (tmp_path / "fake_generation_id" / "g4p" / "document.pdf").write_text("abcd")
 
         response = client.get(
@@ -332,13 +318,17 @@ Traceback (most recent call last):
         assert list(response.streaming_content) == [b"abcd"]
 
     def test_calmar_generation_done(
-        self, tmp_path, settings, client, authorization_header
+        self, tmp_path, settings, client, authorization_header, procrastinate
     ):
         settings.HOME_GENERATION_PATH = tmp_path
 
         (tmp_path / "fake_generation_id" / "g4p").mkdir(parents=True)
-        (tmp_path / "fake_generation_id" / "g4p" / "returncode").write_text("0")
-        (tmp_path / "fake_generation_id" / "g4p" / "archive.zip").write_text("abcd")
+        generation_job(procrastinate, "fake_generation_id", "succeeded")
+        (tmp_path / "fake_generation_id" / "g4p" / "document.pdf").write_text("abcd")
+        (tmp_path / "fake_generation_id" / "g4p" / "calmar.pdf").write_text("efgh")
+        (tmp_path / "fake_generation_id" / "g4p" / "bundle").write_text(
+            "calmar.pdf\ndocument.pdf\n"
+        )
 
         response = client.get(
             "/publication/fake_generation_id/",
@@ -346,6 +336,28 @@ Traceback (most recent call last):
         )
 
         assert response.status_code == 200
-        assert response.filename == "g4p.zip"
+        assert response.headers["content-disposition"] == (
+            'attachment; filename="g4p.zip"'
+        )
         assert response.headers["content-type"] == "application/zip"
-        assert list(response.streaming_content) == [b"abcd"]
+        with zipfile.ZipFile(
+            io.BytesIO(b"".join(response.streaming_content))
+        ) as archive:
+            assert archive.namelist() == ["calmar.pdf", "document.pdf"]
+            assert archive.read("document.pdf") == b"abcd"
+
+    def test_generation_started_again(
+        self, tmp_path, settings, client, authorization_header, procrastinate
+    ):
+        settings.HOME_GENERATION_PATH = tmp_path
+
+        (tmp_path / "fake_generation_id" / "g4p").mkdir(parents=True)
+        generation_job(procrastinate, "fake_generation_id", "failed")
+        generation_job(procrastinate, "fake_generation_id", "todo")
+
+        response = client.get(
+            "/publication/fake_generation_id/",
+            HTTP_AUTHORIZATION=authorization_header,
+        )
+
+        assert response.status_code == 404
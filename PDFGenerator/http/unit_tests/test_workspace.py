@@ -0,0 +1,34 @@
+import shutil
+from unittest.mock import patch
+
+from home.workspace import WorkspaceLinker
+
+
+class TestWorkspaceLinker:
+    def test_link_tree(self, tmp_path):
+        (tmp_path / "commun" / "illustrations").mkdir(parents=True)
+        (tmp_path / "commun" / "illustrations" / "logo.eps").write_text("12345")
+
+        workspace = WorkspaceLinker()
+        # A copy-on-write filesystem
+        with patch("home.workspace.reflink", side_effect=shutil.copy2):
+            workspace.link_tree(tmp_path / "commun", tmp_path / "generation" / "commun")
+
+        linked_file = tmp_path / "generation" / "commun" / "illustrations" / "logo.eps"
+        assert linked_file.read_text() == "12345"
+        assert (workspace.linked_bytes, workspace.copied_bytes) == (5, 0)
+
+    def test_copy_when_reflinks_are_not_supported(self, tmp_path):
+        (tmp_path / "commun").mkdir()
+        (tmp_path / "commun" / "logo.eps").write_text("12345")
+
+        workspace = WorkspaceLinker()
+        with patch("home.workspace.fcntl.ioctl", side_effect=OSError):
+            workspace.link_tree(tmp_path / "commun", tmp_path / "copy")
+
+        assert (tmp_path / "copy" / "logo.eps").read_text() == "12345"
+        assert (workspace.linked_bytes, workspace.copied_bytes) == (0, 5)
+        # Not hardlinked: writing the copy in place leaves the assets untouched
+        with open(tmp_path / "copy" / "logo.eps", "w") as copy:
+            copy.write("modified")
+        assert (tmp_path / "commun" / "logo.eps").read_text() == "12345"
@@ -0,0 +1,27 @@
+import io
+import zipfile
+
+from home.zip_stream import stream_zip
+
+
+class TestStreamZip:
+    def test_stored_entries(self, tmp_path):
+        (tmp_path / "document.pdf").write_bytes(b"%PDF" * 1000)
+        (tmp_path / "calmar.pdf").write_bytes(b"")
+
+        chunks = list(
+            stream_zip([tmp_path / "document.pdf", tmp_path / "calmar.pdf"], 1024)
+        )
+
+        # Written while the files are read, not at the end
+        assert len([chunk for chunk in chunks if chunk]) > 2
+        with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+            assert archive.testzip() is None
+            assert [
+                (info.filename, info.compress_type, info.file_size)
+                for info in archive.infolist()
+            ] == [
+                ("document.pdf", zipfile.ZIP_STORED, 4000),
+                ("calmar.pdf", zipfile.ZIP_STORED, 0),
+            ]
+            assert archive.read("document.pdf") == b"%PDF" * 1000
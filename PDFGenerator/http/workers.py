@@ -1,3 +1,6 @@
+import os
+
+import django
 from core import error_reporting
 from decouple import config
 from procrastinate import AiopgConnector, App
@@ -5,6 +8,10 @@ from procrastinate.testing import InMemoryConnector
 
 error_reporting.init()
 
+# The tasks read and write the models of home
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+django.setup()
+
 if config("TEST", default=False, cast=bool):
     connector = InMemoryConnector()
 else:
@@ -0,0 +1,240 @@
+import java.io.BufferedReader;
+import java.io.BufferedWriter;
+import java.io.File;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.OutputStreamWriter;
+import java.io.Writer;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.Collections;
+import java.util.LinkedHashMap;
+import java.util.List;
+import java.util.Map;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+
+import javax.xml.transform.ErrorListener;
+import javax.xml.transform.SourceLocator;
+import javax.xml.transform.TransformerException;
+import javax.xml.transform.stream.StreamSource;
+
+import net.sf.saxon.Configuration;
+import net.sf.saxon.Controller;
+import net.sf.saxon.s9api.MessageListener;
+import net.sf.saxon.s9api.Processor;
+import net.sf.saxon.s9api.QName;
+import net.sf.saxon.s9api.SaxonApiException;
+import net.sf.saxon.s9api.Serializer;
+import net.sf.saxon.s9api.XdmAtomicValue;
+import net.sf.saxon.s9api.XdmNode;
+import net.sf.saxon.s9api.XsltCompiler;
+import net.sf.saxon.s9api.XsltExecutable;
+import net.sf.saxon.s9api.XsltTransformer;
+
+/**
+ * Saxon transformations served to the generator over a local socket, so that
+ * the JVM startup, class loading and JIT warm-up are paid once.
+ *
+ * Each connection sends one request, the source document followed by the
+ * transforms to apply to it and an empty line, fields being tab separated:
+ *
+ *     SOURCE source
+ *     TRANSFORM stylesheet key output warnings name=value...
+ *     TRANSFORM ...
+ *
+ * where `key` identifies the version of the stylesheet and its imports at
+ * this location,
+ * `output` is empty to discard the principal result and `warnings` is empty,
+ * "silent", "recover" or "fatal" (the `-warnings` CLI option). The source is
+ * parsed once for all the transforms, which run in order. The response is a
+ * `MESSAGE text` line per warning or xsl:message, followed by `OK` or, at the
+ * first failure, `ERROR text`.
+ *
+ * Compiled stylesheets are kept by key, so each version of a stylesheet is
+ * compiled once by location. Relative URIs of a compiled stylesheet resolve
+ * against the folder it was compiled from, hence the location in the key:
+ * a cached stylesheet is never used from another folder, which may have been
+ * removed since. The least recently used ones are dropped past
+ * MAX_EXECUTABLES.
+ *
+ * Requests are served by a fixed number of threads, the `java` slots of the
+ * host (see `home/slots.py`), which the generations take for each request:
+ * the heap, bounded by the options of the JVM, is shared by that many
+ * transforms at most.
+ *
+ * Usage: java -Xmx4g -cp saxon9.jar:. SaxonService 127.0.0.1:8390 [threads]
+ */
+public class SaxonService {
+    private static final int MAX_EXECUTABLES = 16;
+
+    private final Processor processor = new Processor(true);
+    private final Map<String, XsltExecutable> executables = Collections.synchronizedMap(
+            new LinkedHashMap<String, XsltExecutable>(MAX_EXECUTABLES, 0.75f, true) {
+                @Override
+                protected boolean removeEldestEntry(Map.Entry<String, XsltExecutable> eldest) {
+                    return size() > MAX_EXECUTABLES;
+                }
+            });
+
+    public static void main(String[] args) throws IOException {
+        String address = args.length > 0 ? args[0] : "127.0.0.1:8390";
+        int separator = address.lastIndexOf(':');
+        InetAddress host = InetAddress.getByName(address.substring(0, separator));
+        int port = Integer.parseInt(address.substring(separator + 1));
+
+        int threads = args.length > 1
+                ? Integer.parseInt(args[1])
+                : Math.max(1, Runtime.getRuntime().availableProcessors() / 2);
+
+        SaxonService service = new SaxonService();
+        ExecutorService executor = Executors.newFixedThreadPool(threads);
+        try (ServerSocket server = new ServerSocket(port, 50, host)) {
+            System.err.println("SAXON SERVICE : listening on " + address);
+            while (true) {
+                Socket connection = server.accept();
+                executor.execute(() -> service.serve(connection));
+            }
+        }
+    }
+
+    private void serve(Socket connection) {
+        try (connection;
+                BufferedReader reader = new BufferedReader(
+                        new InputStreamReader(connection.getInputStream(), StandardCharsets.UTF_8));
+                Writer writer = new BufferedWriter(
+                        new OutputStreamWriter(connection.getOutputStream(), StandardCharsets.UTF_8))) {
+            List<String[]> request = new ArrayList<>();
+            for (String line = reader.readLine(); line != null && !line.isEmpty(); line = reader.readLine()) {
+                request.add(line.split("\t", -1));
+            }
+            if (request.isEmpty()) {
+                return;
+            }
+            Response response = new Response(writer);
+            try {
+                handle(request, response);
+                response.write("OK", null);
+            } catch (SaxonApiException | RuntimeException e) {
+                response.write("ERROR", e.getMessage() != null ? e.getMessage() : e.toString());
+            }
+            writer.flush();
+        } catch (IOException e) {
+            System.err.println("SAXON SERVICE : " + e);
+        }
+    }
+
+    private void handle(List<String[]> request, Response response) throws SaxonApiException {
+        String[] source = request.get(0);
+        if (source.length != 2 || !source[0].equals("SOURCE")) {
+            throw new IllegalArgumentException("Invalid request");
+        }
+        XdmNode document = processor.newDocumentBuilder().build(new File(source[1]));
+        for (String[] fields : request.subList(1, request.size())) {
+            transform(document, fields, response);
+        }
+    }
+
+    private void transform(XdmNode document, String[] fields, Response response) throws SaxonApiException {
+        if (fields.length < 5 || !fields[0].equals("TRANSFORM")) {
+            throw new IllegalArgumentException("Invalid request");
+        }
+        String stylesheet = fields[1];
+        String key = fields[2];
+        String output = fields[3];
+        String warnings = fields[4];
+
+        XsltTransformer transformer = executable(stylesheet, key, response).load();
+        transformer.setMessageListener(response);
+        Controller controller = transformer.getUnderlyingController();
+        controller.setErrorListener(response);
+        controller.setRecoveryPolicy(recoveryPolicy(warnings));
+        for (int i = 5; i < fields.length; i++) {
+            String[] parameter = fields[i].split("=", 2);
+            transformer.setParameter(new QName(parameter[0]), new XdmAtomicValue(parameter[1]));
+        }
+
+        transformer.setInitialContextNode(document);
+        Serializer serializer = new Serializer();
+        if (output.isEmpty()) {
+            serializer.setOutputStream(OutputStream.nullOutputStream());
+        } else {
+            serializer.setOutputFile(new File(output));
+            controller.setBaseOutputURI(new File(output).toURI().toString());
+        }
+        transformer.setDestination(serializer);
+        transformer.transform();
+    }
+
+    private XsltExecutable executable(String stylesheet, String key, Response response)
+            throws SaxonApiException {
+        XsltExecutable executable = executables.get(key);
+        if (executable == null) {
+            // Concurrent requests may compile the same stylesheet, the last one is kept.
+            // The key includes the location, relative URIs resolve against it.
+            XsltCompiler compiler = processor.newXsltCompiler();
+            compiler.setErrorListener(response);
+            executable = compiler.compile(new StreamSource(new File(stylesheet)));
+            executables.put(key, executable);
+            System.err.println("SAXON SERVICE : compiled " + stylesheet + " (" + key + ")");
+        }
+        return executable;
+    }
+
+    private static int recoveryPolicy(String warnings) {
+        switch (warnings) {
+            case "silent":
+                return Configuration.RECOVER_SILENTLY;
+            case "fatal":
+                return Configuration.DO_NOT_RECOVER;
+            default:
+                return Configuration.RECOVER_WITH_WARNINGS;
+        }
+    }
+
+    /** Forwards warnings, errors and messages to the client as they come. */
+    private static class Response implements ErrorListener, MessageListener {
+        private final Writer writer;
+
+        Response(Writer writer) {
+            this.writer = writer;
+        }
+
+        synchronized void write(String kind, String text) {
+            try {
+                writer.write(kind);
+                if (text != null) {
+                    writer.write("\t");
+                    writer.write(text.replace('\t', ' ').replace("\r", "").replace("\n", "\n" + kind + "\t"));
+                }
+                writer.write("\n");
+            } catch (IOException e) {
+                throw new RuntimeException(e);
+            }
+        }
+
+        private void report(String level, TransformerException exception) {
+            write("MESSAGE", level + ": " + exception.getMessageAndLocation());
+        }
+
+        public void warning(TransformerException exception) {
+            report("Warning", exception);
+        }
+
+        public void error(TransformerException exception) {
+            report("Error", exception);
+        }
+
+        public void fatalError(TransformerException exception) {
+            report("Error", exception);
+        }
+
+        public void message(XdmNode content, boolean terminate, SourceLocator locator) {
+            write("MESSAGE", content.getStringValue());
+        }
+    }
+}
@@ -4,13 +4,13 @@ Synchronize a folder to S3
 
 import argparse
 import logging
-import subprocess
-import sys
 from pathlib import Path
 
 import sentry_sdk
 from decouple import config
 
+from s3_transfer import s3_client, sync_folder
+
 S3_ENDPOINT = config("S3_ENDPOINT")
 SENTRY_DSN = config("SENTRY_DSN")
 INCLUDE_PATTERNS = config(
@@ -28,16 +28,6 @@ sentry_sdk.init(
     dsn=SENTRY_DSN,
 )
 
-
-include_arguments = []
-for pattern in INCLUDE_PATTERNS:
-    include_arguments.append("--include")
-    include_arguments.append(pattern)
-
-    # We add **/ because it seems to be necessary to ignore these patterns in subdirectories
-    include_arguments.append("--include")
-    include_arguments.append(f"**/{pattern}")
-
 parser = argparse.ArgumentParser()
 parser.add_argument("referentiel_local_path")
 parser.add_argument("s3_bucket")
@@ -50,22 +40,9 @@ if not Path(args.referentiel_local_path).is_dir():
     )
     exit(1)
 
-subprocess.run(
-    [
-        sys.executable,
-        "-m",
-        "awscli",
-        "s3",
-        "sync",
-        args.referentiel_local_path,
-        f"s3://{args.s3_bucket}",
-        "--delete",
-        "--endpoint-url",
-        S3_ENDPOINT,
-        "--exclude",
-        "*"
-        # "--debug",
-    ]
-    + include_arguments,
-    check=True,
+sync_folder(
+    s3_client(S3_ENDPOINT),
+    Path(args.referentiel_local_path),
+    args.s3_bucket,
+    INCLUDE_PATTERNS,
 )
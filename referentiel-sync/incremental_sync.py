@@ -5,18 +5,19 @@ Watch a folder to incrementally synchronise it to S3
 import argparse
 import logging
 import os
-import subprocess
-import sys
 import time
 from pathlib import Path, PurePosixPath
 from stat import filemode
 
 import sentry_sdk
+from botocore.exceptions import BotoCoreError, ClientError
 from decouple import config
 from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_fixed
 from watchdog.events import LoggingEventHandler, PatternMatchingEventHandler
 from watchdog.observers import Observer
 
+from s3_transfer import s3_client, upload_files, write_version
+
 S3_ENDPOINT = config("S3_ENDPOINT")
 SENTRY_DSN = config("SENTRY_DSN")
 INCLUDE_PATTERNS = config(
@@ -48,17 +49,17 @@ class S3UploadHandler(PatternMatchingEventHandler):
         super().__init__(*args, **kwargs)
         self.s3_bucket = s3_bucket
         self.referentiel_local_path = referentiel_local_path.resolve()
+        self.client = s3_client(S3_ENDPOINT)
 
-    def _build_s3_path(self, path: Path) -> str:
-        relative_path = PurePosixPath(
-            path.resolve().relative_to(self.referentiel_local_path)
+    def _build_s3_key(self, path: Path) -> str:
+        return str(
+            PurePosixPath(path.resolve().relative_to(self.referentiel_local_path))
         )
-        return f"s3://{self.s3_bucket}/{relative_path}"
 
     @retry(
         stop=stop_after_attempt(5),
         wait=wait_fixed(0.2),
-        retry=retry_if_exception_type(subprocess.CalledProcessError),
+        retry=retry_if_exception_type((BotoCoreError, ClientError)),
         reraise=True,
     )
     def _upload(self, file_to_upload: str) -> None:
@@ -70,34 +71,15 @@ class S3UploadHandler(PatternMatchingEventHandler):
             logging.info("File does not match patterns, skipping: %s", path_to_upload)
             return
 
-        awscli = subprocess.run(
-            [
-                sys.executable,
-                "-m",
-                "awscli",
-                "s3",
-                "cp",
-                "--endpoint-url",
-                S3_ENDPOINT,
-                str(path_to_upload),
-                self._build_s3_path(path_to_upload),
-            ],
-            stderr=subprocess.STDOUT,
-            stdout=subprocess.PIPE,
-        )
-        logging.info("AWSCLI: %s", awscli.stdout.decode())
-
+        s3_key = self._build_s3_key(path_to_upload)
         try:
-            awscli.check_returncode()
-        except subprocess.CalledProcessError:
-            if "Skipping file" in awscli.stdout.decode():
-                # AWS can't read the file
-                # we skip it until the next Ffile system notification
-                # when the file will be available.
-                logging.warning("Skipping file: %s", path_to_upload)
-                return
-
-            raise
+            upload_files(self.client, [(path_to_upload, self.s3_bucket, s3_key)])
+        except PermissionError:
+            # The file can't be read yet, we skip it until the next file
+            # system notification when the file will be available.
+            logging.warning("Skipping file: %s", path_to_upload)
+            return
+        write_version(self.client, self.s3_bucket, [s3_key])
 
     def dispatch(self, event):
         # We don't want failing commands to crash our process. So we just report exceptions.
@@ -0,0 +1,120 @@
+"""
+Uploads to S3 run in the process with botocore and s3transfer, the libraries
+of awscli, instead of an awscli process by command.
+
+The client reads the credentials and the signature version configured with
+`python -m awscli configure`. Files are uploaded concurrently, the large ones
+in concurrent multipart parts, and failed requests are retried by botocore.
+"""
+
+import logging
+import uuid
+from pathlib import Path, PurePosixPath
+
+import botocore.session
+from botocore.config import Config
+from s3transfer.manager import TransferConfig, TransferManager
+
+MAX_CONCURRENCY = 10
+RETRY_ATTEMPTS = 5
+MIB = 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * MIB,
+    multipart_chunksize=16 * MIB,
+    max_request_concurrency=MAX_CONCURRENCY,
+)
+DELETE_BATCH_SIZE = 1000  # keys by DeleteObjects request
+# Replaced after each change, at the root of the bucket and in each changed
+# top-level folder: the generator syncs the bucket again when the ETag of the
+# first changes, and regenerates an ouvrage when the one of its folder changes
+VERSION_KEY = "VERSION"
+
+
+def s3_client(endpoint_url: str):
+    return botocore.session.get_session().create_client(
+        "s3",
+        endpoint_url=endpoint_url,
+        config=Config(
+            max_pool_connections=MAX_CONCURRENCY,
+            retries={"max_attempts": RETRY_ATTEMPTS, "mode": "standard"},
+        ),
+    )
+
+
+def upload_files(client, uploads: list[tuple[Path, str, str]]) -> None:
+    """Upload concurrently the `(path, bucket, key)`."""
+    with TransferManager(client, TRANSFER_CONFIG) as manager:
+        futures = []
+        for path, bucket, key in uploads:
+            logging.info("upload: %s to s3://%s/%s", path, bucket, key)
+            futures.append(manager.upload(str(path), bucket, key))
+        for future in futures:
+            future.result()
+
+
+def write_version(client, bucket: str, keys: list[str]) -> None:
+    """Replace the version of the bucket and of the folders of the changed `keys`."""
+    version = uuid.uuid4().hex
+    folders = sorted({key.split("/")[0] for key in keys if "/" in key})
+    for version_key in [
+        *(f"{folder}/{VERSION_KEY}" for folder in folders),
+        VERSION_KEY,
+    ]:
+        logging.info("version: s3://%s/%s %s", bucket, version_key, version)
+        client.put_object(Bucket=bucket, Key=version_key, Body=version.encode())
+
+
+def _is_included(path: PurePosixPath, include_patterns: list[str]) -> bool:
+    return any(path.match(pattern) for pattern in include_patterns)
+
+
+def sync_folder(
+    client, local_path: Path, bucket: str, include_patterns: list[str]
+) -> None:
+    """
+    Upload the included files missing from the bucket, or with another size
+    or a later modification, and delete the included objects without a local
+    file, like `aws s3 sync --delete`. The version is replaced when the bucket
+    changed.
+    """
+    local_files = {
+        file.relative_to(local_path).as_posix(): file
+        for file in local_path.rglob("*")
+        if file.is_file()
+        and _is_included(PurePosixPath(file.relative_to(local_path)), include_patterns)
+    }
+    s3_objects = {
+        s3_object["Key"]: s3_object
+        for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket)
+        for s3_object in page.get("Contents", [])
+        if _is_included(PurePosixPath(s3_object["Key"]), include_patterns)
+    }
+
+    def is_outdated(key: str, file: Path) -> bool:
+        if key not in s3_objects:
+            return True
+        stat = file.stat()
+        return (
+            stat.st_size != s3_objects[key]["Size"]
+            or stat.st_mtime > s3_objects[key]["LastModified"].timestamp()
+        )
+
+    uploads = [
+        (file, bucket, key)
+        for key, file in local_files.items()
+        if is_outdated(key, file)
+    ]
+    upload_files(client, uploads)
+
+    deleted_keys = sorted(s3_objects.keys() - local_files.keys())
+    for start in range(0, len(deleted_keys), DELETE_BATCH_SIZE):
+        batch = deleted_keys[start : start + DELETE_BATCH_SIZE]
+        for key in batch:
+            logging.info("delete: s3://%s/%s", bucket, key)
+        client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+        )
+
+    if uploads or deleted_keys:
+        write_version(client, bucket, [key for _, _, key in uploads] + deleted_keys)